@@ -93,6 +93,8 @@ TEMPLATES = [
                 'django.contrib.messages.context_processors.messages',
                 'products.context_processors.cart_total_amount',
                 'products.context_processors.current_year',
+                'products.context_processors.navigation',
+                'products.context_processors.currency',
                 'accounts.context_processors.auth_forms',
             ],
         },
@@ -108,6 +110,10 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # SQLite не поддерживает SELECT ... FOR UPDATE: транзакции сразу берут
+        # блокировку записи (BEGIN IMMEDIATE), иначе резерв товара
+        # (products/reservations.py) прочитал бы остаток без блокировки
+        'OPTIONS': {'transaction_mode': 'IMMEDIATE'},
     }
 }
 
@@ -310,6 +316,70 @@ CACHES = {
     }
 }
 
+# Поисковый бэкенд каталога: 'auto' (FTS5, если доступен), 'fts5' или 'python'.
+# Индекс 'python' у каждого процесса свой и не видит записей других процессов
+PRODUCT_SEARCH_BACKEND = 'auto'
+# Автодополнение поиска: максимум подсказок каждого вида и прогрев индекса
+# при старте сервера (команды manage.py, кроме runserver, его не прогревают)
+SEARCH_SUGGESTIONS_LIMIT = 8
+SEARCH_AUTOCOMPLETE_WARMUP = True
+# Кеш результатов поиска (id найденных товаров) и максимум id для просмотра каталога без запроса
+SEARCH_RESULTS_CACHE_TIMEOUT = 300
+SEARCH_RESULTS_CACHE_MAX_IDS = 1200
+# Пагинация каталога: 'cursor' (keyset, без COUNT/OFFSET) или 'page'; TTL приблизительного COUNT(*)
+PRODUCT_PAGINATION_MODE = 'cursor'
+APPROXIMATE_COUNT_TIMEOUT = 600
+# Фасеты: границы ценовых диапазонов (руб.) и TTL кеша счётчиков
+SEARCH_FACET_PRICE_BUCKETS = (1000, 5000, 10000, 50000)
+SEARCH_FACETS_CACHE_TIMEOUT = 300
+# Подсветка результатов поиска: длина фрагмента описания и TTL кеша фрагментов
+SEARCH_SNIPPET_LENGTH = 160
+SEARCH_SNIPPET_CACHE_TIMEOUT = 3600
+# Журнал поисковых запросов: буфер, размер пачки bulk_create и период фонового сброса (сек.)
+SEARCH_LOG_ENABLED = True
+SEARCH_LOG_BUFFER_SIZE = 10000
+SEARCH_LOG_BATCH_SIZE = 100
+SEARCH_LOG_FLUSH_INTERVAL = 5
+# Дерево навигации по категориям (перестраивается при изменении каталога)
+NAVIGATION_CACHE_TIMEOUT = 60 * 60
+# Сколько секунд держится резерв товара в корзине (см. products/reservations.py)
+STOCK_RESERVATION_TTL = 15 * 60
+# TTL кешированной сводки корзины авторизованного пользователя (см. products/cart.py)
+CART_SUMMARY_CACHE_TIMEOUT = 15 * 60
+# История заказов: заказов на страницу и TTL кеша страниц (см. products/orders.py)
+ORDER_HISTORY_PAGE_SIZE = 10
+ORDER_HISTORY_CACHE_TIMEOUT = 15 * 60
+ORDER_TRANSITION_CHUNK_SIZE = 500
+# Последняя активность: не чаще раза в GRANULARITY сек. на пользователя,
+# запись в БД пачкой раз в FLUSH_INTERVAL сек. фоновым потоком (см.
+# accounts/activity.py). Отметки в LocMemCache видны только своему процессу
+LAST_ACTIVITY_GRANULARITY = 30
+LAST_ACTIVITY_FLUSH_INTERVAL = 15
+LAST_ACTIVITY_BATCH_SIZE = 500
+# Сколько секунд кеш и сессия верят часовому поясу, прочитанному из профиля
+# (см. accounts/timezones.py)
+USER_TIMEZONE_CACHE_TIMEOUT = 5 * 60
+# События активности: буфер, пачка bulk_create, период фонового сброса (сек.)
+# (см. accounts/events.py)
+USER_ACTIVITY_ENABLED = True
+USER_ACTIVITY_BUFFER_SIZE = 10000
+USER_ACTIVITY_BATCH_SIZE = 200
+USER_ACTIVITY_FLUSH_INTERVAL = 5
+# Срок хранения журналов пользователей и свёртка старых строк в дневные итоги;
+# применяется командой apply_retention (см. accounts/retention.py)
+RETENTION_POLICIES = {
+    'accounts.UserActivity': {'days': 180, 'rollup': True},
+    'accounts.UserLoginHistory': {'days': 365, 'rollup': True},
+}
+# Сколько дней истории входов показывать в карточке пользователя в админке
+ADMIN_LOGIN_HISTORY_DAYS = 30
+# Локальная база GeoIP для истории входов (см. accounts/geoip.py): собирается из CSV
+# DB-IP "IP to City Lite" (https://db-ip.com/db/download/ip-to-city-lite) командой
+# python manage.py import_geoip dbip-city-lite-ГГГГ-ММ.csv.gz
+GEOIP_DATABASE_PATH = os.path.join(BASE_DIR, 'data', 'geoip.dat')
+# Валюта цен в каталоге; курсы остальных валют — в ExchangeRate (см. products/currency.py)
+BASE_CURRENCY = 'MDL'
+
 INTERNAL_IPS = [
     '127.0.0.1',
 ]
@@ -0,0 +1,126 @@
+# accounts/activity.py
+"""
+Последняя активность пользователей без UPDATE на каждый запрос.
+
+LastActivityMiddleware только отмечает пользователя в трекере. Отметка
+пропускается, если предыдущая была не раньше чем
+settings.LAST_ACTIVITY_GRANULARITY секунд назад: сначала по памяти
+процесса, затем по кешу Django. Общим для процессов этот кеш будет только
+с разделяемым бэкендом (Redis, Memcached); с LocMemCache из настроек по
+умолчанию у каждого процесса свой кеш, и повторы отсекаются только внутри
+процесса. Свежие отметки копятся в буфере и записываются в
+Profile.last_activity одним UPDATE ... CASE WHEN фоновым потоком: раз в
+settings.LAST_ACTIVITY_FLUSH_INTERVAL секунд или сразу, как только в
+буфере набралось LAST_ACTIVITY_BATCH_SIZE отметок (см.
+products/buffering.py). При завершении процесса остаток сбрасывается
+через atexit.
+
+Profile.last_seen и Profile.is_online() читают отметку из кеша,
+ProfileQuerySet.online()/offline() и фильтр админки добавляют к БД ещё не
+записанные отметки процесса. Отметки других процессов попадают в БД не
+позже чем через GRANULARITY + FLUSH_INTERVAL секунд, что должно быть меньше
+Profile.ONLINE_THRESHOLD.
+"""
+import atexit
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Case, DateTimeField, Value, When
+from django.utils import timezone
+
+from products.buffering import BufferedWriter
+
+
+def granularity():
+    return timedelta(seconds=getattr(settings, 'LAST_ACTIVITY_GRANULARITY', 30))
+
+
+def flush_interval():
+    return getattr(settings, 'LAST_ACTIVITY_FLUSH_INTERVAL', 15)
+
+
+def batch_size():
+    return getattr(settings, 'LAST_ACTIVITY_BATCH_SIZE', 500)
+
+
+def activity_key(user_id):
+    return f'last_activity:{user_id}'
+
+
+class ActivityTracker(BufferedWriter):
+    """Буфер отметок: user_id -> отметка, ожидающая записи в БД."""
+    thread_name = 'last-activity-flusher'
+    label = 'последнюю активность'
+    batch_size = staticmethod(batch_size)
+    flush_interval = staticmethod(flush_interval)
+
+    def __init__(self):
+        super().__init__()
+        # user_id -> последняя отметка процесса (записанная или ещё нет)
+        self._seen = {}
+
+    def new_buffer(self):
+        return {}
+
+    def add(self, pending, item):
+        user_id, now = item
+        self._seen[user_id] = now
+        pending[user_id] = now
+
+    def touch(self, user_id, now=None):
+        """Отмечает активность пользователя. Возвращает False, если отметка свежая."""
+        now = now or timezone.now()
+        threshold = now - granularity()
+        with self._lock:
+            seen = self._seen.get(user_id)
+        if seen is not None and seen > threshold:
+            return False
+        shared = cache.get(activity_key(user_id))
+        if shared is not None and shared > threshold:
+            with self._lock:
+                self._seen[user_id] = max(shared, self._seen.get(user_id, shared))
+            return False
+        cache.set(activity_key(user_id), now, int(granularity().total_seconds()) * 4 or None)
+        self.put((user_id, now))
+        return True
+
+    def flush(self):
+        """Записывает накопленные отметки одним UPDATE. Возвращает их число."""
+        with self._lock:
+            # Старые отметки уже не нужны для пропуска повторов
+            threshold = timezone.now() - granularity()
+            self._seen = {uid: seen for uid, seen in self._seen.items() if seen > threshold}
+        return super().flush()
+
+    def write(self, pending):
+        from .models import Profile
+
+        Profile.objects.filter(user_id__in=pending).update(
+            last_activity=Case(
+                *[When(user_id=uid, then=Value(seen)) for uid, seen in pending.items()],
+                output_field=DateTimeField(),
+            )
+        )
+
+    def last_seen(self, user_id, stored=None):
+        """Последняя активность с учётом незаписанных отметок; stored — значение из БД."""
+        with self._lock:
+            seen = self._seen.get(user_id)
+        candidates = [stored, seen, cache.get(activity_key(user_id))]
+        candidates = [value for value in candidates if value is not None]
+        return max(candidates) if candidates else None
+
+    def recent_user_ids(self, since):
+        """Пользователи с незаписанной в БД отметкой не старше since (только этот процесс)."""
+        with self._lock:
+            return [uid for uid, seen in self._pending.items() if seen >= since]
+
+    def clear(self):
+        with self._lock:
+            self._seen = {}
+            self._pending = {}
+
+
+activity_tracker = ActivityTracker()
+atexit.register(activity_tracker.flush)
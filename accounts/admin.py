@@ -1,21 +1,19 @@
 import logging
-import ipaddress
+from datetime import timedelta
 from zoneinfo import available_timezones  # Для формирования списка часовых поясов
 
-import requests
 from django.contrib import admin
 from django.contrib.auth import get_user_model
 from django.contrib.auth.admin import UserAdmin as DefaultUserAdmin
-from django.db.models import Count, Sum, Avg, F, FloatField, ExpressionWrapper
-from django.utils.html import format_html
+from django.conf import settings
+from django.db.models import Avg
 from django.utils import timezone
+from django.utils.html import format_html
 from django.core.cache import cache
 
-from geopy import Nominatim
-from geopy.exc import GeocoderTimedOut, GeocoderUnavailable
-
 from solo.admin import SingletonModelAdmin
 
+from .geoip import NOT_FOUND, locate
 from .models import (
     Profile,
     UserLoginHistory,
@@ -23,6 +21,7 @@ from .models import (
     Subscription,
     PaymentMethod,
     AdminSettings,
+    online_q,
 )
 from products.models import Order, Review, Wishlist
 
@@ -39,40 +38,22 @@ class UserLoginHistoryInline(admin.TabularInline):
     readonly_fields = ('ip_address', 'user_agent', 'session_key', 'login_datetime', 'location_display')
     extra = 0
     can_delete = False
+    verbose_name_plural = "История входов (последние дни)"
+
+    def get_queryset(self, request):
+        # Только недавние входы: карточка не должна читать всю историю пользователя
+        days = getattr(settings, 'ADMIN_LOGIN_HISTORY_DAYS', 30)
+        qs = super().get_queryset(request)
+        return qs.filter(login_datetime__gte=timezone.now() - timedelta(days=days))
 
     def location_display(self, obj):
         """
-        Попытка получить геолокацию по IP через Nominatim (OpenStreetMap).
-        Результат кешируется на 24 часа.
+        Местоположение, определённое при входе; для старых записей без него —
+        по локальной базе GeoIP (accounts/geoip.py), без сетевых запросов.
         """
-        ip = obj.ip_address
-
-        # Проверка на localhost
-        if ip.startswith('127.') or ip == '::1':
-            return "Localhost"
-
-        # Проверка на приватный IP
-        try:
-            ip_obj = ipaddress.ip_address(ip)
-            if ip_obj.is_private:
-                return "Private IP"
-        except ValueError:
-            pass  # Некорректный IP, продолжаем
-
-        cache_key = f"geolocation_{ip}"
-        location = cache.get(cache_key)
-
-        if not location:
-            try:
-                response = requests.get(f"http://ip-api.com/json/{ip}?fields=lat,lon")
-                if response.status_code == 200:
-                    data = response.json()
-                    location_str = f"{data['lat']}, {data['lon']}"
-            except Exception as e:
-                logger.error(f"Geocoding error: {e}")
-                return "Geocoding error"
-
-        return location
+        if not obj.ip_address:
+            return "-"
+        return obj.location or locate(obj.ip_address) or NOT_FOUND
 
     location_display.short_description = "User Location"
 
@@ -163,13 +144,9 @@ class OnlineFilter(admin.SimpleListFilter):
 
     def queryset(self, request, queryset):
         if self.value() == 'online':
-            return queryset.filter(
-                profile__last_activity__gte=timezone.now() - Profile.ONLINE_THRESHOLD
-            )
+            return queryset.filter(online_q('profile__'))
         if self.value() == 'offline':
-            return queryset.filter(
-                profile__last_activity__lt=timezone.now() - Profile.ONLINE_THRESHOLD
-            )
+            return queryset.exclude(online_q('profile__'))
         return queryset
 
 
@@ -222,15 +199,18 @@ class CustomUserAdmin(DefaultUserAdmin):
         return "Нет истории входов"
     user_login_info.short_description = "Информация о последнем входе"
 
+    # Количество заказов и сумма покупок читаются из UserOrderSummary
     def order_count(self, obj):
-        return obj.order_count or 0
+        summary = getattr(obj, 'order_summary', None)
+        return summary.orders_count if summary else 0
     order_count.short_description = 'Количество заказов'
-    order_count.admin_order_field = 'order_count'
+    order_count.admin_order_field = 'order_summary__orders_count'
 
     def total_spent(self, obj):
-        return round(obj.total_spent or 0, 2)
+        summary = getattr(obj, 'order_summary', None)
+        return summary.total_spent if summary else 0
     total_spent.short_description = 'Общая сумма покупок'
-    total_spent.admin_order_field = 'total_spent'
+    total_spent.admin_order_field = 'order_summary__total_spent'
 
     def average_wishlist_rating(self, obj):
         if obj.average_wishlist_rating is None:
@@ -249,7 +229,7 @@ class CustomUserAdmin(DefaultUserAdmin):
     def last_activity(self, obj):
         profile = getattr(obj, 'profile', None)
         if profile:
-            return profile.last_activity if not profile.is_online() else "Сейчас"
+            return profile.last_seen if not profile.is_online() else "Сейчас"
         return "Неизвестно"
     last_activity.short_description = 'Последняя активность'
 
@@ -265,21 +245,14 @@ class CustomUserAdmin(DefaultUserAdmin):
         if cached_qs:
             return cached_qs
 
-        qs = super().get_queryset(request).select_related('profile').prefetch_related(
-            'orders__items',
+        qs = super().get_queryset(request).select_related('profile', 'order_summary').prefetch_related(
             'wishlist__product__reviews',
             'wishlist__product__category',
             'wishlist__product__related_products',
             'payment_methods',
         )
 
-        total_spent_expression = ExpressionWrapper(
-            F('orders__items__price') * F('orders__items__quantity'),
-            output_field=FloatField()
-        )
         qs = qs.annotate(
-            order_count=Count('orders', distinct=True),
-            total_spent=Sum(total_spent_expression),
             average_wishlist_rating=Avg('wishlist__product__reviews__rating'),
         )
 
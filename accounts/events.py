@@ -0,0 +1,68 @@
+# accounts/events.py
+"""
+События активности пользователей (UserActivity) без INSERT в пути запроса.
+
+Представление только добавляет событие в кольцевой буфер процесса
+(settings.USER_ACTIVITY_BUFFER_SIZE; при переполнении вытесняются самые
+старые события). Буфер сбрасывается в БД одним bulk_create фоновым
+потоком: раз в settings.USER_ACTIVITY_FLUSH_INTERVAL секунд или сразу, как
+только в нём набралось settings.USER_ACTIVITY_BATCH_SIZE событий (см.
+products/buffering.py). При завершении процесса остаток буфера
+сбрасывается через atexit.
+
+Старые события удаляются (и сворачиваются в дневные итоги) командой
+apply_retention, см. accounts/retention.py.
+"""
+import atexit
+
+from django.conf import settings
+from django.utils import timezone
+
+from products.buffering import BufferedWriter
+
+
+def events_enabled():
+    return getattr(settings, 'USER_ACTIVITY_ENABLED', True)
+
+
+def batch_size():
+    return getattr(settings, 'USER_ACTIVITY_BATCH_SIZE', 200)
+
+
+def flush_interval():
+    return getattr(settings, 'USER_ACTIVITY_FLUSH_INTERVAL', 5)
+
+
+def buffer_size():
+    return getattr(settings, 'USER_ACTIVITY_BUFFER_SIZE', 10000)
+
+
+class ActivityEventBuffer(BufferedWriter):
+    thread_name = 'activity-flusher'
+    label = 'события активности'
+    batch_size = staticmethod(batch_size)
+    flush_interval = staticmethod(flush_interval)
+    buffer_size = staticmethod(buffer_size)
+
+    def record(self, user_id, activity_type, product_id=None):
+        if not events_enabled():
+            return
+        from .models import UserActivity
+
+        self.put(UserActivity(
+            user_id=user_id,
+            activity_type=activity_type,
+            product_id=product_id,
+            timestamp=timezone.now(),
+        ))
+
+    def write(self, pending):
+        """Записывает накопленные события одним bulk_create."""
+        from .models import UserActivity
+
+        UserActivity.objects.bulk_create(list(pending), batch_size=batch_size())
+
+
+activity_events = ActivityEventBuffer()
+atexit.register(activity_events.flush)
+
@@ -0,0 +1,275 @@
+# accounts/geoip.py
+"""
+Геолокация IP по локальной базе диапазонов, без HTTP-запросов.
+
+Источник — CSV DB-IP "IP to City Lite" (бесплатно, лицензия CC BY 4.0:
+при показе данных нужна ссылка на https://db-ip.com). Файл
+dbip-city-lite-ГГГГ-ММ.csv.gz скачивается с
+https://db-ip.com/db/download/ip-to-city-lite (обновляется раз в месяц) и
+собирается командой
+
+    python manage.py import_geoip dbip-city-lite-2026-10.csv.gz
+
+в двоичный файл settings.GEOIP_DATABASE_PATH (build_database()):
+заголовок, отсортированные диапазоны IPv4 и IPv6 записями фиксированной
+длины (начало, конец, номер места) и таблица мест. Процесс открывает файл
+через mmap и ищет диапазон двоичным поиском прямо по нему — ничего не
+разбирается в памяти, а открытие ничего не стоит, так что первый вход
+после старта не ждёт загрузки. После повторного import_geoip файл
+переоткрывается (сменились путь или mtime). Результаты locate()
+запоминаются в LRU.
+
+Местоположение сохраняется в UserLoginHistory.location при входе
+(accounts/signals.py); '' — место неизвестно (нет в базе или база
+недоступна), подпись для этого случая подставляет админка. Записи,
+сохранённые без места (до появления базы), заполняет
+backfill_locations() — команда import_geoip --backfill.
+"""
+import bisect
+import csv
+import gzip
+import ipaddress
+import logging
+import mmap
+import os
+import struct
+import threading
+from functools import lru_cache
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+LOCALHOST = 'Localhost'
+PRIVATE_IP = 'Private IP'
+NOT_FOUND = 'Location not found'
+
+MAGIC = b'GEOIP\x00\x01\x00'
+# Сигнатура, число диапазонов IPv4, IPv6 и число мест
+HEADER = struct.Struct('>8sIII')
+# Начало, конец (ip_address.packed) и номер места
+RANGES = {4: struct.Struct('>4s4sI'), 6: struct.Struct('>16s16sI')}
+# Смещения строк мест: offsets[i], offsets[i + 1]
+OFFSET = struct.Struct('>I')
+LOCATION_BOUNDS = struct.Struct('>II')
+
+
+def database_path():
+    return getattr(settings, 'GEOIP_DATABASE_PATH', None)
+
+
+class GeoRecord:
+    __slots__ = ('country', 'region', 'city', 'latitude', 'longitude')
+
+    def __init__(self, country, region, city, latitude, longitude):
+        self.country = country
+        self.region = region
+        self.city = city
+        self.latitude = latitude
+        self.longitude = longitude
+
+    def __str__(self):
+        place = ', '.join(part for part in (self.city, self.country) if part)
+        coordinates = f'{self.latitude}, {self.longitude}' if self.latitude is not None else ''
+        if place and coordinates:
+            return f'{place} ({coordinates})'
+        return place or coordinates
+
+
+def read_csv(f):
+    """Строки CSV DB-IP -> (начало, конец, 'страна\\tрегион\\tгород\\tширота\\tдолгота')."""
+    for line in csv.reader(f):
+        if len(line) < 8:
+            continue
+        try:
+            start, end = ipaddress.ip_address(line[0]), ipaddress.ip_address(line[1])
+            for coordinate in line[6:8]:
+                if coordinate:
+                    float(coordinate)
+        except ValueError:
+            continue
+        if start.version != end.version:
+            continue
+        location = '\t'.join(field.replace('\t', ' ') for field in line[3:8])
+        yield start, end, location
+
+
+def build_database(source, target):
+    """
+    Собирает из CSV DB-IP source (.csv или .csv.gz) двоичный файл target.
+    Файл заменяется атомарно: процессы, открывшие прежний, дочитывают его.
+    Возвращает число диапазонов.
+    """
+    ranges = {4: [], 6: []}
+    locations = {}
+    opener = gzip.open if source.endswith('.gz') else open
+    with opener(source, 'rt', newline='', encoding='utf-8') as f:
+        for start, end, location in read_csv(f):
+            index = locations.setdefault(location, len(locations))
+            ranges[start.version].append((start.packed, end.packed, index))
+
+    directory = os.path.dirname(target)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = f'{target}.tmp'
+    with open(tmp, 'wb') as out:
+        out.write(HEADER.pack(MAGIC, len(ranges[4]), len(ranges[6]), len(locations)))
+        for version, record in RANGES.items():
+            for row in sorted(ranges[version]):
+                out.write(record.pack(*row))
+        # Словарь хранит места в порядке номеров
+        strings = [location.encode('utf-8') for location in locations]
+        offset = 0
+        out.write(OFFSET.pack(offset))
+        for string in strings:
+            offset += len(string)
+            out.write(OFFSET.pack(offset))
+        for string in strings:
+            out.write(string)
+    os.replace(tmp, target)
+    return len(ranges[4]) + len(ranges[6])
+
+
+class _Ranges:
+    """Последовательность начал диапазонов в mmap — для bisect без копирования."""
+
+    def __init__(self, data, record, base, count):
+        self._data = data
+        self._record = record
+        self._base = base
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        return self._record.unpack_from(self._data, self._base + index * self._record.size)[0]
+
+    def row(self, index):
+        return self._record.unpack_from(self._data, self._base + index * self._record.size)
+
+
+class GeoIPFile:
+    """Файл, собранный build_database(), открытый через mmap."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, v4, v6, locations = HEADER.unpack_from(self._data)
+        if magic != MAGIC:
+            raise ValueError("неизвестный формат файла")
+        offset = HEADER.size
+        self._ranges = {}
+        for version, count in ((4, v4), (6, v6)):
+            record = RANGES[version]
+            self._ranges[version] = _Ranges(self._data, record, offset, count)
+            offset += record.size * count
+        self._offsets = offset
+        self._strings = offset + OFFSET.size * (locations + 1)
+
+    def lookup(self, address):
+        ranges = self._ranges[address.version]
+        value = address.packed
+        index = bisect.bisect_right(ranges, value) - 1
+        if index < 0:
+            return None
+        _, end, location = ranges.row(index)
+        return self.location(location) if value <= end else None
+
+    def location(self, index):
+        start, end = LOCATION_BOUNDS.unpack_from(self._data, self._offsets + index * OFFSET.size)
+        text = self._data[self._strings + start:self._strings + end].decode('utf-8')
+        country, region, city, latitude, longitude = text.split('\t')
+        return GeoRecord(
+            country, region, city,
+            float(latitude) if latitude else None,
+            float(longitude) if longitude else None,
+        )
+
+
+class GeoIPDatabase:
+    """Текущий файл settings.GEOIP_DATABASE_PATH (переоткрывается при смене пути или mtime)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key = None
+        self._file = None
+
+    def current(self):
+        """Открытый GeoIPFile или None, если базы нет."""
+        path = database_path()
+        try:
+            key = (path, os.stat(path).st_mtime_ns) if path else (None, None)
+        except OSError:
+            key = (path, None)
+        if key != self._key:
+            with self._lock:
+                if key != self._key:
+                    if key[1] is not None:
+                        self._file = self.open(path)
+                    else:
+                        self._file = None
+                        if path:
+                            logger.warning(f"Нет файла базы GeoIP {path}, соберите его командой import_geoip")
+                    self._key = key
+                    cached_locate.cache_clear()
+        return self._file
+
+    @staticmethod
+    def open(path):
+        try:
+            return GeoIPFile(path)
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning(f"Не удалось открыть базу GeoIP {path}: {e}")
+            return None
+
+    def lookup(self, ip):
+        """GeoRecord для адреса ip (str или ip_address) или None."""
+        if isinstance(ip, str):
+            ip = ipaddress.ip_address(ip)
+        database = self.current()
+        return database.lookup(ip) if database is not None else None
+
+
+geoip_database = GeoIPDatabase()
+
+
+def locate(ip):
+    """Подпись местоположения IP для истории входов ('' — место неизвестно)."""
+    # Переоткрывает базу (и сбрасывает LRU), если файл сменился
+    geoip_database.current()
+    return cached_locate(ip)
+
+
+@lru_cache(maxsize=4096)
+def cached_locate(ip):
+    if not ip:
+        return ''
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return ''
+    if address.is_loopback:
+        return LOCALHOST
+    if address.is_private:
+        return PRIVATE_IP
+    record = geoip_database.lookup(address)
+    return str(record) if record else ''
+
+
+def backfill_locations():
+    """
+    Заполняет location у записей истории входов, сохранённых без места.
+    Один UPDATE на каждый адрес, место которого нашлось в базе. Возвращает
+    число обновлённых записей.
+    """
+    from .models import UserLoginHistory
+
+    missing = UserLoginHistory.objects.filter(location='', ip_address__isnull=False)
+    ips = list(missing.order_by().values_list('ip_address', flat=True).distinct())
+    updated = 0
+    for ip in ips:
+        location = locate(ip)
+        if location:
+            updated += missing.filter(ip_address=ip).update(location=location)
+    return updated
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.retention import apply_retention
+
+
+class Command(BaseCommand):
+    help = "Удаляет старые строки журналов пользователей по политикам хранения (RETENTION_POLICIES)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'labels', nargs='*',
+            help="Модели (app_label.Model); по умолчанию — все, для которых есть политика",
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=5000,
+            help="Сколько id удалять за одну транзакцию",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            results = apply_retention(options['labels'], chunk_size=options['chunk_size'])
+        except LookupError as e:
+            raise CommandError(e)
+        for label, (deleted, rolled_up) in results.items():
+            self.stdout.write(self.style.SUCCESS(
+                f"{label}: удалено строк: {deleted}, свёрнуто в дневные итоги: {rolled_up}"
+            ))
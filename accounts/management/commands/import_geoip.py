@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.geoip import backfill_locations, build_database, database_path
+
+
+class Command(BaseCommand):
+    help = (
+        "Собирает базу GeoIP (settings.GEOIP_DATABASE_PATH) из CSV DB-IP \"IP to City Lite\" "
+        "(https://db-ip.com/db/download/ip-to-city-lite)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'source', nargs='?',
+            help="Файл dbip-city-lite-ГГГГ-ММ.csv или .csv.gz; без него с --backfill используется текущая база",
+        )
+        parser.add_argument(
+            '--output', default=None,
+            help="Куда записать базу; по умолчанию settings.GEOIP_DATABASE_PATH",
+        )
+        parser.add_argument(
+            '--backfill', action='store_true',
+            help="Заполнить местоположение у записей истории входов, сохранённых без него",
+        )
+
+    def handle(self, *args, **options):
+        if not options['source'] and not options['backfill']:
+            raise CommandError("Укажите файл CSV или --backfill")
+        if options['backfill'] and options['output']:
+            # Места ищутся в базе, которую читает сайт
+            raise CommandError("--backfill использует settings.GEOIP_DATABASE_PATH, а не --output")
+        if options['source']:
+            target = options['output'] or database_path()
+            if not target:
+                raise CommandError("Не задан settings.GEOIP_DATABASE_PATH")
+            try:
+                count = build_database(options['source'], target)
+            except OSError as e:
+                raise CommandError(e)
+            self.stdout.write(self.style.SUCCESS(f"База GeoIP собрана ({count} диапазонов): {target}"))
+        if options['backfill']:
+            updated = backfill_locations()
+            self.stdout.write(self.style.SUCCESS(f"Местоположение заполнено у записей: {updated}"))
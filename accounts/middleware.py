@@ -1,35 +1,25 @@
 # accounts/middleware.py
-from django.conf import settings
 from django.utils import timezone
-from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
-import logging
 
-from accounts.models import Profile
-
-logger = logging.getLogger(__name__)
+from accounts.activity import activity_tracker
+from accounts.timezones import UserTimezone, user_timezone_name
 
 class TimezoneMiddleware:
+    """
+    Активирует часовой пояс пользователя лениво: пояс определяется (кеш,
+    сессия, в крайнем случае Profile) только при первом форматировании даты,
+    см. accounts/timezones.py.
+    """
     def __init__(self, get_response):
         self.get_response = get_response
 
     def __call__(self, request):
-        if request.user.is_authenticated:
-            try:
-                profile = request.user.profile
-                if profile.time_zone:
-                    timezone.activate(ZoneInfo(profile.time_zone))
-                else:
-                    timezone.deactivate()
-            except (Profile.DoesNotExist, AttributeError, ZoneInfoNotFoundError) as e:
-                timezone.deactivate()
-                logger.warning(f"Timezone error for user {request.user}: {e}")
-            except ZoneInfoNotFoundError:
-                timezone.activate(settings.TIME_ZONE)
-        else:
+        timezone.activate(UserTimezone(lambda: user_timezone_name(request)))
+        try:
+            return self.get_response(request)
+        finally:
             timezone.deactivate()
 
-        return self.get_response(request)
-
 class LastActivityMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
@@ -38,9 +28,7 @@ class LastActivityMiddleware:
         response = self.get_response(request)
 
         if request.user.is_authenticated:
-            # Оптимизированный запрос без загрузки объекта
-            Profile.objects.filter(user=request.user).update(
-                last_activity=timezone.now()
-            )
+            # Запись в БД — пачками раз в LAST_ACTIVITY_FLUSH_INTERVAL (accounts/activity.py)
+            activity_tracker.touch(request.user.pk)
 
         return response
\ No newline at end of file
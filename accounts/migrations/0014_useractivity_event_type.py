@@ -0,0 +1,106 @@
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Value
+from django.db.models.functions import Concat
+
+PRODUCT_VIEW = 1
+PRODUCT_VIEW_TYPE = 'Просмотр товара'
+OTHER_TYPE = 'Другое'
+PRODUCT_VIEW_PREFIX = 'Просмотрел товар: '
+
+
+def convert_activity(apps, schema_editor):
+    """
+    Текстовые события -> ActivityType и ссылка на товар (по названию из
+    описания). Описание, которое не свелось к товару, сохраняется в
+    legacy_description.
+    """
+    UserActivity = apps.get_model('accounts', 'UserActivity')
+    Product = apps.get_model('products', 'Product')
+    views = UserActivity.objects.filter(legacy_activity_type=PRODUCT_VIEW_TYPE)
+    views.update(activity_type=PRODUCT_VIEW)
+    names = {
+        description[len(PRODUCT_VIEW_PREFIX):]
+        for description in views.values_list('description', flat=True).distinct()
+        if description.startswith(PRODUCT_VIEW_PREFIX)
+    }
+    for name, product_id in Product.objects.filter(name__in=names).values_list('name', 'pk'):
+        views.filter(description=PRODUCT_VIEW_PREFIX + name).update(product_id=product_id)
+    UserActivity.objects.filter(product__isnull=True).update(legacy_description=F('description'))
+
+
+def restore_activity(apps, schema_editor):
+    """Обратно: тип — по ActivityType, текст — из legacy_description или названия товара."""
+    UserActivity = apps.get_model('accounts', 'UserActivity')
+    Product = apps.get_model('products', 'Product')
+    UserActivity.objects.filter(activity_type=PRODUCT_VIEW).update(legacy_activity_type=PRODUCT_VIEW_TYPE)
+    UserActivity.objects.exclude(activity_type=PRODUCT_VIEW).update(legacy_activity_type=OTHER_TYPE)
+    UserActivity.objects.filter(legacy_description__isnull=False).update(description=F('legacy_description'))
+    UserActivity.objects.filter(legacy_description__isnull=True, product__isnull=False).update(
+        description=Concat(
+            Value(PRODUCT_VIEW_PREFIX),
+            Subquery(Product.objects.filter(pk=OuterRef('product_id')).values('name')[:1]),
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0013_alter_adminsettings_site_timezone_and_more'),
+        ('products', '0028_orderstatusevent'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='useractivity',
+            old_name='activity_type',
+            new_name='legacy_activity_type',
+        ),
+        migrations.AddField(
+            model_name='useractivity',
+            name='activity_type',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'Другое'), (1, 'Просмотр товара')], default=0),
+        ),
+        migrations.AddField(
+            model_name='useractivity',
+            name='product',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='products.product'),
+        ),
+        migrations.AddField(
+            model_name='useractivity',
+            name='legacy_description',
+            field=models.TextField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(convert_activity, restore_activity),
+        # Значения по умолчанию нужны только обратной миграции: поля
+        # добавляются заново до restore_activity()
+        migrations.AlterField(
+            model_name='useractivity',
+            name='legacy_activity_type',
+            field=models.CharField(default='', max_length=50),
+        ),
+        migrations.AlterField(
+            model_name='useractivity',
+            name='description',
+            field=models.TextField(default=''),
+        ),
+        migrations.RemoveField(
+            model_name='useractivity',
+            name='legacy_activity_type',
+        ),
+        migrations.RemoveField(
+            model_name='useractivity',
+            name='description',
+        ),
+        migrations.AlterField(
+            model_name='useractivity',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='useractivity',
+            index=models.Index(fields=['user', '-timestamp'], name='useractivity_user_time_idx'),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0015_dailyactivityrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userloginhistory',
+            name='location',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
@@ -33,20 +33,34 @@ def user_directory_path(instance, filename):
 # -----------------------------------------------------------------------
 # Пример кастомного QuerySet и Manager для Profile
 # -----------------------------------------------------------------------
+def online_q(prefix=''):
+    """
+    Условие "онлайн" для Profile (prefix='') или связанной модели
+    (prefix='profile__'): по БД и по отметкам, ещё не записанным трекером
+    активности (accounts/activity.py).
+    """
+    from .activity import activity_tracker
+
+    since = timezone.now() - Profile.ONLINE_THRESHOLD
+    condition = models.Q(**{f'{prefix}last_activity__gte': since})
+    recent = activity_tracker.recent_user_ids(since)
+    if recent:
+        condition |= models.Q(**{f'{prefix}user_id__in': recent})
+    return condition
+
+
 class ProfileQuerySet(models.QuerySet):
     def online(self):
         """
         Возвращает queryset с профилями, которые считаются "онлайн".
         """
-        now = timezone.now()
-        return self.filter(last_activity__gte=now - Profile.ONLINE_THRESHOLD)
+        return self.filter(online_q())
 
     def offline(self):
         """
         Возвращает queryset с профилями, которые считаются "оффлайн".
         """
-        now = timezone.now()
-        return self.filter(last_activity__lt=now - Profile.ONLINE_THRESHOLD)
+        return self.exclude(online_q())
 
 
 class ProfileManager(models.Manager):
@@ -132,12 +146,19 @@ class Profile(models.Model):
         except Exception as e:
             logger.error(f"Ошибка при обработке аватара: {e}", exc_info=True)
 
+    @property
+    def last_seen(self):
+        """last_activity с учётом отметок, ещё не записанных в БД."""
+        from .activity import activity_tracker
+
+        return activity_tracker.last_seen(self.user_id, self.last_activity)
+
     def is_online(self):
         """
         Локальный метод проверки "онлайн" — можно вызвать в шаблоне: profile.is_online()
         Или использовать менеджер: Profile.objects.online()
         """
-        return timezone.now() - self.last_activity <= self.ONLINE_THRESHOLD
+        return timezone.now() - self.last_seen <= self.ONLINE_THRESHOLD
 
 
 # -----------------------------------------------------------------------
@@ -247,7 +268,7 @@ class UserActivityQuerySet(models.QuerySet):
 class UserActivityManager(models.Manager):
     def get_queryset(self):
         # Можно использовать select_related, если нужно
-        return UserActivityQuerySet(self.model, using=self._db).select_related('user')
+        return UserActivityQuerySet(self.model, using=self._db).select_related('user', 'product')
 
     def recent_for_user(self, user, limit=10):
         """
@@ -256,16 +277,72 @@ class UserActivityManager(models.Manager):
         return self.get_queryset().recent(user, limit=limit)
 
 
+class ActivityType(models.IntegerChoices):
+    OTHER = 0, 'Другое'
+    PRODUCT_VIEW = 1, 'Просмотр товара'
+
+
 class UserActivity(models.Model):
+    """
+    Событие активности пользователя. Записывается не напрямую, а через
+    буфер accounts.events.activity_events (пачками, вне пути запроса).
+    """
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="activities")
-    activity_type = models.CharField(max_length=50)
-    description = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    activity_type = models.PositiveSmallIntegerField(choices=ActivityType.choices, default=ActivityType.OTHER)
+    product = models.ForeignKey(
+        'products.Product',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+',
+    )
+    # Текст события из прежнего формата, которое не удалось свести к товару (миграция 0014)
+    legacy_description = models.TextField(null=True, blank=True, editable=False)
+    # Время события, а не записи пачки в БД
+    timestamp = models.DateTimeField(default=timezone.now)
 
     objects = UserActivityManager()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', '-timestamp'], name='useractivity_user_time_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} - {self.get_activity_type_display()} at {self.timestamp}"
+
+    @property
+    def description(self):
+        if self.activity_type == ActivityType.PRODUCT_VIEW and self.product:
+            return f'Просмотрел товар: {self.product.name}'
+        return self.legacy_description or self.get_activity_type_display()
+
+
+class DailyActivityRollup(models.Model):
+    """
+    Число событий пользователя за день — то, что остаётся от строк
+    UserActivity и UserLoginHistory после срока хранения (accounts/retention.py).
+    """
+    SOURCE_CHOICES = [
+        ('activity', 'Активность'),
+        ('login', 'Входы'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="activity_rollups")
+    day = models.DateField()
+    source = models.CharField(max_length=10, choices=SOURCE_CHOICES)
+    activity_type = models.PositiveSmallIntegerField(choices=ActivityType.choices, default=ActivityType.OTHER)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'day', 'source', 'activity_type'], name='unique_daily_activity_rollup',
+            ),
+        ]
+
     def __str__(self):
-        return f"{self.user.username} - {self.activity_type} at {self.timestamp}"
+        return f"{self.user_id} {self.day} {self.source}: {self.count}"
 
 
 # -----------------------------------------------------------------------
@@ -329,6 +406,8 @@ class UserLoginHistory(models.Model):
     user_agent = models.CharField(max_length=512, blank=True)
     session_key = models.CharField(max_length=128, blank=True)
     login_datetime = models.DateTimeField(auto_now_add=True)
+    # Определяется при входе по локальной базе GeoIP (accounts/geoip.py)
+    location = models.CharField(max_length=255, blank=True)
 
     objects = UserLoginHistoryManager()
 
@@ -0,0 +1,157 @@
+# accounts/retention.py
+"""
+Срок хранения журналов пользователей (UserActivity, UserLoginHistory).
+
+Для каждой таблицы действует политика: поле даты, сколько дней хранить
+строки и сворачивать ли старые строки в дневные итоги DailyActivityRollup
+(по пользователю, дню и типу события). Политики по умолчанию — в
+DEFAULT_POLICIES, переопределяются settings.RETENTION_POLICIES
+({'accounts.UserActivity': {'days': 90}, ...}).
+
+apply_policy() проходит старые строки пачками по диапазонам id (id растут
+вместе со временем): в каждой пачке один агрегат для итогов, один
+прибавляющий upsert итогов и один DELETE — каждая транзакция короткая и не
+держит блокировку на всю таблицу. Запускается командой apply_retention.
+"""
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import Count, F, Max, Min
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import DailyActivityRollup
+
+DEFAULT_POLICIES = {
+    'accounts.UserActivity': {
+        'date_field': 'timestamp', 'days': 180, 'rollup': True,
+        'source': 'activity', 'type_field': 'activity_type',
+    },
+    'accounts.UserLoginHistory': {
+        'date_field': 'login_datetime', 'days': 365, 'rollup': True,
+        'source': 'login', 'type_field': None,
+    },
+}
+
+
+class RetentionPolicy:
+    __slots__ = ('label', 'date_field', 'days', 'rollup', 'source', 'type_field')
+
+    def __init__(self, label, date_field, days, rollup=False, source=None, type_field=None):
+        self.label = label
+        self.date_field = date_field
+        self.days = days
+        self.rollup = rollup and source is not None
+        self.source = source
+        self.type_field = type_field
+
+    @property
+    def model(self):
+        return apps.get_model(self.label)
+
+    def cutoff(self, now=None):
+        return (now or timezone.now()) - timedelta(days=self.days)
+
+    def __repr__(self):
+        return f'<RetentionPolicy {self.label} {self.days}d>'
+
+
+def retention_policies():
+    """Действующие политики: DEFAULT_POLICIES с поправками из settings."""
+    overrides = getattr(settings, 'RETENTION_POLICIES', {})
+    policies = []
+    for label in {**DEFAULT_POLICIES, **overrides}:
+        options = {**DEFAULT_POLICIES.get(label, {}), **overrides.get(label, {})}
+        policies.append(RetentionPolicy(label, **options))
+    return policies
+
+
+def get_policy(label):
+    for policy in retention_policies():
+        if policy.label.lower() == label.lower():
+            return policy
+    raise LookupError(f"Нет политики хранения для {label}")
+
+
+def add_to_rollups(source, counts):
+    """
+    Прибавляет counts {(user_id, day, activity_type): n} к дневным итогам.
+    Прибавление делает сама БД (INSERT ... ON CONFLICT DO UPDATE SET
+    count = count + excluded.count), поэтому параллельные запуски не
+    теряют итоги друг друга.
+    """
+    if not counts:
+        return
+    connection = connections[router.db_for_write(DailyActivityRollup)]
+    if connection.vendor not in ('sqlite', 'postgresql'):
+        # Без ON CONFLICT: строка создаётся или увеличивается выражением F()
+        for (user_id, day, activity_type), count in counts.items():
+            rollup, created = DailyActivityRollup.objects.get_or_create(
+                user_id=user_id, day=day, source=source, activity_type=activity_type,
+                defaults={'count': count},
+            )
+            if not created:
+                DailyActivityRollup.objects.filter(pk=rollup.pk).update(count=F('count') + count)
+        return
+
+    rows = [
+        (user_id, connection.ops.adapt_datefield_value(day), source, activity_type, count)
+        for (user_id, day, activity_type), count in counts.items()
+    ]
+    qn = connection.ops.quote_name
+    table = qn(DailyActivityRollup._meta.db_table)
+    columns = ['user_id', 'day', 'source', 'activity_type', 'count']
+    batch = connection.ops.bulk_batch_size(columns, rows) or len(rows)
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), batch):
+            chunk = rows[start:start + batch]
+            placeholders = ', '.join(['(%s, %s, %s, %s, %s)'] * len(chunk))
+            cursor.execute(
+                f"INSERT INTO {table} ({', '.join(qn(c) for c in columns)}) VALUES {placeholders} "
+                f"ON CONFLICT ({', '.join(qn(c) for c in columns[:4])}) "
+                f"DO UPDATE SET {qn('count')} = {table}.{qn('count')} + excluded.{qn('count')}",
+                [value for row in chunk for value in row],
+            )
+
+
+def apply_policy(policy, chunk_size=5000, now=None):
+    """
+    Удаляет строки старше срока политики (сворачивая их в итоги, если
+    policy.rollup). Возвращает (удалено строк, строк свёрнуто в итоги).
+    """
+    model = policy.model
+    old = model._base_manager.filter(**{f'{policy.date_field}__lt': policy.cutoff(now)})
+    bounds = old.aggregate(first=Min('pk'), last=Max('pk'))
+    if bounds['last'] is None:
+        return 0, 0
+
+    deleted = rolled_up = 0
+    for start in range(bounds['first'], bounds['last'] + 1, chunk_size):
+        chunk = old.filter(pk__gte=start, pk__lt=min(start + chunk_size, bounds['last'] + 1))
+        with transaction.atomic():
+            if policy.rollup:
+                group = ['user_id', 'day'] + ([policy.type_field] if policy.type_field else [])
+                rows = (
+                    chunk.order_by()
+                    .annotate(day=TruncDate(policy.date_field))
+                    .values(*group)
+                    .annotate(n=Count('pk'))
+                )
+                counts = {
+                    (row['user_id'], row['day'], row[policy.type_field] if policy.type_field else 0): row['n']
+                    for row in rows
+                }
+                add_to_rollups(policy.source, counts)
+                rolled_up += sum(counts.values())
+            # На журналы никто не ссылается, так что это один DELETE без выборки
+            count, _ = chunk.delete()
+            deleted += count
+    return deleted, rolled_up
+
+
+def apply_retention(labels=None, chunk_size=5000, now=None):
+    """Применяет политики (все или для labels). Возвращает {label: (удалено, свёрнуто)}."""
+    policies = retention_policies() if not labels else [get_policy(label) for label in labels]
+    return {policy.label: apply_policy(policy, chunk_size=chunk_size, now=now) for policy in policies}
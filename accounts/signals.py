@@ -4,6 +4,8 @@ from django.dispatch import receiver
 from django.contrib.auth.signals import user_logged_in
 from django.core.exceptions import ObjectDoesNotExist
 from .models import Profile, UserLoginHistory
+from .geoip import locate
+from .timezones import remember_timezone
 from .utils import get_client_ip
 import logging
 
@@ -34,11 +36,25 @@ def save_user_profile(sender, instance, **kwargs):
 def log_user_login(sender, request, user, **kwargs):
     """Логирование успешного входа в систему"""
     try:
+        ip = get_client_ip(request)
         UserLoginHistory.objects.create(
             user=user,
-            ip_address=get_client_ip(request),
+            ip_address=ip,
+            location=locate(ip),
             user_agent=request.META.get('HTTP_USER_AGENT', '')[:512],
             session_key=request.session.session_key or ''
         )
     except Exception as e:
-        logger.error(f"Ошибка логирования входа: {e}", exc_info=True)
\ No newline at end of file
+        logger.error(f"Ошибка логирования входа: {e}", exc_info=True)
+
+@receiver(post_save, sender=Profile)
+def update_cached_timezone(sender, instance, raw=False, **kwargs):
+    """Новый часовой пояс сразу виден во всех сессиях пользователя"""
+    if not raw:
+        remember_timezone(instance.user_id, instance.time_zone)
+
+@receiver(user_logged_in)
+def remember_user_timezone(sender, request, user, **kwargs):
+    profile = getattr(user, 'profile', None)
+    if request is not None and profile is not None:
+        remember_timezone(user.pk, profile.time_zone, request.session)
@@ -1,16 +1,35 @@
 # accounts/tests/test_admin.py
 
-from unittest.mock import patch, MagicMock
+import os
+import tempfile
+from contextlib import contextmanager
+from io import StringIO
+from unittest import mock
 
 from django.contrib.admin.sites import site
 from django.contrib.auth import get_user_model
-from django.test import TestCase, Client
+from django.contrib.auth.signals import user_logged_in
+from django.contrib.sessions.backends.cache import SessionStore
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client, RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 
+from accounts.activity import activity_tracker
 from accounts.admin import CustomUserAdmin
+from accounts.events import ActivityEventBuffer, activity_events
+from accounts.geoip import geoip_database, locate
+from accounts.retention import add_to_rollups, apply_retention
+from accounts.middleware import TimezoneMiddleware
+from accounts.timezones import TIMEZONE_SESSION_KEY
 from accounts.models import (
+    ActivityType,
+    DailyActivityRollup,
     Profile,
+    UserActivity,
     UserLoginHistory,
     AdminSettings,
 )
@@ -18,6 +37,24 @@ from products.models import Order, OrderItem, Product, Category, Review, Wishlis
 
 User = get_user_model()
 
+GEOIP_ROWS = [
+    "8.8.8.0,8.8.8.255,NA,US,California,Mountain View,37.386,-122.0838",
+    "2a02:2f0e::,2a02:2f0e:ffff:ffff:ffff:ffff:ffff:ffff,EU,MD,Chisinau,Chisinau,47.0105,28.8638",
+    "5.32.0.0,5.32.255.255,EU,MD,Balti,Balti,47.7617,27.9289",
+]
+
+
+@contextmanager
+def geoip_database_file(rows):
+    """Временная база GeoIP, собранная командой import_geoip из CSV-строк rows."""
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, 'dbip-city-lite.csv')
+        with open(source, 'w', encoding='utf-8') as f:
+            f.write("\n".join(rows))
+        path = os.path.join(directory, 'geoip.dat')
+        call_command('import_geoip', source, output=path, stdout=StringIO())
+        yield path
+
 
 class CustomUserAdminTests(TestCase):
     """Тесты для кастомного UserAdmin (CustomUserAdmin)."""
@@ -57,6 +94,8 @@ class CustomUserAdminTests(TestCase):
 
     def setUp(self):
         """Подключаем клиент и логинимся под суперпользователем, чтобы иметь доступ в админку."""
+        cache.clear()
+        activity_tracker.clear()
         self.client = Client()
         self.client.login(username="admin", password="adminpass")
 
@@ -151,11 +190,10 @@ class CustomUserAdminTests(TestCase):
         self.assertContains(response, "IP:")
         self.assertContains(response, "Last Login:")
 
-    @patch("accounts.admin.Nominatim")
-    def test_location_display(self, mock_nominatim):
+    def test_location_display(self):
         """
-        Проверяем, что location_display корректно возвращает "Localhost", "Private IP" или "Location not found".
-        Для внешних IP-адресов используем mock, чтобы не вызывать реальный сервис.
+        Проверяем, что location_display возвращает "Localhost", "Private IP",
+        место из локальной базы GeoIP или "Location not found" — без сетевых запросов.
         """
         history = UserLoginHistory.objects.create(
             user=self.user,
@@ -175,25 +213,18 @@ class CustomUserAdminTests(TestCase):
         response = self.client.get(url)
         self.assertContains(response, "Private IP")
 
-        # Меняем IP на внешний
+        # Меняем IP на внешний — место берётся из локальной базы
         history.ip_address = "8.8.8.8"
         history.save()
+        with geoip_database_file(GEOIP_ROWS) as path, self.settings(GEOIP_DATABASE_PATH=path):
+            response = self.client.get(url)
+            self.assertContains(response, "Mountain View, US (37.386, -122.0838)")
 
-        # Настраиваем mock-ответ от geocode
-        instance = mock_nominatim.return_value
-        instance.geocode.return_value = MagicMock(latitude=55.7558, longitude=37.6176)
-
-        response = self.client.get(url)
-        self.assertContains(response, "55.7558, 37.6176")
-
-        # Проверим ситуацию, когда geocode вернул None => Location not found
-        instance.geocode.return_value = None
-        # Нужно очистить кэш или изменить IP, чтобы повторно вызвать geocoder
-        history.ip_address = "8.8.4.4"
-        history.save()
-
-        response = self.client.get(url)
-        self.assertContains(response, "Location not found")
+            # IP, которого нет в базе => Location not found
+            history.ip_address = "8.8.4.4"
+            history.save()
+            response = self.client.get(url)
+            self.assertContains(response, "Location not found")
 
     def test_custom_url_preview_homepage(self):
         """
@@ -207,6 +238,269 @@ class CustomUserAdminTests(TestCase):
         self.assertIn("/", response.url)
 
 
+@override_settings(LAST_ACTIVITY_GRANULARITY=30, LAST_ACTIVITY_FLUSH_INTERVAL=3600)
+class LastActivityTests(TestCase):
+    """Тесты буфера последней активности."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [
+            User.objects.create_user(username=f"visitor{i}", password="12345") for i in range(3)
+        ]
+
+    def setUp(self):
+        cache.clear()
+        activity_tracker.clear()
+        stale = timezone.now() - timezone.timedelta(hours=1)
+        Profile.objects.update(last_activity=stale)
+
+    def test_requests_do_not_write_profile(self):
+        self.client.force_login(self.users[0])
+        self.client.get(reverse("products:home"))
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(reverse("products:home"))
+        self.assertFalse([q for q in context.captured_queries if 'UPDATE "accounts_profile"' in q['sql']])
+        self.assertEqual(activity_tracker.pending(), 1)
+
+    def test_touch_coalesced_within_granularity(self):
+        now = timezone.now()
+        self.assertTrue(activity_tracker.touch(self.users[0].pk, now))
+        self.assertFalse(activity_tracker.touch(self.users[0].pk, now + timezone.timedelta(seconds=10)))
+        self.assertTrue(activity_tracker.touch(self.users[0].pk, now + timezone.timedelta(seconds=31)))
+
+    def test_flush_writes_one_update(self):
+        now = timezone.now()
+        for user in self.users:
+            activity_tracker.touch(user.pk, now)
+        with self.assertNumQueries(1):
+            self.assertEqual(activity_tracker.flush(), 3)
+        self.assertEqual(Profile.objects.filter(last_activity=now).count(), 3)
+        self.assertEqual(activity_tracker.pending(), 0)
+
+    @override_settings(LAST_ACTIVITY_BATCH_SIZE=1)
+    def test_full_buffer_is_flushed_outside_request(self):
+        with mock.patch.object(activity_tracker, '_ensure_thread'), self.assertNumQueries(0):
+            self.assertTrue(activity_tracker.touch(self.users[0].pk))
+        self.assertTrue(activity_tracker._wakeup.is_set())
+        activity_tracker._wakeup.clear()
+        self.assertEqual(activity_tracker.pending(), 1)
+
+    def test_online_reads_through_buffer(self):
+        activity_tracker.touch(self.users[1].pk)
+        profile = Profile.objects.get(user=self.users[1])
+        self.assertTrue(profile.is_online())
+        self.assertEqual(list(Profile.objects.online().values_list('user', flat=True)), [self.users[1].pk])
+        self.assertNotIn(self.users[1].pk, Profile.objects.offline().values_list('user', flat=True))
+
+
+class TimezoneMiddlewareTests(TestCase):
+    """Тесты ленивой активации часового пояса."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="traveller", password="12345")
+        Profile.objects.filter(user=cls.user).update(time_zone="Europe/Chisinau")
+
+    def setUp(self):
+        cache.clear()
+
+    def run_middleware(self, view):
+        request = RequestFactory().get("/")
+        request.user = self.user
+        request.session = SessionStore()
+        seen = {}
+
+        def get_response(request):
+            seen['result'] = view()
+            return None
+
+        TimezoneMiddleware(get_response)(request)
+        return request, seen['result']
+
+    def test_no_work_without_datetime_formatting(self):
+        with self.assertNumQueries(0):
+            self.run_middleware(lambda: None)
+        self.assertIsNone(cache.get(f"user_timezone:{self.user.pk}"))
+
+    def test_zone_resolved_once_then_cached(self):
+        with self.assertNumQueries(1):
+            request, name = self.run_middleware(timezone.get_current_timezone_name)
+        self.assertEqual(name, "Europe/Chisinau")
+        self.assertEqual(request.session[TIMEZONE_SESSION_KEY][0], "Europe/Chisinau")
+        with self.assertNumQueries(0):
+            _, name = self.run_middleware(timezone.get_current_timezone_name)
+        self.assertEqual(name, "Europe/Chisinau")
+
+    def test_profile_change_invalidates_cached_zone(self):
+        self.run_middleware(timezone.get_current_timezone_name)
+        profile = Profile.objects.get(user=self.user)
+        profile.time_zone = "Asia/Tokyo"
+        profile.save()
+        _, local = self.run_middleware(lambda: timezone.localtime(timezone.now()))
+        self.assertEqual(local.utcoffset(), timezone.timedelta(hours=9))
+
+    @override_settings(USER_TIMEZONE_CACHE_TIMEOUT=60)
+    def test_change_from_another_process_seen_after_timeout(self):
+        request, _ = self.run_middleware(timezone.get_current_timezone_name)
+        # Другой процесс меняет пояс: до этого кеша и сессии сигнал не доходит
+        Profile.objects.filter(user=self.user).update(time_zone="Asia/Tokyo")
+        _, name = self.run_middleware(timezone.get_current_timezone_name)
+        self.assertEqual(name, "Europe/Chisinau")
+        stored_at = request.session[TIMEZONE_SESSION_KEY][1]
+        with mock.patch('accounts.timezones.time.time', return_value=stored_at + 61):
+            _, name = self.run_middleware(timezone.get_current_timezone_name)
+        self.assertEqual(name, "Asia/Tokyo")
+
+
+@override_settings(USER_ACTIVITY_FLUSH_INTERVAL=None, USER_ACTIVITY_BATCH_SIZE=3)
+class ActivityEventTests(TestCase):
+    """Тесты буфера событий активности."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="viewer", password="12345")
+        category = Category.objects.create(name="Книги")
+        cls.product = Product.objects.create(
+            name="Словарь", price=50, category=category, description="", image="products/sample.jpg",
+        )
+
+    def setUp(self):
+        activity_events.flush()
+
+    def test_product_view_is_buffered(self):
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(reverse("products:product_detail", args=[self.product.pk]))
+        self.assertFalse([q for q in context.captured_queries if 'INSERT INTO "accounts_useractivity"' in q['sql']])
+        self.assertEqual(activity_events.pending(), 1)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(activity_events.flush(), 1)
+        activity = UserActivity.objects.get(user=self.user)
+        self.assertEqual((activity.activity_type, activity.product), (ActivityType.PRODUCT_VIEW, self.product))
+        self.assertEqual(activity.description, "Просмотрел товар: Словарь")
+
+    def test_full_batch_flushes_inline(self):
+        for _ in range(3):
+            activity_events.record(self.user.pk, ActivityType.PRODUCT_VIEW, self.product.pk)
+        self.assertEqual(activity_events.pending(), 0)
+        self.assertEqual(UserActivity.objects.filter(user=self.user).count(), 3)
+
+    @override_settings(USER_ACTIVITY_BUFFER_SIZE=2, USER_ACTIVITY_BATCH_SIZE=10)
+    def test_ring_buffer_drops_oldest(self):
+        buffer = ActivityEventBuffer()
+        for activity_type in (ActivityType.OTHER, ActivityType.PRODUCT_VIEW, ActivityType.PRODUCT_VIEW):
+            buffer.record(self.user.pk, activity_type)
+        with self.assertLogs('products.buffering', 'WARNING'):
+            self.assertEqual(buffer.flush(), 2)
+        self.assertFalse(UserActivity.objects.filter(activity_type=ActivityType.OTHER).exists())
+
+    def test_description_falls_back_to_legacy_text(self):
+        legacy = UserActivity(
+            user=self.user, activity_type=ActivityType.PRODUCT_VIEW,
+            legacy_description="Просмотрел товар: Удалённый товар",
+        )
+        self.assertEqual(legacy.description, "Просмотрел товар: Удалённый товар")
+        self.assertEqual(UserActivity(user=self.user).description, "Другое")
+
+
+class RetentionTests(TestCase):
+    """Тесты срока хранения журналов и дневных итогов."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="veteran", password="12345")
+
+    def test_old_activity_deleted_in_chunks_and_rolled_up(self):
+        now = timezone.now()
+        days = [now - timezone.timedelta(days=200), now - timezone.timedelta(days=201)]
+        UserActivity.objects.bulk_create(
+            [UserActivity(user=self.user, activity_type=ActivityType.PRODUCT_VIEW, timestamp=days[0]) for _ in range(3)]
+            + [UserActivity(user=self.user, activity_type=ActivityType.PRODUCT_VIEW, timestamp=days[1]) for _ in range(2)]
+            + [UserActivity(user=self.user, activity_type=ActivityType.PRODUCT_VIEW, timestamp=now)]
+        )
+        with CaptureQueriesContext(connection) as context:
+            result = apply_retention(['accounts.UserActivity'], chunk_size=2, now=now)
+        self.assertEqual(result, {'accounts.UserActivity': (5, 5)})
+        deletes = [q for q in context.captured_queries if q['sql'].startswith('DELETE')]
+        self.assertEqual(len(deletes), 3)
+        self.assertEqual(UserActivity.objects.count(), 1)
+        self.assertEqual(
+            sorted(DailyActivityRollup.objects.filter(user=self.user).values_list('day', 'source', 'count')),
+            sorted([(days[0].date(), 'activity', 3), (days[1].date(), 'activity', 2)]),
+        )
+
+    def test_rollups_incremented_in_database(self):
+        day = timezone.now().date()
+        DailyActivityRollup.objects.create(user=self.user, day=day, source='activity', activity_type=1, count=5)
+        with self.assertNumQueries(1):
+            add_to_rollups('activity', {(self.user.pk, day, 1): 3, (self.user.pk, day, 0): 2})
+        self.assertEqual(
+            sorted(DailyActivityRollup.objects.values_list('activity_type', 'count')), [(0, 2), (1, 8)],
+        )
+
+    @override_settings(RETENTION_POLICIES={'accounts.UserLoginHistory': {'days': 30, 'rollup': False}})
+    def test_policy_overrides_and_command(self):
+        login = UserLoginHistory.objects.create(user=self.user, ip_address="10.0.0.1")
+        UserLoginHistory.objects.filter(pk=login.pk).update(
+            login_datetime=timezone.now() - timezone.timedelta(days=31)
+        )
+        UserLoginHistory.objects.create(user=self.user, ip_address="10.0.0.2")
+        out = StringIO()
+        call_command('apply_retention', 'accounts.UserLoginHistory', stdout=out)
+        self.assertIn("удалено строк: 1", out.getvalue())
+        self.assertEqual(list(UserLoginHistory.objects.values_list('ip_address', flat=True)), ["10.0.0.2"])
+        self.assertFalse(DailyActivityRollup.objects.exists())
+
+
+class GeoIPTests(TestCase):
+    """Тесты локальной базы GeoIP."""
+
+    def test_lookup_by_range(self):
+        with geoip_database_file(GEOIP_ROWS) as path, self.settings(GEOIP_DATABASE_PATH=path):
+            self.assertEqual(str(geoip_database.lookup("8.8.8.255")), "Mountain View, US (37.386, -122.0838)")
+            self.assertEqual(geoip_database.lookup("8.8.9.0"), None)
+            self.assertEqual(str(geoip_database.lookup("2a02:2f0e::1")), "Chisinau, MD (47.0105, 28.8638)")
+            self.assertEqual(str(geoip_database.lookup("5.32.0.0")), "Balti, MD (47.7617, 27.9289)")
+            self.assertEqual(geoip_database.lookup("2a02:2f0d::1"), None)
+            self.assertEqual(locate("10.1.2.3"), "Private IP")
+            self.assertEqual(locate("1.1.1.1"), "")
+
+    def test_missing_database(self):
+        with self.settings(GEOIP_DATABASE_PATH=os.path.join(tempfile.gettempdir(), "no-geoip.dat")):
+            self.assertEqual(geoip_database.lookup("8.8.8.8"), None)
+            self.assertEqual(locate("8.8.8.8"), "")
+
+    def test_location_stored_at_login(self):
+        user = User.objects.create_user(username="tourist", password="12345")
+        request = RequestFactory().post("/", REMOTE_ADDR="8.8.8.8")
+        request.session = SessionStore()
+        with geoip_database_file(GEOIP_ROWS) as path, self.settings(GEOIP_DATABASE_PATH=path):
+            user_logged_in.send(sender=User, request=request, user=user)
+        history = UserLoginHistory.objects.get(user=user)
+        self.assertEqual(history.location, "Mountain View, US (37.386, -122.0838)")
+
+        # Неизвестное место хранится пустым, подпись — только при показе
+        request = RequestFactory().post("/", REMOTE_ADDR="1.1.1.1")
+        request.session = SessionStore()
+        with geoip_database_file(GEOIP_ROWS) as path, self.settings(GEOIP_DATABASE_PATH=path):
+            user_logged_in.send(sender=User, request=request, user=user)
+        self.assertEqual(UserLoginHistory.objects.filter(user=user, location="").count(), 1)
+
+    def test_backfill_existing_history(self):
+        user = User.objects.create_user(username="regular", password="12345")
+        for ip in ("8.8.8.8", "8.8.8.8", "1.1.1.1", None):
+            UserLoginHistory.objects.create(user=user, ip_address=ip)
+        with geoip_database_file(GEOIP_ROWS) as path, self.settings(GEOIP_DATABASE_PATH=path):
+            out = StringIO()
+            call_command('import_geoip', backfill=True, stdout=out)
+        self.assertIn("записей: 2", out.getvalue())
+        self.assertEqual(
+            UserLoginHistory.objects.filter(location="Mountain View, US (37.386, -122.0838)").count(), 2,
+        )
+        self.assertEqual(UserLoginHistory.objects.filter(location="").count(), 2)
+
+
 class AdminSettingsAdminTests(TestCase):
     """Тесты для AdminSettingsAdmin (SingletonModel)."""
 
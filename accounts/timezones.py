@@ -0,0 +1,132 @@
+# accounts/timezones.py
+"""
+Часовой пояс пользователя без запроса к Profile на каждой странице.
+
+Название пояса берётся по порядку из кеша (user_timezone:<id>), из сессии
+и только затем из Profile. Кеш и сессия заполняются при входе, кеш — ещё и
+при каждом сохранении профиля (accounts/signals.py). Вместе с названием
+хранится время, когда оно было прочитано из Profile, и ни кеш, ни сессия
+не верят ему дольше settings.USER_TIMEZONE_CACHE_TIMEOUT секунд: процессы
+с собственным кешем (LocMemCache) и другие сессии пользователя увидят
+новый пояс не позже чем через этот срок. Объекты ZoneInfo берутся из LRU
+get_zone().
+
+TimezoneMiddleware активирует UserTimezone — tzinfo, который определяет
+пояс при первом обращении. Запросы, которые не форматируют дат, не делают
+ничего из перечисленного.
+"""
+import logging
+import time
+from datetime import tzinfo
+from functools import lru_cache
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+TIMEZONE_SESSION_KEY = '_user_timezone'
+
+
+def timezone_key(user_id):
+    return f'user_timezone:{user_id}'
+
+
+@lru_cache(maxsize=64)
+def get_zone(name):
+    """ZoneInfo по названию; None для пустого или неизвестного пояса."""
+    if not name:
+        return None
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError) as e:
+        logger.warning(f"Неизвестный часовой пояс {name!r}: {e}")
+        return None
+
+
+def timezone_timeout():
+    return getattr(settings, 'USER_TIMEZONE_CACHE_TIMEOUT', 5 * 60)
+
+
+def fresh_entry(entry):
+    """Запись [название, время чтения из Profile], если она ещё не устарела."""
+    if not isinstance(entry, (list, tuple)) or len(entry) != 2:
+        return None
+    name, stored_at = entry
+    if time.time() - stored_at >= timezone_timeout():
+        return None
+    return [name, stored_at]
+
+
+def remember_timezone(user_id, name, session=None, stored_at=None):
+    """
+    Запоминает пояс, прочитанный из Profile в момент stored_at (по умолчанию
+    — сейчас), в кеше до конца срока и в сессии.
+    """
+    entry = [name, time.time() if stored_at is None else stored_at]
+    remaining = timezone_timeout() - (time.time() - entry[1])
+    if remaining > 0:
+        cache.set(timezone_key(user_id), entry, max(int(remaining), 1))
+    if session is not None and session.get(TIMEZONE_SESSION_KEY) != entry:
+        session[TIMEZONE_SESSION_KEY] = entry
+
+
+def user_timezone_name(request):
+    """Название пояса текущего пользователя ('' — пояс по умолчанию)."""
+    from .models import Profile
+
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        return ''
+    session = getattr(request, 'session', None)
+    entry = fresh_entry(cache.get(timezone_key(user.pk)))
+    if entry is not None:
+        # Пояс мог смениться в другой сессии
+        if session is not None and session.get(TIMEZONE_SESSION_KEY) != entry:
+            session[TIMEZONE_SESSION_KEY] = entry
+        return entry[0]
+    if session is not None:
+        entry = fresh_entry(session.get(TIMEZONE_SESSION_KEY))
+    if entry is None:
+        name = Profile.objects.filter(user=user).values_list('time_zone', flat=True).first() or ''
+        entry = [name, None]
+    remember_timezone(user.pk, entry[0], session, entry[1])
+    return entry[0]
+
+
+class UserTimezone(tzinfo):
+    """Часовой пояс, определяемый функцией resolve() при первом использовании."""
+
+    def __init__(self, resolve):
+        self._resolve = resolve
+        self._zone = None
+
+    @property
+    def zone(self):
+        if self._zone is None:
+            self._zone = get_zone(self._resolve()) or timezone.get_default_timezone()
+        return self._zone
+
+    def utcoffset(self, dt):
+        return self.zone.utcoffset(dt)
+
+    def dst(self, dt):
+        return self.zone.dst(dt)
+
+    def tzname(self, dt):
+        return self.zone.tzname(dt)
+
+    def fromutc(self, dt):
+        return self.zone.fromutc(dt.replace(tzinfo=self.zone)).replace(tzinfo=self)
+
+    def __reduce__(self):
+        # В pickle попадает сам ZoneInfo, без resolve()
+        return self.zone.__reduce__()
+
+    def __str__(self):
+        return str(self.zone)
+
+    def __repr__(self):
+        return f'<UserTimezone {self.zone}>' if self._zone is not None else '<UserTimezone (lazy)>'
@@ -1,13 +1,8 @@
 # utils.py
-from django.core.cache import cache
-from ipware import get_client_ip
+from ipware import get_client_ip as ipware_client_ip
 
 
 def get_client_ip(request):
-    cache_key=f"client_ip_{request.session.session_key}"
-    ip=cache.get(cache_key)
-    if not ip:
-        ip, _ = get_client_ip(request)
-        cache.set(cache_key,ip,60*5)
-
-    return ip or ''
\ No newline at end of file
+    # ipware разбирает заголовки без обращений к сети — кешировать нечего
+    ip, _ = ipware_client_ip(request)
+    return ip or ''
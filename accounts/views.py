@@ -5,14 +5,14 @@ from django.contrib.auth import login, authenticate
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.auth.forms import AuthenticationForm
 from django.core.mail import send_mail
-from django.core.paginator import Paginator
 from django.shortcuts import redirect, render, get_object_or_404
 from django.utils.crypto import get_random_string
 
-from accounts.models import Address, NotificationSettings, Subscription, UserLoginHistory
+from accounts.models import Address, NotificationSettings, Subscription
 from products.models import Order, Wishlist, Product
+from products.orders import order_history_page
+from products.pagination import KeysetPaginator
 from .forms import UserRegisterForm, UserForm, ProfileForm, AddressForm, NotificationSettingsForm, SubscriptionForm
-from .utils import get_client_ip
 
 def is_owner(user, subscription_id):
     return Subscription.objects.filter(id=subscription_id, user=user).exists()
@@ -106,9 +106,7 @@ def order_history(request):
     """
     Представление для отображения истории заказов пользователя.
     """
-    orders = Order.objects.filter(user=request.user).prefetch_related(
-        'items__product__category'
-    ).order_by('-created_at')
+    orders = order_history_page(request.user, request.GET.get('cursor'))
     return render(request, 'accounts/order_history.html', {'orders': orders})
 
 @login_required
@@ -183,10 +181,10 @@ def notification_settings(request):
 
 @login_required
 def activity_history(request):
-    activities = request.user.activities.order_by('-timestamp')
-    paginator = Paginator(activities, 10)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    # Keyset-страница по индексу (user, -timestamp): без COUNT и OFFSET
+    activities = request.user.activities.select_related('product')
+    paginator = KeysetPaginator(activities, 10, ordering='-timestamp', fields=('timestamp',))
+    page_obj = paginator.page(request.GET.get('cursor'))
     return render(request, 'accounts/activity_history.html', {'page_obj': page_obj})
 
 @login_required
@@ -222,13 +220,8 @@ def login_view(request):
         password = request.POST.get('password')
         user = authenticate(request, username=username, password=password)
         if user is not None:
+            # Вход записывается в UserLoginHistory сигналом user_logged_in
             login(request, user)
-            UserLoginHistory.objects.create(
-                user=user,
-                ip_address=get_client_ip(request),
-                user_agent=request.META.get('HTTP_USER_AGENT', ''),
-                session_key=request.session.session_key
-            )
             return redirect('home')  # После успешного логина перенаправление
     else:
         form = AuthenticationForm()
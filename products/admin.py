@@ -1,12 +1,15 @@
 # admin.py
-from django.contrib import admin
-from django.db.models import Sum, F
+from django.contrib import admin, messages
 from django.urls import reverse
 from django.utils.html import format_html
 from django.utils.safestring import mark_safe
 from imagekit.admin import AdminThumbnail
 
-from .models import Product, Category, OrderItem, Order, StaticPage, SubCategory
+from .models import (
+    Product, Category, OrderItem, Order, StaticPage, SubCategory, SearchQueryLog, ExchangeRate,
+    OrderStatusEvent,
+)
+from .lifecycle import CANCELLED, DELIVERED, SHIPPED, InvalidTransitionError
 
 
 class SubCategoryInline(admin.TabularInline):
@@ -47,7 +50,7 @@ class ProductAdmin(admin.ModelAdmin):
         'is_featured', 'stock', 'created_at', 'image_tag'
     )
     list_editable = ('price', 'is_featured', 'stock')
-    list_filter = ('is_featured', 'category', 'created_at')
+    list_filter = ('is_featured', 'category', 'subcategory', 'created_at')
     search_fields = ('name', 'description')
     prepopulated_fields = {'slug': ('name',)}
     date_hierarchy = 'created_at'
@@ -58,7 +61,7 @@ class ProductAdmin(admin.ModelAdmin):
     readonly_fields = ('image_preview', 'price_with_currency')
     fieldsets = (
         (None, {
-            'fields': (('name', 'slug'), 'category', 'description')
+            'fields': (('name', 'slug'), 'category', 'subcategory', 'description')
         }),
         ('Pricing', {
             'fields': ('price', 'price_with_currency')
@@ -70,7 +73,7 @@ class ProductAdmin(admin.ModelAdmin):
             'fields': ('image', 'image_preview')
         }),
     )
-    autocomplete_fields = ['category']
+    autocomplete_fields = ['category', 'subcategory']
 
     def image_preview(self, obj):
         if obj.image:
@@ -113,24 +116,70 @@ class OrderItemInline(admin.TabularInline):
     extra = 0
 
 
+class OrderStatusEventInline(admin.TabularInline):
+    model = OrderStatusEvent
+    fields = ['created_at', 'from_status', 'to_status', 'actor', 'note']
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
-    list_display = ['id', 'user', 'created_at', 'paid', 'total_amount']
+    list_display = ['id', 'user', 'created_at', 'status', 'paid', 'total_amount']
     ordering = ['-created_at']
-    list_filter = ['paid', 'created_at']
-    inlines = [OrderItemInline]
+    list_filter = ['status', 'paid', 'created_at']
+    inlines = [OrderItemInline, OrderStatusEventInline]
     date_hierarchy = 'created_at'
-    readonly_fields = ['created_at', 'user']
+    # total_amount пересчитывается при сохранении позиций (products/orders.py),
+    # статус меняется только действиями списка (products/lifecycle.py)
+    readonly_fields = ['created_at', 'user', 'status', 'total_amount']
     autocomplete_fields = ['user']
     list_select_related = ('user',)
 
-    def get_queryset(self, request):
-        return super().get_queryset(request).annotate(
-            total_amount=Sum(F('items__price') * F('items__quantity')))
+    def transition(self, request, queryset, status):
+        try:
+            count = queryset.transition(status, actor=request.user)
+        except InvalidTransitionError as error:
+            self.message_user(request, str(error), messages.ERROR)
+        else:
+            self.message_user(request, f"Статус изменён у заказов: {count}", messages.SUCCESS)
+
+    @admin.action(description='Отметить выбранные заказы как отправленные')
+    def mark_shipped(self, request, queryset):
+        self.transition(request, queryset, SHIPPED)
+
+    @admin.action(description='Отметить выбранные заказы как доставленные')
+    def mark_delivered(self, request, queryset):
+        self.transition(request, queryset, DELIVERED)
+
+    @admin.action(description='Отменить выбранные заказы')
+    def cancel_orders(self, request, queryset):
+        self.transition(request, queryset, CANCELLED)
+
+    actions = ['mark_shipped', 'mark_delivered', 'cancel_orders']
+
+
+@admin.register(OrderStatusEvent)
+class OrderStatusEventAdmin(admin.ModelAdmin):
+    # Журнал только дописывается
+    list_display = ('order', 'from_status', 'to_status', 'actor', 'created_at')
+    list_filter = ('to_status', 'created_at')
+    date_hierarchy = 'created_at'
+    raw_id_fields = ('order',)
+    list_select_related = ('actor',)
+
+    def has_add_permission(self, request):
+        return False
 
-    def total_amount(self, obj):
-        return sum(item.product.price * item.quantity for item in obj.items.all())
-    total_amount.short_description = 'Общая сумма'
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
 
 
 @admin.register(StaticPage)
@@ -159,3 +208,21 @@ class StaticPageAdmin(admin.ModelAdmin):
             return format_html('<a href="{}" target="_blank">Открыть Предпросмотр</a>', url)
         return "-"
     preview.short_description = "Предпросмотр"
+
+
+@admin.register(SearchQueryLog)
+class SearchQueryLogAdmin(admin.ModelAdmin):
+    list_display = ('query', 'results_count', 'latency_ms', 'cache_hit', 'created_at')
+    list_filter = ('cache_hit', 'created_at')
+    search_fields = ('query',)
+    date_hierarchy = 'created_at'
+    ordering = ('-created_at',)
+    readonly_fields = ('query', 'filters', 'results_count', 'latency_ms', 'cache_hit', 'created_at')
+
+
+@admin.register(ExchangeRate)
+class ExchangeRateAdmin(admin.ModelAdmin):
+    list_display = ('code', 'name', 'symbol', 'rate', 'updated_at')
+    list_editable = ('rate',)
+    search_fields = ('code', 'name')
+    readonly_fields = ('updated_at',)
@@ -0,0 +1,66 @@
+# products/analytics.py
+"""
+Журнал поисковых запросов (SearchQueryLog) без INSERT в пути запроса.
+
+product_search только добавляет запись в буфер в памяти процесса
+(settings.SEARCH_LOG_BUFFER_SIZE; при переполнении вытесняются самые
+старые записи). Буфер сбрасывается в БД одним bulk_create фоновым потоком:
+раз в settings.SEARCH_LOG_FLUSH_INTERVAL секунд или сразу, как только в нём
+набралось settings.SEARCH_LOG_BATCH_SIZE записей (см. products/buffering.py).
+При завершении процесса остаток буфера сбрасывается через atexit.
+"""
+import atexit
+
+from django.conf import settings
+from django.utils import timezone
+
+from .buffering import BufferedWriter
+from .search import tokenize
+
+
+def log_enabled():
+    return getattr(settings, 'SEARCH_LOG_ENABLED', True)
+
+
+def batch_size():
+    return getattr(settings, 'SEARCH_LOG_BATCH_SIZE', 100)
+
+
+def flush_interval():
+    return getattr(settings, 'SEARCH_LOG_FLUSH_INTERVAL', 5)
+
+
+def buffer_size():
+    return getattr(settings, 'SEARCH_LOG_BUFFER_SIZE', 10000)
+
+
+class SearchQueryBuffer(BufferedWriter):
+    thread_name = 'search-log-flusher'
+    label = 'журнал поиска'
+    batch_size = staticmethod(batch_size)
+    flush_interval = staticmethod(flush_interval)
+    buffer_size = staticmethod(buffer_size)
+
+    def record(self, query, filters, results_count, latency_ms, cache_hit):
+        if not log_enabled():
+            return
+        from .models import SearchQueryLog
+
+        self.put(SearchQueryLog(
+            query=' '.join(tokenize(query))[:255],
+            filters={key: value for key, value in filters.items() if value not in ('', None)},
+            results_count=results_count,
+            latency_ms=round(latency_ms, 2),
+            cache_hit=cache_hit,
+            created_at=timezone.now(),
+        ))
+
+    def write(self, pending):
+        """Записывает накопленные запросы одним bulk_create."""
+        from .models import SearchQueryLog
+
+        SearchQueryLog.objects.bulk_create(list(pending), batch_size=batch_size())
+
+
+search_query_log = SearchQueryBuffer()
+atexit.register(search_query_log.flush)
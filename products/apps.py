@@ -1,6 +1,31 @@
+import os
+import sys
+
 from django.apps import AppConfig
 
 
+def serves_requests():
+    """
+    Будет ли процесс обслуживать запросы: WSGI/ASGI-сервер или runserver
+    (при автоперезагрузке — только его дочерний процесс). Остальные команды
+    manage.py (migrate, makemigrations, test, shell...) сюда не попадают.
+    """
+    program = os.path.basename(sys.argv[0]) if sys.argv else ''
+    if program not in ('manage.py', 'django-admin', '__main__.py'):
+        return True
+    if sys.argv[1:2] != ['runserver']:
+        return False
+    return os.environ.get('RUN_MAIN') == 'true' or '--noreload' in sys.argv
+
+
 class ProductsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'products'
+
+    def ready(self):
+        import products.signals
+
+        from django.conf import settings
+        if getattr(settings, 'SEARCH_AUTOCOMPLETE_WARMUP', False) and serves_requests():
+            from .autocomplete import autocomplete_index
+            autocomplete_index.warm_up()
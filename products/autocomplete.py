@@ -0,0 +1,285 @@
+# products/autocomplete.py
+"""
+Автодополнение для поля поиска в шапке (#searchInput).
+
+Индекс живёт в памяти процесса: отсортированный массив ключей
+(нормализованный "хвост" названия, начиная с каждого слова) и bisect
+по префиксу. Для каждой записи хранится популярность (для товаров —
+сколько штук продано, для категорий — число товаров), по ней выбираются
+top-K результатов. Последние ответы по префиксам кешируются (LRU).
+
+Индекс прогревается в фоне из ProductsConfig.ready() (кроме команд
+manage.py вроде migrate и test), иначе строится при первом запросе
+подсказок. Названия и популярность обновляются сигналами моделей
+(products/signals.py). Если индекс не удалось собрать, подсказки
+берутся из БД.
+"""
+import heapq
+import logging
+import threading
+from bisect import bisect_left, insort
+from collections import OrderedDict, namedtuple
+
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Sum
+
+from .suggestions import CATEGORY, PRODUCT, SUBCATEGORY, normalize_name
+
+logger = logging.getLogger(__name__)
+
+Suggestion = namedtuple('Suggestion', 'kind pk name payload popularity')
+
+RESULT_GROUPS = {
+    PRODUCT: 'products',
+    CATEGORY: 'categories',
+    SUBCATEGORY: 'subcategories',
+}
+
+
+def suggestions_limit():
+    return getattr(settings, 'SEARCH_SUGGESTIONS_LIMIT', 8)
+
+
+def prefix_keys(name):
+    """Ключи записи: нормализованное название, начиная с каждого слова."""
+    words = normalize_name(name).split()
+    return [' '.join(words[i:]) for i in range(len(words))]
+
+
+class AutocompleteIndex:
+    CACHE_SIZE = 1024
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._build_lock = threading.Lock()
+        self._keys = []          # отсортированный список (key, (kind, pk))
+        self._entries = {}       # (kind, pk) -> Suggestion
+        self._results = OrderedDict()
+        self._built = False
+        self._generation = 0
+
+    # --- построение ---
+
+    @staticmethod
+    def _querysets():
+        """
+        Записи каждого вида с популярностью: товары — сколько штук продано,
+        категории и подкатегории — сколько в них товаров.
+        """
+        from .models import Category, Product, SubCategory
+
+        return {
+            PRODUCT: Product._base_manager.annotate(popularity=Sum('orderitem__quantity')),
+            CATEGORY: Category._base_manager.annotate(popularity=Count('products')),
+            SUBCATEGORY: SubCategory._base_manager.annotate(popularity=Count('products')),
+        }
+
+    @staticmethod
+    def _payload(kind, row):
+        if kind == PRODUCT:
+            return {'id': row['pk'], 'name': row['name']}
+        if kind == CATEGORY:
+            return {'slug': row['slug'], 'name': row['name']}
+        return {'slug': row['slug'], 'category_slug': row['category__slug'], 'name': row['name']}
+
+    @classmethod
+    def _rows(cls, kind, queryset):
+        fields = {
+            PRODUCT: ('pk', 'name', 'popularity'),
+            CATEGORY: ('pk', 'name', 'slug', 'popularity'),
+            SUBCATEGORY: ('pk', 'name', 'slug', 'category__slug', 'popularity'),
+        }[kind]
+        for row in queryset.values(*fields).iterator(chunk_size=2000):
+            yield Suggestion(kind, row['pk'], row['name'], cls._payload(kind, row), row['popularity'] or 0)
+
+    @classmethod
+    def _load(cls):
+        return [
+            entry
+            for kind, queryset in cls._querysets().items()
+            for entry in cls._rows(kind, queryset)
+        ]
+
+    def rebuild(self):
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+        entries = self._load()
+        keys = sorted(
+            (key, (entry.kind, entry.pk))
+            for entry in entries
+            for key in prefix_keys(entry.name)
+        )
+        with self._lock:
+            # Пока строили, индекс мог быть перестроен или изменён — не затираем
+            if generation != self._generation:
+                return
+            self._keys = keys
+            self._entries = {(entry.kind, entry.pk): entry for entry in entries}
+            self._results.clear()
+            self._built = True
+
+    def ensure_built(self):
+        """True, если индекс собран; False — сборку пришлось бросить."""
+        if self._built:
+            return True
+        # Первые параллельные запросы ждут одну сборку, а не строят каждый свою
+        with self._build_lock:
+            # rebuild() может отбросить результат из-за параллельных изменений
+            for _ in range(3):
+                if self._built:
+                    return True
+                self.rebuild()
+            if self._built:
+                return True
+        logger.warning("Индекс автодополнения не собран: каталог меняется во время сборки, подсказки берутся из БД")
+        return False
+
+    def warm_up(self):
+        """Фоновая сборка индекса (вызывается из ProductsConfig.ready)."""
+        def run():
+            # ready() вызывается до окончания загрузки всех приложений
+            apps.ready_event.wait()
+            try:
+                self.ensure_built()
+            except Exception as e:
+                # Например, таблицы ещё не созданы (до migrate)
+                logger.warning(f"Не удалось прогреть индекс автодополнения: {e}")
+
+        threading.Thread(target=run, name='autocomplete-warmup', daemon=True).start()
+
+    # --- инкрементальные изменения ---
+
+    def _discard(self, entry_key):
+        entry = self._entries.pop(entry_key, None)
+        if entry is None:
+            return None
+        for key in prefix_keys(entry.name):
+            i = bisect_left(self._keys, (key, entry_key))
+            if i < len(self._keys) and self._keys[i] == (key, entry_key):
+                del self._keys[i]
+        return entry
+
+    def _put(self, kind, pk, name, payload, popularity=None):
+        entry_key = (kind, pk)
+        old = self._discard(entry_key)
+        if popularity is None:
+            popularity = old.popularity if old else 0
+        self._entries[entry_key] = Suggestion(kind, pk, name, payload, popularity)
+        for key in prefix_keys(name):
+            insort(self._keys, (key, entry_key))
+
+    def _apply(self, change):
+        def apply():
+            with self._lock:
+                self._generation += 1
+                if self._built:
+                    change()
+                    self._results.clear()
+
+        transaction.on_commit(apply)
+
+    def _set_popularity(self, kind, counts):
+        for pk, popularity in counts.items():
+            entry = self._entries.get((kind, pk))
+            if entry is not None:
+                self._entries[(kind, pk)] = entry._replace(popularity=popularity)
+
+    def refresh_popularity(self, kind, pks):
+        """Перечитывает популярность записей kind (продажи товара, число товаров в категории)."""
+        pks = {pk for pk in pks if pk is not None}
+        if not pks:
+            return
+        counts = dict.fromkeys(pks, 0)
+        counts.update(
+            (pk, popularity or 0)
+            for pk, popularity in self._querysets()[kind].filter(pk__in=pks).values_list('pk', 'popularity')
+        )
+        self._apply(lambda: self._set_popularity(kind, counts))
+
+    def add_popularity(self, kind, deltas):
+        """Прибавляет к популярности записей {pk: прирост} без запросов к БД."""
+        def change():
+            for pk, delta in deltas.items():
+                entry = self._entries.get((kind, pk))
+                if entry is not None:
+                    self._entries[(kind, pk)] = entry._replace(popularity=entry.popularity + delta)
+
+        self._apply(change)
+
+    def update_product(self, product):
+        payload = {'id': product.pk, 'name': product.name}
+        self._apply(lambda: self._put(PRODUCT, product.pk, product.name, payload))
+
+    def update_category(self, category):
+        payload = {'slug': category.slug, 'name': category.name}
+        self._apply(lambda: self._put(CATEGORY, category.pk, category.name, payload))
+
+    def update_subcategory(self, subcategory):
+        payload = {
+            'slug': subcategory.slug,
+            'category_slug': subcategory.category.slug,
+            'name': subcategory.name,
+        }
+        self._apply(lambda: self._put(SUBCATEGORY, subcategory.pk, subcategory.name, payload))
+
+    def remove(self, kind, pk):
+        self._apply(lambda: self._discard((kind, pk)))
+
+    # --- поиск ---
+
+    def search(self, query, limit=None):
+        """
+        Возвращает {'products': [...], 'categories': [...], 'subcategories': [...]}
+        — не больше limit самых популярных записей каждого вида.
+        """
+        limit = min(limit or suggestions_limit(), suggestions_limit())
+        prefix = normalize_name(query)
+        if not prefix:
+            return {group: [] for group in RESULT_GROUPS.values()}
+        if not self.ensure_built():
+            return self._search_database(query.strip(), limit)
+        cache_key = (prefix, limit)
+        with self._lock:
+            cached = self._results.get(cache_key)
+            if cached is not None:
+                self._results.move_to_end(cache_key)
+                return cached
+
+            matched = {kind: {} for kind in RESULT_GROUPS}
+            i = bisect_left(self._keys, (prefix,))
+            while i < len(self._keys) and self._keys[i][0].startswith(prefix):
+                entry = self._entries[self._keys[i][1]]
+                matched[entry.kind][entry.pk] = entry
+                i += 1
+
+            result = {
+                RESULT_GROUPS[kind]: [
+                    entry.payload
+                    for entry in heapq.nlargest(
+                        limit, entries.values(), key=lambda e: (e.popularity, -len(e.name))
+                    )
+                ]
+                for kind, entries in matched.items()
+            }
+            self._results[cache_key] = result
+            if len(self._results) > self.CACHE_SIZE:
+                self._results.popitem(last=False)
+        return result
+
+    def _search_database(self, query, limit):
+        """Запасной путь без индекса: вхождение в название, по убыванию популярности."""
+        return {
+            RESULT_GROUPS[kind]: [
+                entry.payload
+                for entry in self._rows(
+                    kind, queryset.filter(name__icontains=query).order_by(F('popularity').desc(nulls_last=True), 'pk')[:limit]
+                )
+            ]
+            for kind, queryset in self._querysets().items()
+        }
+
+
+autocomplete_index = AutocompleteIndex()
@@ -0,0 +1,109 @@
+# products/buffering.py
+"""
+Буфер записей в памяти процесса со сбросом в БД фоновым потоком.
+
+Общая основа журнала поиска (products/analytics.py), событий активности
+(accounts/events.py) и отметок последней активности (accounts/activity.py).
+Запрос только кладёт запись в буфер (put). Буфер сбрасывается методом
+write() подкласса в фоновом потоке: раз в flush_interval() секунд или
+сразу, как только в нём набралось batch_size() записей. Если интервал не
+задан (None/0), потока нет и полный буфер сбрасывается в том же потоке.
+
+Буфер ограничен buffer_size() записями (None — без ограничения): при
+переполнении вытесняются самые старые, а их число пишется в лог при
+следующем сбросе. Остаток буфера при завершении процесса сбрасывает
+atexit, который регистрирует модуль с экземпляром буфера.
+"""
+import logging
+import threading
+from collections import deque
+
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+
+class BufferedWriter:
+    thread_name = 'buffer-flusher'
+    # Что лежит в буфере — для сообщений в лог
+    label = 'записи'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = self.new_buffer()
+        self._dropped = 0
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    # --- задаётся подклассами ---
+
+    def batch_size(self):
+        raise NotImplementedError
+
+    def flush_interval(self):
+        raise NotImplementedError
+
+    def buffer_size(self):
+        return None
+
+    def new_buffer(self):
+        return deque(maxlen=self.buffer_size())
+
+    def add(self, pending, item):
+        """Кладёт item в буфер pending (вызывается под блокировкой)."""
+        pending.append(item)
+
+    def write(self, pending):
+        raise NotImplementedError
+
+    # --- буфер ---
+
+    def put(self, item):
+        with self._lock:
+            limit = getattr(self._pending, 'maxlen', None)
+            if limit is not None and len(self._pending) >= limit:
+                self._dropped += 1
+            self.add(self._pending, item)
+            full = len(self._pending) >= self.batch_size()
+
+        if self.flush_interval():
+            self._ensure_thread()
+            if full:
+                self._wakeup.set()
+        elif full:
+            self.flush()
+
+    def flush(self):
+        """Записывает накопленное одним write(). Возвращает число записей."""
+        with self._lock:
+            pending, self._pending = self._pending, self.new_buffer()
+            dropped, self._dropped = self._dropped, 0
+        if dropped:
+            logger.warning(f"Буфер переполнен ({self.label}), потеряно записей: {dropped}")
+        if not pending:
+            return 0
+        try:
+            self.write(pending)
+        except Exception as e:
+            logger.error(f"Не удалось записать {self.label} ({len(pending)} шт.): {e}")
+            return 0
+        return len(pending)
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval() or 5)
+            self._wakeup.clear()
+            self.flush()
+            close_old_connections()
@@ -1,101 +1,485 @@
 from decimal import Decimal
 
-from .models import Product
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Sum
+
+from .currency import session_currency
+from .models import CartLine, Product, UserCart
+from .reservations import (
+    HOLDER_SESSION_KEY, extend, holder_for_session, others_reserved_subquery, release, reserve,
+)
+from .services import InsufficientStockError
+
+CART_SESSION_KEY = 'cart'
+CART_OPERATIONS = ('add', 'update', 'remove')
+SUMMARY_REQUEST_ATTR = '_cart_summary'
+
+
+def summary_cache_key(user_id):
+    return f'cart_summary:{user_id}'
+
+
+def summary_cache_timeout():
+    return getattr(settings, 'CART_SUMMARY_CACHE_TIMEOUT', 15 * 60)
+
+
+def refresh_summary(cart):
+    """
+    Пересчитывает сводку корзины cart (UserCart) одним агрегатом и
+    обновляет UserCart и кеш. Возвращает (количество, сумма).
+    """
+    totals = CartLine.objects.filter(cart_id=cart.pk).aggregate(
+        count=Sum('quantity'), total=Sum(F('price') * F('quantity')),
+    )
+    summary = (totals['count'] or 0, totals['total'] or Decimal('0'))
+    UserCart.objects.filter(pk=cart.pk).update(items_count=summary[0], total=summary[1])
+    # Кеш обновляется после коммита: откат транзакции не оставит в нём чужую сводку
+    key = summary_cache_key(cart.user_id)
+    cache.delete(key)
+    transaction.on_commit(lambda: cache.set(key, summary, summary_cache_timeout()))
+    return summary
+
+
+class SessionCartStorage:
+    """
+    Корзина анонимного пользователя: {product_id: {'quantity', 'price'}} в сессии.
+    Пока корзина пуста, в сессию ничего не пишется.
+    """
+
+    def __init__(self, session):
+        self.session = session
+
+    def lines(self):
+        return self.session.get(CART_SESSION_KEY, {})
+
+    def set(self, product, quantity):
+        lines = self.lines()
+        line = lines.setdefault(str(product.id), {'quantity': 0, 'price': str(product.price)})
+        line['quantity'] = quantity
+        self.session[CART_SESSION_KEY] = lines
+
+    def delete(self, product_ids):
+        lines = self.lines()
+        for product_id in product_ids:
+            lines.pop(str(product_id), None)
+        self.session[CART_SESSION_KEY] = lines
+
+    def set_many(self, products, quantities):
+        lines = self.lines()
+        for product_id, quantity in quantities.items():
+            if quantity:
+                line = lines.setdefault(str(product_id), {'quantity': 0, 'price': str(products[product_id].price)})
+                line['quantity'] = quantity
+            else:
+                lines.pop(str(product_id), None)
+        self.session[CART_SESSION_KEY] = lines
+
+    def reprice(self, prices):
+        lines = self.lines()
+        for product_id, price in prices.items():
+            lines[str(product_id)]['price'] = str(price)
+        self.session[CART_SESSION_KEY] = lines
+
+    def clear(self):
+        self.session.pop(CART_SESSION_KEY, None)
+
+    def summary(self):
+        lines = self.lines().values()
+        return (
+            sum(line['quantity'] for line in lines),
+            sum((Decimal(line['price']) * line['quantity'] for line in lines), Decimal('0')),
+        )
+
+    def holder(self, create=True):
+        if create:
+            return holder_for_session(self.session)
+        return self.session.get(HOLDER_SESSION_KEY)
+
+
+class DatabaseCartStorage:
+    """
+    Корзина авторизованного пользователя в UserCart/CartLine.
+    Сводка (количество и сумма) хранится в UserCart и в кеше, строки
+    загружаются только когда они действительно нужны.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self._lines = None
+
+    def lines(self):
+        if self._lines is None:
+            self._lines = {
+                str(product_id): {'quantity': quantity, 'price': str(price)}
+                for product_id, quantity, price in
+                CartLine.objects.for_user(self.user).values_list('product_id', 'quantity', 'price')
+            }
+        return self._lines
+
+    def _cart(self):
+        cart, _ = UserCart.objects.get_or_create(user=self.user)
+        return cart
+
+    def _refresh_summary(self, cart):
+        refresh_summary(cart)
+        self._lines = None
+
+    def set(self, product, quantity):
+        cart = self._cart()
+        CartLine.objects.update_or_create(
+            cart=cart, product=product,
+            defaults={'quantity': quantity},
+            create_defaults={'quantity': quantity, 'price': product.price},
+        )
+        self._refresh_summary(cart)
+
+    def delete(self, product_ids):
+        cart = self._cart()
+        cart.lines.filter(product_id__in=product_ids).delete()
+        self._refresh_summary(cart)
+
+    def set_many(self, products, quantities):
+        cart = self._cart()
+        removed = [product_id for product_id, quantity in quantities.items() if not quantity]
+        if removed:
+            cart.lines.filter(product_id__in=removed).delete()
+        # Новые строки вставляются с текущей ценой, у существующих меняется только количество
+        CartLine.objects.bulk_create(
+            [
+                CartLine(cart=cart, product=products[product_id], quantity=quantity, price=products[product_id].price)
+                for product_id, quantity in quantities.items() if quantity
+            ],
+            update_conflicts=True, unique_fields=['cart', 'product'], update_fields=['quantity'],
+        )
+        self._refresh_summary(cart)
+
+    def reprice(self, prices):
+        cart = self._cart()
+        lines = list(cart.lines.filter(product_id__in=prices))
+        for line in lines:
+            line.price = prices[line.product_id]
+        CartLine.objects.bulk_update(lines, ['price'])
+        self._refresh_summary(cart)
+
+    def clear(self):
+        cart = self._cart()
+        cart.lines.all().delete()
+        self._refresh_summary(cart)
+
+    def summary(self):
+        key = summary_cache_key(self.user.pk)
+        summary = cache.get(key)
+        if summary is None:
+            row = UserCart.objects.filter(user=self.user).values_list('items_count', 'total').first()
+            summary = row or (0, Decimal('0'))
+            cache.set(key, summary, summary_cache_timeout())
+        return summary
+
+    def holder(self, create=True):
+        # Резервы авторизованной корзины общие для всех устройств пользователя
+        return f'user:{self.user.pk}'
+
+
+class HydratedCart:
+    """
+    Строки корзины вместе с товарами: товары выбираются одним запросом,
+    итоги строк и корзины считаются за один проход. Строки — новые словари
+    (product, quantity, price, total_price, price_changed, current_price),
+    хранилище корзины не меняется и остаётся JSON-совместимым.
+    Цены — в валюте currency; price_changed — цена в корзине отличается
+    от текущей Product.price.
+    """
+
+    def __init__(self, lines, currency):
+        products = Product.objects.select_related('category').in_bulk([int(pk) for pk in lines])
+        self.items = []
+        self.stale = []
+        self.count = 0
+        self.total = Decimal('0')
+        for product_id, line in lines.items():
+            product = products.get(int(product_id))
+            if product is None:
+                continue
+            stored_price = Decimal(line['price'])
+            price = currency.convert(stored_price)
+            item = {
+                'product': product,
+                'quantity': line['quantity'],
+                'price': price,
+                'total_price': price * line['quantity'],
+                'price_changed': stored_price != product.price,
+                'current_price': currency.convert(product.price),
+            }
+            self.items.append(item)
+            if item['price_changed']:
+                self.stale.append(item)
+            self.count += item['quantity']
+            self.total += item['total_price']
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
 
 
 class Cart:
     def __init__(self, request):
         """
-        Инициализируем корзину
+        Инициализируем корзину: для авторизованного пользователя — в БД,
+        для анонимного — в сессии
         """
+        self.request = request
+        self._hydrated = None
         self.session = request.session
         self.user = request.user if request.user.is_authenticated else None
-        cart = self.session.get('cart')
-        if not cart:
-            cart = self.session['cart'] = {}
-        self.cart = cart
+        if self.user is not None:
+            self.storage = DatabaseCartStorage(self.user)
+        else:
+            self.storage = SessionCartStorage(self.session)
+
+    @property
+    def cart(self):
+        """
+        Строки корзины: {product_id: {'quantity', 'price'}}
+        """
+        return self.storage.lines()
+
+    @property
+    def currency(self):
+        """
+        Валюта, выбранная покупателем (цены в хранилище — в базовой)
+        """
+        return session_currency(self.session)
+
+    @property
+    def holder(self):
+        """
+        Токен корзины для резервов (для анонимной корзины создаётся при первом изменении)
+        """
+        return self.storage.holder()
+
+    def _changed(self):
+        # Сводка, запомненная для этого запроса (cart_summary), и собранные строки устарели
+        self.request.__dict__.pop(SUMMARY_REQUEST_ATTR, None)
+        self._hydrated = None
+
+    def hydrated(self):
+        """
+        Строки корзины с товарами (HydratedCart) — собираются один раз на
+        экземпляр корзины, до следующего изменения
+        """
+        if self._hydrated is None:
+            self._hydrated = HydratedCart(self.cart, self.currency)
+        return self._hydrated
+
+    def quantity(self, product):
+        """
+        Сколько единиц товара лежит в корзине
+        """
+        return self.cart.get(str(product.id), {}).get('quantity', 0)
 
     def add(self, product, quantity=1, update_quantity=False):
-        product_id = str(product.id)
+        """
+        Добавляет quantity единиц товара (или устанавливает количество при
+        update_quantity). Возвращает количество в корзине после резерва —
+        оно меньше запрошенного, если столько товара не нашлось
+        """
         quantity = int(quantity)
-        if quantity > product.stock:
-            quantity = product.stock  # Ограничиваем количество доступным на складе
-        if product_id not in self.cart:
-            self.cart[product_id] = {'quantity': 0, 'price': str(product.price)}
-        if update_quantity:
-            self.cart[product_id]['quantity'] = quantity
+        current = self.quantity(product)
+        wanted = quantity if update_quantity else current + quantity
+        # Резервируем товар под корзину; если доступно меньше — берём сколько есть
+        reserved = reserve(self.holder, product, wanted)
+        if not reserved:
+            self.storage.delete([product.id])
         else:
-            self.cart[product_id]['quantity'] += quantity
-            # Дополнительная проверка после добавления
-            if self.cart[product_id]['quantity'] > product.stock:
-                self.cart[product_id]['quantity'] = product.stock
-        self.save()
-
-    def save(self):
-        # Обновление сессии cart
-        self.session['cart'] = self.cart
-        # Отметить сессию как "измененную", чтобы убедиться, что она сохранится
-        self.session.modified = True
+            self.storage.set(product, reserved)
+        self._changed()
+        return reserved
 
     def remove(self, product):
         """
         Удаление товара из корзины
         """
-        product_id = str(product.id)
-        if product_id in self.cart:
-            del self.cart[product_id]
-            self.save()
+        if str(product.id) in self.cart:
+            self.storage.delete([product.id])
+            self._changed()
+        release(self.holder, [product.id])
 
     def __iter__(self):
-        product_ids = self.cart.keys()
-        products = Product.objects.filter(id__in=product_ids)
-        currency = self.session.get('currency', 'MDL')
-        exchange_rates = {
-            'MDL': 1,
-            'USD': 0.056,
-            'EUR': 0.048,
-        }
-        rate = exchange_rates.get(currency, 1)
-        for product in products:
-            cart_item = self.cart[str(product.id)]
-            cart_item['product'] = product
-            cart_item['price'] = Decimal(cart_item['price']) * rate
-            cart_item['total_price'] = cart_item['price'] * cart_item['quantity']
-            yield cart_item
+        return iter(self.hydrated().items)
 
     def __len__(self):
         """
-        Подсчет всех товаров в корзине
+        Подсчет всех товаров в корзине (по сводке, без загрузки строк)
+        """
+        return self.storage.summary()[0]
+
+    def quantities(self):
+        """
+        {product_id: количество} (для оформления заказа)
         """
-        return sum(item['quantity'] for item in self.cart.values())
+        return {int(product_id): item['quantity'] for product_id, item in self.cart.items()}
 
     def get_total_price(self):
         """
-        Подсчет общей стоимости товаров в корзине
+        Подсчет общей стоимости товаров в корзине в выбранной валюте:
+        сумма итогов строк по округлённым ценам
         """
-        return sum(Decimal(item['price']) * item['quantity'] for item in self.cart.values())
+        if self._hydrated is not None:
+            return self._hydrated.total
+        currency = self.currency
+        if currency.is_base:
+            return self.storage.summary()[1]
+        return sum(
+            (currency.convert(line['price']) * line['quantity'] for line in self.cart.values()),
+            Decimal('0'),
+        )
 
     def clear(self):
-        # Очистка корзины
-        self.session['cart'] = {}
-        self.session.modified = True
+        # Очистка корзины и снятие резервов
+        self.storage.clear()
+        self._changed()
+        holder = self.storage.holder(create=False)
+        if holder:
+            release(holder)
+
+    def extend_reservations(self):
+        """
+        Продлевает резервы товаров корзины
+        """
+        holder = self.storage.holder(create=False)
+        if holder:
+            extend(holder)
 
     def update(self, product, quantity):
         """
         Update quantity of a product in the cart
         """
-        product_id = str(product.id)
-        if product_id in self.cart:
-            self.cart[product_id]['quantity'] = quantity
-            self.save()
+        if str(product.id) in self.cart:
+            reserved = reserve(self.holder, product, quantity)
+            # Как и в add(): если товара не осталось, строка удаляется
+            if not reserved:
+                self.storage.delete([product.id])
+            else:
+                self.storage.set(product, reserved)
+            self._changed()
+
+    def apply(self, operations):
+        """
+        Применяет пачку операций [{'op': 'add'|'update'|'remove', 'product_id', 'quantity'}].
+        Итоговые количества проверяются по доступным остаткам одним запросом;
+        при нехватке бросается InsufficientStockError и корзина не меняется,
+        некорректная операция — ValueError. Резервы и строки корзины
+        меняются в одной транзакции. Возвращает HydratedCart.
+        """
+        if not isinstance(operations, list):
+            raise ValueError("Ожидается список операций")
+        current = {int(product_id): line['quantity'] for product_id, line in self.cart.items()}
+        wanted = dict(current)
+        for operation in operations:
+            try:
+                op = operation['op']
+                product_id = int(operation['product_id'])
+                quantity = int(operation.get('quantity', 1))
+            except (KeyError, TypeError, ValueError, AttributeError):
+                raise ValueError("Некорректная операция") from None
+            if op not in CART_OPERATIONS or quantity < 0:
+                raise ValueError(f"Некорректная операция: {op}")
+            if op == 'add':
+                wanted[product_id] = wanted.get(product_id, 0) + quantity
+            elif op == 'update':
+                wanted[product_id] = quantity
+            else:
+                wanted[product_id] = 0
+        changed = {product_id: quantity for product_id, quantity in wanted.items() if quantity != current.get(product_id, 0)}
+        if not changed:
+            return self.hydrated()
+
+        holder = self.holder
+        products = (
+            Product.objects.filter(pk__in=changed)
+            .annotate(available=F('stock') - others_reserved_subquery(holder))
+            .in_bulk()
+        )
+        missing = set(changed) - set(products)
+        if missing:
+            raise ValueError(f"Товар не найден: {', '.join(map(str, sorted(missing)))}")
+        shortages = [
+            (product_id, products[product_id].name, max(products[product_id].available, 0))
+            for product_id, quantity in changed.items() if quantity > products[product_id].available
+        ]
+        if shortages:
+            raise InsufficientStockError(shortages)
+
+        with transaction.atomic():
+            for product_id, quantity in changed.items():
+                # Остаток мог уйти между проверкой и резервом — тогда откатываем всё
+                reserved = reserve(holder, products[product_id], quantity)
+                if reserved != quantity:
+                    raise InsufficientStockError([(product_id, products[product_id].name, reserved)])
+            self.storage.set_many(products, changed)
+        self._changed()
+        return self.hydrated()
+
+    def refresh_prices(self):
+        """
+        Переписывает в корзине цены, устаревшие относительно Product.price.
+        Возвращает товары, у которых цена изменилась.
+        """
+        stale = self.hydrated().stale
+        if stale:
+            self.storage.reprice({item['product'].id: item['product'].price for item in stale})
+            self._changed()
+        return [item['product'] for item in stale]
 
     def get_item_total_price(self, product):
         """
         Get total price for a single item in the cart
         """
-        product_id = str(product.id)
-        if product_id in self.cart:
-            return Decimal(self.cart[product_id]['price']) * self.cart[product_id]['quantity']
-        return Decimal(0)
+        line = self.cart.get(str(product.id))
+        if line is None:
+            return Decimal(0)
+        return self.currency.convert(line['price']) * line['quantity']
+
+
+def cart_summary(request):
+    """
+    (количество товаров, сумма) корзины. Для пользователя — из кеша или
+    сводки UserCart, для анонима — из сессии; пустая сессия не создаётся.
+    Результат запоминается на время запроса.
+    """
+    summary = getattr(request, SUMMARY_REQUEST_ATTR, None)
+    if summary is None:
+        summary = Cart(request).storage.summary()
+        setattr(request, SUMMARY_REQUEST_ATTR, summary)
+    return summary
 
 
+def merge_session_cart(request, user):
+    """
+    Переносит анонимную корзину из сессии в корзину пользователя при входе:
+    количества складываются, резервы переходят на корзину пользователя.
+    """
+    session = SessionCartStorage(request.session)
+    lines = session.lines()
+    if not lines:
+        return
+    storage = DatabaseCartStorage(user)
+    existing = storage.lines()
+    session_holder = session.holder(create=False)
+    if session_holder:
+        release(session_holder)
+    user_holder = storage.holder()
+    products = Product.objects.in_bulk([int(product_id) for product_id in lines])
+    quantities = {}
+    for pk, product in products.items():
+        product_id = str(pk)
+        wanted = lines[product_id]['quantity'] + existing.get(product_id, {}).get('quantity', 0)
+        # 0 — товара не осталось: строка пользователя удаляется, а не остаётся без резерва
+        quantities[pk] = reserve(user_holder, product, wanted)
+    # Одна запись строк и один пересчёт сводки корзины
+    storage.set_many(products, quantities)
+    session.clear()
@@ -1,10 +1,28 @@
 from datetime import datetime
 
-from .cart import Cart
+from django.utils.functional import SimpleLazyObject
+
+from .cart import cart_summary
+from .currency import session_currency
+from .navigation import get_navigation_tree
 
 def cart_total_amount(request):
-    cart = Cart(request)
-    return {'cart_total_items': len(cart)}
+    """Число товаров в корзине; считается, только если шаблон его выводит."""
+    return {'cart_total_items': SimpleLazyObject(lambda: cart_summary(request)[0])}
 
 def current_year(request):
     return {'current_year': datetime.now().year}
+
+
+def navigation(request):
+    """Дерево категорий из кеша; читается, только если шаблон его использует."""
+    return {'navigation': SimpleLazyObject(get_navigation_tree)}
+
+
+def currency(request):
+    """Выбранная покупателем валюта (объект Currency) и её символ."""
+    selected = SimpleLazyObject(lambda: session_currency(request.session))
+    return {
+        'currency': SimpleLazyObject(lambda: selected.code),
+        'currency_symbol': SimpleLazyObject(lambda: selected.symbol),
+    }
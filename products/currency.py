@@ -0,0 +1,167 @@
+# products/currency.py
+"""
+Валюты и пересчёт цен.
+
+Курсы хранятся в ExchangeRate: сколько единиц валюты стоит одна единица
+базовой (settings.BASE_CURRENCY, цены в Product — в ней). Каждый процесс
+держит таблицу курсов в памяти вместе с версией курсов из общего кеша;
+сохранение или удаление курса увеличивает версию (products/signals.py),
+и при следующем обращении процесс перечитывает таблицу одним запросом.
+Пока таблица пуста, действуют курсы DEFAULT_CURRENCIES.
+
+Пересчитанная цена округляется до копеек (ROUND_HALF_UP), итог строки —
+это округлённая цена, умноженная на количество, итог корзины — сумма
+итогов строк. Для каждой валюты ведётся таблица "базовая цена -> цена в
+валюте": цены на витрине сильно повторяются, поэтому каждая цена
+пересчитывается один раз на версию курсов, а не для каждого товара при
+каждом рендере.
+"""
+import threading
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+
+CENT = Decimal('0.01')
+RATES_VERSION_KEY = 'currency_rates_version'
+CURRENCY_SESSION_KEY = 'currency'
+
+# code: (название, символ, курс к базовой валюте)
+DEFAULT_CURRENCIES = {
+    'MDL': ('Молдавские леи', 'L', Decimal('1')),
+    'EUR': ('Евро', '€', Decimal('0.048')),
+    'USD': ('Доллар США', '$', Decimal('0.056')),
+}
+
+
+def base_currency():
+    return getattr(settings, 'BASE_CURRENCY', 'MDL')
+
+
+def rates_version():
+    """Версия курсов: меняется при любом изменении ExchangeRate."""
+    version = cache.get(RATES_VERSION_KEY)
+    if version is None:
+        cache.add(RATES_VERSION_KEY, 1, None)
+        version = cache.get(RATES_VERSION_KEY, 1)
+    return version
+
+
+def bump_rates_version():
+    """Заставляет все процессы перечитать курсы и пересчитать цены."""
+    try:
+        cache.incr(RATES_VERSION_KEY)
+    except ValueError:
+        cache.set(RATES_VERSION_KEY, 2, None)
+
+
+class Currency:
+    __slots__ = ('code', 'name', 'symbol', 'rate', 'prices')
+
+    def __init__(self, code, name, symbol, rate):
+        self.code = code
+        self.name = name
+        self.symbol = symbol
+        self.rate = Decimal(rate)
+        # базовая цена -> цена в валюте (заполняется по мере обращения)
+        self.prices = {}
+
+    @property
+    def is_base(self):
+        return self.code == base_currency()
+
+    def convert(self, amount):
+        amount = Decimal(amount)
+        if self.is_base:
+            return amount
+        price = self.prices.get(amount)
+        if price is None:
+            price = self.prices[amount] = (amount * self.rate).quantize(CENT, rounding=ROUND_HALF_UP)
+        return price
+
+    def __repr__(self):
+        return f'<Currency {self.code} {self.rate}>'
+
+
+class ExchangeRates:
+    """Таблица курсов процесса, привязанная к версии курсов в общем кеше."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._currencies = {}
+
+    def load(self):
+        from .models import ExchangeRate
+
+        currencies = {
+            code: Currency(code, name, symbol, rate)
+            for code, name, symbol, rate in ExchangeRate.objects.values_list('code', 'name', 'symbol', 'rate')
+        }
+        if not currencies:
+            currencies = {
+                code: Currency(code, name, symbol, rate)
+                for code, (name, symbol, rate) in DEFAULT_CURRENCIES.items()
+            }
+        base = base_currency()
+        if base not in currencies:
+            name, symbol, _ = DEFAULT_CURRENCIES.get(base, (base, base, 1))
+            currencies[base] = Currency(base, name, symbol, 1)
+        return currencies
+
+    def all(self):
+        """{code: Currency} для текущей версии курсов."""
+        version = rates_version()
+        if version != self._version:
+            currencies = self.load()
+            with self._lock:
+                self._currencies = currencies
+                self._version = version
+        return self._currencies
+
+    def get(self, code):
+        """Валюта по коду; неизвестный код — базовая валюта."""
+        currencies = self.all()
+        return currencies.get(code) or currencies[base_currency()]
+
+    def clear(self):
+        with self._lock:
+            self._version = None
+            self._currencies = {}
+
+
+exchange_rates = ExchangeRates()
+
+
+def get_currency(code=None):
+    return exchange_rates.get(code or base_currency())
+
+
+def session_currency(session):
+    """Валюта, выбранная покупателем (в сессии), без создания сессии."""
+    return get_currency(session.get(CURRENCY_SESSION_KEY))
+
+
+def convert(amount, code):
+    """Пересчёт суммы в базовой валюте в валюту code с округлением до копеек."""
+    return get_currency(code).convert(amount)
+
+
+def currency_symbol(code):
+    return get_currency(code).symbol
+
+
+def localize_prices(products, currency):
+    """
+    Проставляет товарам display_price (и display_old_price, если у товара
+    есть old_price) в валюте currency (Currency или код). Курс берётся один
+    раз на весь список; возвращает список товаров.
+    """
+    if not isinstance(currency, Currency):
+        currency = get_currency(currency)
+    products = list(products)
+    for product in products:
+        product.display_price = currency.convert(product.price)
+        old_price = getattr(product, 'old_price', None)
+        product.display_old_price = currency.convert(old_price) if old_price else None
+    return products
@@ -0,0 +1,128 @@
+# products/facets.py
+"""
+Фасеты для каталога и поиска: сколько товаров текущей выборки приходится
+на каждую категорию, подкатегорию, ценовой диапазон и сколько есть в наличии.
+
+Все счётчики считаются одним запросом: выборка группируется по
+(категория, подкатегория), а ценовые диапазоны и наличие — условные
+Count(filter=Q(...)) в той же агрегации. Суммы по категориям и диапазонам
+складываются уже в Python из полученных групп. Если выборка задана
+списком id (результаты поиска), запрос выполняется по пачкам id, а группы
+пачек складываются так же. Результат кешируется по подписи фильтров и
+версии каталога (см. search.catalog_version).
+"""
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Q
+
+from .search import catalog_version, id_chunks
+
+DEFAULT_PRICE_BUCKETS = (1000, 5000, 10000, 50000)
+
+
+def price_buckets():
+    """
+    Диапазоны цен [(min, max), ...] из границ settings.SEARCH_FACET_PRICE_BUCKETS.
+    Нижняя граница включается, верхняя нет; у последнего диапазона max = None.
+    """
+    bounds = [Decimal(str(bound)) for bound in
+              getattr(settings, 'SEARCH_FACET_PRICE_BUCKETS', DEFAULT_PRICE_BUCKETS)]
+    lower = [Decimal(0)] + bounds
+    upper = bounds + [None]
+    return list(zip(lower, upper))
+
+
+def _bucket_filter(low, high):
+    condition = Q(price__gte=low)
+    if high is not None:
+        condition &= Q(price__lt=high)
+    return condition
+
+
+def compute_facets(queryset, ids=None):
+    """
+    Считает фасеты выборки товаров одним агрегирующим запросом; если задан
+    ids — только по товарам с этими id, по запросу на пачку id.
+    """
+    buckets = price_buckets()
+    aggregates = {
+        'total': Count('pk'),
+        'in_stock': Count('pk', filter=Q(stock__gt=0)),
+    }
+    for i, (low, high) in enumerate(buckets):
+        aggregates[f'price_{i}'] = Count('pk', filter=_bucket_filter(low, high))
+
+    grouped = (
+        queryset.order_by()
+        .values(
+            'category_id', 'category__slug', 'category__name',
+            'subcategory_id', 'subcategory__slug', 'subcategory__name',
+        )
+        .annotate(**aggregates)
+    )
+    if ids is None:
+        rows = grouped
+    else:
+        rows = (row for chunk in id_chunks(ids) for row in grouped.filter(pk__in=chunk))
+
+    categories = {}
+    subcategories = {}
+    bucket_counts = [0] * len(buckets)
+    total = in_stock = 0
+    for row in rows:
+        total += row['total']
+        in_stock += row['in_stock']
+        for i in range(len(buckets)):
+            bucket_counts[i] += row[f'price_{i}']
+
+        category = categories.setdefault(row['category_id'], {
+            'id': row['category_id'],
+            'slug': row['category__slug'],
+            'name': row['category__name'],
+            'count': 0,
+        })
+        category['count'] += row['total']
+        if row['subcategory_id'] is not None:
+            subcategory = subcategories.setdefault(row['subcategory_id'], {
+                'id': row['subcategory_id'],
+                'slug': row['subcategory__slug'],
+                'name': row['subcategory__name'],
+                'category_slug': row['category__slug'],
+                'count': 0,
+            })
+            subcategory['count'] += row['total']
+
+    def by_count(values):
+        return sorted(values, key=lambda facet: (-facet['count'], facet['name']))
+
+    return {
+        'total': total,
+        'in_stock': in_stock,
+        'categories': by_count(categories.values()),
+        'subcategories': by_count(subcategories.values()),
+        'price_buckets': [
+            {'min': low, 'max': high, 'count': count}
+            for (low, high), count in zip(buckets, bucket_counts)
+            if count
+        ],
+    }
+
+
+def facets_timeout():
+    return getattr(settings, 'SEARCH_FACETS_CACHE_TIMEOUT', 300)
+
+
+def get_facets(queryset, signature, ids=None):
+    """
+    Фасеты выборки из кеша; signature — подпись фильтров (search.query_signature),
+    ids — см. compute_facets. Запись привязана к версии каталога и устаревает
+    при изменении товаров.
+    """
+    key = f"facets:{catalog_version()}:{signature}"
+    facets = cache.get(key)
+    if facets is None:
+        facets = compute_facets(queryset, ids)
+        cache.set(key, facets, facets_timeout())
+    return facets
@@ -1,12 +1,14 @@
 # products/filters.py
 
 import django_filters
-from .models import Product, Category
+from .models import Product, Category, SubCategory
 
 class ProductFilter(django_filters.FilterSet):
     price_min = django_filters.NumberFilter(field_name='price', lookup_expr='gte', label='Цена от')
     price_max = django_filters.NumberFilter(field_name='price', lookup_expr='lte', label='Цена до')
     category = django_filters.ModelChoiceFilter(queryset=Category.objects.all(), label='Категория')
+    subcategory = django_filters.ModelChoiceFilter(queryset=SubCategory.objects.all(), label='Подкатегория')
+    in_stock = django_filters.BooleanFilter(method='filter_in_stock', label='В наличии')
 
     ordering = django_filters.OrderingFilter(
         choices=(
@@ -20,4 +22,9 @@ class ProductFilter(django_filters.FilterSet):
 
     class Meta:
         model = Product
-        fields = ['category', 'price_min', 'price_max']
+        fields = ['category', 'subcategory', 'price_min', 'price_max', 'in_stock']
+
+    def filter_in_stock(self, queryset, name, value):
+        if value:
+            return queryset.filter(stock__gt=0)
+        return queryset
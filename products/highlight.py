@@ -0,0 +1,133 @@
+# products/highlight.py
+"""
+Подсветка совпадений в результатах поиска.
+
+Работает не с HTML описания, а с его текстом (search.html_to_text):
+текст описания считается один раз на версию товара и кешируется, а в
+шаблон уходит короткий фрагмент вокруг первого совпадения. Все термы
+запроса ищутся одним скомпилированным регулярным выражением без учёта
+регистра (совпадение по префиксу слова, как и в поисковом индексе).
+Готовые фрагменты кешируются по (товар, термы запроса).
+
+Результат — уже экранированный HTML с тегами <mark>, его можно выводить
+в шаблоне без |safe.
+"""
+import hashlib
+import re
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from .search import html_to_text, tokenize
+
+
+def snippet_length():
+    return getattr(settings, 'SEARCH_SNIPPET_LENGTH', 160)
+
+
+def snippet_timeout():
+    return getattr(settings, 'SEARCH_SNIPPET_CACHE_TIMEOUT', 3600)
+
+
+def query_terms(query):
+    """Уникальные термы запроса; длинные идут первыми, чтобы побеждать в альтернации."""
+    return tuple(sorted(set(tokenize(query)), key=lambda term: (-len(term), term)))
+
+
+@lru_cache(maxsize=256)
+def compile_terms(terms):
+    """Одно регулярное выражение на запрос: начало слова + любой из термов."""
+    if not terms:
+        return None
+    # Термы нормализованы (ё -> е), а в тексте может стоять ё
+    alternatives = '|'.join(re.escape(term).replace('е', '[её]') for term in terms)
+    return re.compile(rf'(?<!\w)(?:{alternatives})\w*', re.IGNORECASE)
+
+
+def mark(text, pattern):
+    """Экранирует text и оборачивает совпадения pattern в <mark>."""
+    if pattern is None:
+        return escape(text)
+    parts = []
+    position = 0
+    for match in pattern.finditer(text):
+        parts.append(escape(text[position:match.start()]))
+        parts.append(f'<mark>{escape(match.group())}</mark>')
+        position = match.end()
+    parts.append(escape(text[position:]))
+    return mark_safe(''.join(parts))
+
+
+def snippet_window(text, pattern, length):
+    """Фрагмент текста длиной не больше length символов вокруг первого совпадения."""
+    if len(text) <= length:
+        return text
+    match = pattern.search(text) if pattern is not None else None
+    start = 0
+    if match is not None:
+        # Совпадение ближе к началу фрагмента, но с небольшим контекстом слева
+        start = max(0, min(match.start() - length // 4, len(text) - length))
+        if start:
+            space = text.find(' ', start)
+            if space != -1 and space < match.start():
+                start = space + 1
+    end = start + length
+    if end < len(text):
+        space = text.rfind(' ', start, end)
+        if space > start:
+            end = space
+    fragment = text[start:end]
+    return f"{'… ' if start else ''}{fragment}{' …' if end < len(text) else ''}"
+
+
+def _version(product):
+    return product.updated_at.timestamp() if product.updated_at else 0
+
+
+def _text_key(product):
+    return f"product_text:{product.pk}:{_version(product)}"
+
+
+def _snippet_key(product, terms_digest):
+    return f"search_snippet:{product.pk}:{_version(product)}:{terms_digest}"
+
+
+def highlight_products(products, query):
+    """
+    Добавляет товарам highlighted_name и highlighted_description.
+    Фрагменты и тексты описаний берутся из кеша пачкой (get_many); HTML
+    описания разбирается только для товаров, которых ещё нет в кеше.
+    """
+    products = list(products)
+    terms = query_terms(query)
+    pattern = compile_terms(terms)
+    digest = hashlib.sha1(' '.join(terms).encode('utf-8')).hexdigest()
+    length = snippet_length()
+
+    snippet_keys = {product.pk: _snippet_key(product, digest) for product in products}
+    snippets = cache.get_many(snippet_keys.values())
+    missing = [product for product in products if snippet_keys[product.pk] not in snippets]
+
+    if missing:
+        text_keys = {product.pk: _text_key(product) for product in missing}
+        texts = cache.get_many(text_keys.values())
+        new_texts = {}
+        new_snippets = {}
+        for product in missing:
+            key = text_keys[product.pk]
+            text = texts.get(key)
+            if text is None:
+                text = new_texts[key] = html_to_text(product.description)
+            snippet = mark(snippet_window(text, pattern, length), pattern)
+            snippets[snippet_keys[product.pk]] = new_snippets[snippet_keys[product.pk]] = snippet
+        if new_texts:
+            cache.set_many(new_texts, snippet_timeout())
+        cache.set_many(new_snippets, snippet_timeout())
+
+    for product in products:
+        product.highlighted_name = mark(product.name, pattern)
+        product.highlighted_description = mark_safe(snippets[snippet_keys[product.pk]])
+    return products
@@ -0,0 +1,105 @@
+# products/lifecycle.py
+"""
+Жизненный цикл заказа.
+
+Допустимые переходы статусов — TRANSITIONS. Статус меняется через
+transition_orders() (или Order.objects.filter(...).transition(status)),
+каждая смена пишется в журнал OrderStatusEvent.
+
+transition_orders() рассчитан на тысячи заказов за раз:
+
+1. один SELECT ... FOR UPDATE (id, user_id, status) выбранных заказов;
+2. проверка всей пачки: если хоть один заказ нельзя перевести, бросается
+   InvalidTransitionError и ничего не меняется;
+3. UPDATE пачками по chunk_size отдельно для каждого исходного статуса,
+   теми же пачками обновляются строки истории заказов;
+4. один bulk_create событий журнала;
+5. при отмене — пересчёт сводок пользователей пачками (отменённые заказы
+   не входят в сумму покупок); версии истории затронутых пользователей
+   увеличиваются.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import QuerySet
+from django.utils import timezone
+
+from .models import Order, OrderHistoryEntry, OrderStatusEvent
+from .orders import CANCELLED, bump_history_version, refresh_user_summaries
+
+PROCESSING = 'processing'
+SHIPPED = 'shipped'
+DELIVERED = 'delivered'
+
+TRANSITIONS = {
+    PROCESSING: {SHIPPED, CANCELLED},
+    SHIPPED: {DELIVERED, CANCELLED},
+    DELIVERED: set(),
+    CANCELLED: set(),
+}
+
+
+class InvalidTransitionError(Exception):
+    """Часть заказов нельзя перевести в status; invalid — [(order_id, текущий статус), ...]."""
+
+    def __init__(self, status, invalid):
+        self.status = status
+        self.invalid = invalid
+        orders = ', '.join(f'№{pk} ({current})' for pk, current in invalid[:20])
+        more = f' и ещё {len(invalid) - 20}' if len(invalid) > 20 else ''
+        super().__init__(f"Нельзя перевести в статус {status}: {orders}{more}")
+
+
+def can_transition(current, status):
+    return status in TRANSITIONS.get(current, ())
+
+
+def transition_orders(orders, status, actor=None, note='', chunk_size=None):
+    """
+    Переводит заказы (QuerySet или список id) в статус status. Заказы, уже
+    находящиеся в этом статусе, пропускаются. Возвращает число переведённых.
+    """
+    if status not in TRANSITIONS:
+        raise ValueError(f"Неизвестный статус: {status}")
+    chunk_size = chunk_size or getattr(settings, 'ORDER_TRANSITION_CHUNK_SIZE', 500)
+    if not isinstance(orders, QuerySet):
+        orders = Order.objects.filter(pk__in=list(orders))
+
+    with transaction.atomic():
+        rows = list(orders.select_for_update().order_by('pk').values_list('pk', 'user_id', 'status'))
+        invalid = [
+            (pk, current) for pk, _, current in rows
+            if current != status and not can_transition(current, status)
+        ]
+        if invalid:
+            raise InvalidTransitionError(status, invalid)
+        moving = [(pk, user_id, current) for pk, user_id, current in rows if current != status]
+        if not moving:
+            return 0
+
+        by_status = {}
+        for pk, _, current in moving:
+            by_status.setdefault(current, []).append(pk)
+        for current, ids in by_status.items():
+            for start in range(0, len(ids), chunk_size):
+                chunk = ids[start:start + chunk_size]
+                Order.objects.filter(pk__in=chunk, status=current).update(status=status)
+                OrderHistoryEntry.objects.filter(order_id__in=chunk).update(status=status)
+
+        now = timezone.now()
+        OrderStatusEvent.objects.bulk_create(
+            [
+                OrderStatusEvent(
+                    order_id=pk, from_status=current, to_status=status,
+                    actor=actor, note=note, created_at=now,
+                )
+                for pk, _, current in moving
+            ]
+        )
+
+        user_ids = sorted({user_id for _, user_id, _ in moving})
+        if status == CANCELLED:
+            for start in range(0, len(user_ids), chunk_size):
+                refresh_user_summaries(user_ids[start:start + chunk_size])
+        for user_id in user_ids:
+            bump_history_version(user_id)
+    return len(moving)
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from products.orders import rebuild_order_totals
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает Order.total_amount, сводки заказов пользователей и историю заказов"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help="Сколько пользователей (и заказов для истории) пересчитывать за один запрос",
+        )
+
+    def handle(self, *args, **options):
+        orders, summaries, entries = rebuild_order_totals(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Пересчитано заказов: {orders}, сводок пользователей: {summaries}, строк истории: {entries}"
+        ))
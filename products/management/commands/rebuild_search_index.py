@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from products.search import get_search_backend, rebuild_documents
+
+
+class Command(BaseCommand):
+    help = "Пересобирает поисковые документы товаров и полностью перестраивает поисковый индекс"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help="Сколько товаров обрабатывать за один bulk-запрос",
+        )
+        parser.add_argument(
+            '--skip-documents', action='store_true',
+            help="Не пересобирать ProductSearchDocument, только индекс",
+        )
+
+    def handle(self, *args, **options):
+        if not options['skip_documents']:
+            count = rebuild_documents(chunk_size=options['chunk_size'])
+            self.stdout.write(f"Поисковых документов пересобрано: {count}")
+        backend = get_search_backend()
+        backend.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Поисковый индекс ({backend.name}) перестроен"))
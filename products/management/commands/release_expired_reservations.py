@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from products.reservations import release_expired
+
+
+class Command(BaseCommand):
+    help = "Снимает истёкшие резервы товаров в корзинах (запускать по cron раз в минуту)"
+
+    def handle(self, *args, **options):
+        released = release_expired()
+        self.stdout.write(self.style.SUCCESS(f"Снято истёкших резервов: {released}"))
@@ -0,0 +1,49 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Avg, Count, Max, Q
+from django.utils import timezone
+
+from products.analytics import search_query_log
+from products.models import SearchQueryLog
+
+
+class Command(BaseCommand):
+    help = "Отчёт по поисковым запросам: популярные, самые медленные и без результатов"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7, help="За сколько последних дней")
+        parser.add_argument('--limit', type=int, default=20, help="Строк в каждом разделе")
+
+    def handle(self, *args, **options):
+        # Не забываем то, что ещё лежит в буфере этого процесса
+        search_query_log.flush()
+        limit = options['limit']
+        logs = SearchQueryLog.objects.since(timezone.now() - timedelta(days=options['days']))
+        by_query = logs.values('query').annotate(
+            total=Count('id'),
+            zero=Count('id', filter=Q(results_count=0)),
+            hits=Count('id', filter=Q(cache_hit=True)),
+            avg_latency=Avg('latency_ms'),
+            max_latency=Max('latency_ms'),
+        )
+
+        self.stdout.write(self.style.MIGRATE_HEADING(f"Всего запросов: {logs.count()}"))
+
+        self.stdout.write(self.style.MIGRATE_HEADING("Популярные запросы"))
+        for row in by_query.order_by('-total', 'query')[:limit]:
+            self.stdout.write(
+                f"{row['total']:>7}  {row['query']}  "
+                f"(из кеша {row['hits'] * 100 // row['total']}%, в среднем {row['avg_latency']:.1f} мс)"
+            )
+
+        self.stdout.write(self.style.MIGRATE_HEADING("Самые медленные запросы"))
+        for row in by_query.order_by('-avg_latency', 'query')[:limit]:
+            self.stdout.write(
+                f"{row['avg_latency']:>8.1f} мс  {row['query']}  "
+                f"(макс. {row['max_latency']:.1f} мс, {row['total']} раз)"
+            )
+
+        self.stdout.write(self.style.MIGRATE_HEADING("Запросы без результатов"))
+        for row in by_query.filter(zero__gt=0).order_by('-zero', 'query')[:limit]:
+            self.stdout.write(f"{row['zero']:>7}  {row['query']}")
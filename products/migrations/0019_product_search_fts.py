@@ -0,0 +1,56 @@
+# Полнотекстовый индекс товаров на SQLite FTS5 (см. products/search.py)
+
+from html import unescape
+
+from django.db import migrations
+from django.utils.html import strip_tags
+
+FTS_TABLE = 'products_product_fts'
+
+
+def fts5_available(connection):
+    if connection.vendor != 'sqlite':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA compile_options')
+        return any(row[0] == 'ENABLE_FTS5' for row in cursor.fetchall())
+
+
+def create_fts_table(apps, schema_editor):
+    connection = schema_editor.connection
+    if not fts5_available(connection):
+        # Без FTS5 используется индекс в памяти процесса
+        return
+    Product = apps.get_model('products', 'Product')
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} "
+            f"USING fts5(name, description, category, tokenize='unicode61 remove_diacritics 2')"
+        )
+        rows = [
+            (p.id, p.name, ' '.join(unescape(strip_tags(p.description or '')).split()), p.category.name)
+            for p in Product.objects.select_related('category').iterator()
+        ]
+        cursor.executemany(
+            f'INSERT INTO {FTS_TABLE} (rowid, name, description, category) VALUES (%s, %s, %s, %s)',
+            rows,
+        )
+
+
+def drop_fts_table(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0018_alter_category_slug_alter_subcategory_slug_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts_table, drop_fts_table),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.1.15 on 2026-10-18 11:57
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill_subcategory(apps, schema_editor):
+    # Раньше страница подкатегории показывала все товары категории. Товар
+    # однозначно относится к подкатегории, только если она в категории одна;
+    # остальные остаются без подкатегории — они видны на странице категории,
+    # а в подкатегории их разносят в админке (фильтр "Подкатегория: Пусто")
+    Category = apps.get_model('products', 'Category')
+    Product = apps.get_model('products', 'Product')
+    single = (
+        Category.objects.annotate(n=Count('subcategories'))
+        .filter(n=1)
+        .values_list('pk', 'subcategories')
+    )
+    for category_id, subcategory_id in single:
+        Product.objects.filter(category_id=category_id, subcategory__isnull=True).update(subcategory_id=subcategory_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0019_product_search_fts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='subcategory',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='products', to='products.subcategory', verbose_name='Подкатегория'),
+        ),
+        migrations.RunPython(backfill_subcategory, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,80 @@
+# Generated by Django 5.1.15 on 2026-10-18 12:00
+
+import unicodedata
+from html import unescape
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils.html import strip_tags
+
+FTS_TABLE = 'products_product_fts'
+
+
+def fold(text):
+    # Копия products.search.fold на момент миграции
+    if not text:
+        return ''
+    chars = []
+    base = ''
+    for ch in unicodedata.normalize('NFKD', text.lower()):
+        if unicodedata.combining(ch):
+            if base < '\u0250':
+                continue
+        else:
+            base = ch
+        chars.append(ch)
+    return unicodedata.normalize('NFC', ''.join(chars)).replace('ё', 'е')
+
+
+def build_documents(apps, schema_editor):
+    Product = apps.get_model('products', 'Product')
+    ProductSearchDocument = apps.get_model('products', 'ProductSearchDocument')
+    documents = [
+        ProductSearchDocument(
+            product_id=p.id,
+            name=fold(p.name),
+            description=fold(' '.join(unescape(strip_tags(p.description or '')).split())),
+            category=fold(p.category.name),
+            subcategory=fold(p.subcategory.name) if p.subcategory_id else '',
+        )
+        for p in Product.objects.select_related('category', 'subcategory').iterator()
+    ]
+    ProductSearchDocument.objects.bulk_create(documents, batch_size=1000)
+
+    # FTS-индекс теперь строится из нормализованных документов
+    connection = schema_editor.connection
+    if FTS_TABLE not in connection.introspection.table_names():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE}')
+        cursor.execute(
+            f'INSERT INTO {FTS_TABLE} (rowid, name, description, category) '
+            f"SELECT product_id, name, description, TRIM(category || ' ' || subcategory) "
+            f'FROM {ProductSearchDocument._meta.db_table}'
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0020_product_subcategory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSearchDocument',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_document', serialize=False, to='products.product', verbose_name='Товар')),
+                ('name', models.TextField(verbose_name='Название')),
+                ('description', models.TextField(blank=True, verbose_name='Описание')),
+                ('category', models.CharField(blank=True, max_length=255, verbose_name='Категория')),
+                ('subcategory', models.CharField(blank=True, max_length=255, verbose_name='Подкатегория')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата обновления')),
+            ],
+            options={
+                'verbose_name': 'Поисковый документ',
+                'verbose_name_plural': 'Поисковые документы',
+            },
+        ),
+        migrations.RunPython(build_documents, migrations.RunPython.noop),
+    ]
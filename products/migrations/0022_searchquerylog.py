@@ -0,0 +1,30 @@
+# Generated by Django 5.1.15 on 2026-10-18 12:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0021_productsearchdocument'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchQueryLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('query', models.CharField(max_length=255, verbose_name='Запрос')),
+                ('filters', models.JSONField(blank=True, default=dict, verbose_name='Фильтры')),
+                ('results_count', models.PositiveIntegerField(verbose_name='Найдено')),
+                ('latency_ms', models.FloatField(verbose_name='Время ответа, мс')),
+                ('cache_hit', models.BooleanField(default=False, verbose_name='Из кеша')),
+                ('created_at', models.DateTimeField(verbose_name='Дата запроса')),
+            ],
+            options={
+                'verbose_name': 'Поисковый запрос',
+                'verbose_name_plural': 'Поисковые запросы',
+                'indexes': [models.Index(fields=['created_at'], name='products_se_created_ea979b_idx'), models.Index(fields=['query', 'created_at'], name='products_se_query_709a72_idx')],
+            },
+        ),
+    ]
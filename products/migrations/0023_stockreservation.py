@@ -0,0 +1,30 @@
+# Generated by Django 5.1.15 on 2026-10-18 12:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0022_searchquerylog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockReservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('holder', models.CharField(max_length=64, verbose_name='Корзина')),
+                ('quantity', models.PositiveIntegerField(verbose_name='Количество')),
+                ('expires_at', models.DateTimeField(verbose_name='Действует до')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='products.product', verbose_name='Товар')),
+            ],
+            options={
+                'verbose_name': 'Резерв товара',
+                'verbose_name_plural': 'Резервы товаров',
+                'indexes': [models.Index(fields=['expires_at'], name='products_st_expires_817182_idx'), models.Index(fields=['product', 'expires_at'], name='products_st_product_db2e26_idx')],
+                'constraints': [models.UniqueConstraint(fields=('product', 'holder'), name='unique_reservation_per_holder')],
+            },
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.1.15 on 2026-10-18 12:10
+
+from decimal import Decimal
+
+from django.db import migrations, models
+
+# Курсы, которые раньше были зашиты в Cart.__iter__ и CartItem.price_converted
+INITIAL_RATES = [
+    ('MDL', 'Молдавские леи', 'L', Decimal('1')),
+    ('EUR', 'Евро', '€', Decimal('0.048')),
+    ('USD', 'Доллар США', '$', Decimal('0.056')),
+]
+
+
+def seed_rates(apps, schema_editor):
+    ExchangeRate = apps.get_model('products', 'ExchangeRate')
+    ExchangeRate.objects.bulk_create([
+        ExchangeRate(code=code, name=name, symbol=symbol, rate=rate)
+        for code, name, symbol, rate in INITIAL_RATES
+    ], ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0024_usercart_cartline'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExchangeRate',
+            fields=[
+                ('code', models.CharField(max_length=3, primary_key=True, serialize=False, verbose_name='Код')),
+                ('name', models.CharField(max_length=50, verbose_name='Название')),
+                ('symbol', models.CharField(max_length=5, verbose_name='Символ')),
+                ('rate', models.DecimalField(decimal_places=6, max_digits=14, verbose_name='Курс')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлён')),
+            ],
+            options={
+                'verbose_name': 'Курс валюты',
+                'verbose_name_plural': 'Курсы валют',
+                'ordering': ['code'],
+            },
+        ),
+        migrations.RunPython(seed_rates, migrations.RunPython.noop),
+    ]
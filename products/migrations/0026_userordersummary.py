@@ -0,0 +1,69 @@
+# Generated by Django 5.1.15 on 2026-10-18 12:16
+
+import django.db.models.deletion
+from django.conf import settings
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import Count, F, Max, Q, Sum
+
+
+def backfill_totals(apps, schema_editor):
+    # То же, что products.orders.rebuild_order_totals, на исторических моделях
+    Order = apps.get_model('products', 'Order')
+    OrderItem = apps.get_model('products', 'OrderItem')
+    UserOrderSummary = apps.get_model('products', 'UserOrderSummary')
+
+    totals = dict(
+        OrderItem.objects.order_by().values('order_id')
+        .annotate(total=Sum(F('price') * F('quantity')))
+        .values_list('order_id', 'total')
+    )
+    orders = list(Order.objects.only('pk', 'total_amount'))
+    for order in orders:
+        order.total_amount = totals.get(order.pk) or Decimal('0')
+    Order.objects.bulk_update(orders, ['total_amount'], batch_size=500)
+
+    rows = (
+        Order.objects.order_by().values('user_id')
+        .annotate(
+            orders_count=Count('pk'),
+            total_spent=Sum('total_amount', filter=~Q(status='cancelled')),
+            last_order_at=Max('created_at'),
+        )
+    )
+    UserOrderSummary.objects.bulk_create([
+        UserOrderSummary(
+            user_id=row['user_id'],
+            orders_count=row['orders_count'],
+            total_spent=row['total_spent'] or Decimal('0'),
+            last_order_at=row['last_order_at'],
+        )
+        for row in rows
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('products', '0025_exchangerate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserOrderSummary',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='order_summary', serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+                ('orders_count', models.PositiveIntegerField(default=0, verbose_name='Количество заказов')),
+                ('total_spent', models.DecimalField(decimal_places=2, default=0, max_digits=12, verbose_name='Общая сумма покупок')),
+                ('last_order_at', models.DateTimeField(blank=True, null=True, verbose_name='Последний заказ')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлено')),
+            ],
+            options={
+                'verbose_name': 'Сводка заказов пользователя',
+                'verbose_name_plural': 'Сводки заказов пользователей',
+            },
+        ),
+        migrations.RunPython(backfill_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.1.15 on 2026-10-18 12:17
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_history(apps, schema_editor):
+    # То же, что products.orders.materialize_history, на исторических моделях
+    Order = apps.get_model('products', 'Order')
+    OrderItem = apps.get_model('products', 'OrderItem')
+    OrderHistoryEntry = apps.get_model('products', 'OrderHistoryEntry')
+
+    items = {}
+    rows = OrderItem.objects.order_by('pk').values_list('order_id', 'product__name', 'quantity', 'price')
+    for order_id, name, quantity, price in rows:
+        items.setdefault(order_id, []).append({'name': name, 'quantity': quantity, 'price': str(price)})
+    OrderHistoryEntry.objects.bulk_create([
+        OrderHistoryEntry(
+            order_id=order.pk,
+            user_id=order.user_id,
+            created_at=order.created_at,
+            status=order.status,
+            total_amount=order.total_amount,
+            address=f'{order.address}, {order.postal_code}, {order.city}',
+            items=items.get(order.pk, []),
+        )
+        for order in Order.objects.iterator()
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0026_userordersummary'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderHistoryEntry',
+            fields=[
+                ('order', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='history_entry', serialize=False, to='products.order', verbose_name='Заказ')),
+                ('created_at', models.DateTimeField(verbose_name='Дата создания')),
+                ('status', models.CharField(choices=[('processing', 'В обработке'), ('shipped', 'Отправлено'), ('delivered', 'Доставлено'), ('cancelled', 'Отменено')], max_length=20, verbose_name='Статус')),
+                ('total_amount', models.DecimalField(decimal_places=2, default=0, max_digits=10, verbose_name='Общая сумма')),
+                ('address', models.CharField(blank=True, max_length=400, verbose_name='Адрес доставки')),
+                ('items', models.JSONField(blank=True, default=list, verbose_name='Позиции')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='order_history', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Строка истории заказов',
+                'verbose_name_plural': 'История заказов',
+                'indexes': [models.Index(fields=['user', '-created_at', '-order'], name='products_or_user_id_bd9346_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_history, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.1.15 on 2026-10-18 12:20
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0027_orderhistoryentry'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderStatusEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('from_status', models.CharField(choices=[('processing', 'В обработке'), ('shipped', 'Отправлено'), ('delivered', 'Доставлено'), ('cancelled', 'Отменено')], max_length=20, verbose_name='Был статус')),
+                ('to_status', models.CharField(choices=[('processing', 'В обработке'), ('shipped', 'Отправлено'), ('delivered', 'Доставлено'), ('cancelled', 'Отменено')], max_length=20, verbose_name='Новый статус')),
+                ('note', models.CharField(blank=True, max_length=255, verbose_name='Комментарий')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Дата')),
+                ('actor', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Кто изменил')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='status_events', to='products.order', verbose_name='Заказ')),
+            ],
+            options={
+                'verbose_name': 'Смена статуса заказа',
+                'verbose_name_plural': 'Журнал статусов заказов',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['order', 'created_at'], name='products_or_order_i_fc9341_idx'), models.Index(fields=['to_status', 'created_at'], name='products_or_to_stat_bebd04_idx')],
+            },
+        ),
+    ]
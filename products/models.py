@@ -1,7 +1,9 @@
 from autoslug import AutoSlugField
+from django.core.exceptions import ValidationError
 from django.db import models
 from django.contrib.auth.models import User
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.text import slugify
 from django_ckeditor_5.fields import CKEditor5Field
 from imagekit.models.fields import ImageSpecField
@@ -178,6 +180,14 @@ class Product(models.Model):
         related_name='products',
         verbose_name="Категория"
     )
+    subcategory = models.ForeignKey(
+        SubCategory,
+        on_delete=models.SET_NULL,
+        related_name='products',
+        null=True,
+        blank=True,
+        verbose_name="Подкатегория"
+    )
     description = CKEditor5Field(verbose_name="Описание")
     price = models.DecimalField(max_digits=10, decimal_places=2, verbose_name="Цена", db_index=True)
     image = models.ImageField(upload_to='products/', verbose_name="Изображение")
@@ -203,6 +213,11 @@ class Product(models.Model):
     def __str__(self):
         return self.name
 
+    def clean(self):
+        super().clean()
+        if self.subcategory_id and self.category_id and self.subcategory.category_id != self.category_id:
+            raise ValidationError({'subcategory': "Подкатегория должна относиться к категории товара."})
+
     def save(self, *args, **kwargs):
         if not self.slug:
             original_slug = slugify(self.name)
@@ -217,6 +232,91 @@ class Product(models.Model):
         super().save(*args, **kwargs)
 
 
+# ----------------------------------------------------------------------
+# ProductSearchDocument
+# ----------------------------------------------------------------------
+
+class ProductSearchDocument(models.Model):
+    """
+    Денормализованный поисковый документ товара: название, текст описания
+    без HTML, названия категории и подкатегории — в нижнем регистре и без
+    диакритики (products.search.fold). Поддерживается сигналами.
+    """
+    product = models.OneToOneField(
+        Product,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='search_document',
+        verbose_name='Товар'
+    )
+    name = models.TextField(verbose_name='Название')
+    description = models.TextField(blank=True, verbose_name='Описание')
+    category = models.CharField(max_length=255, blank=True, verbose_name='Категория')
+    subcategory = models.CharField(max_length=255, blank=True, verbose_name='Подкатегория')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата обновления')
+
+    class Meta:
+        verbose_name = 'Поисковый документ'
+        verbose_name_plural = 'Поисковые документы'
+
+    def __str__(self):
+        return self.name
+
+    def index_fields(self):
+        """Поля для поискового индекса (подкатегория ищется вместе с категорией)."""
+        return {
+            'name': self.name,
+            'description': self.description,
+            'category': f"{self.category} {self.subcategory}".strip(),
+        }
+
+
+# ----------------------------------------------------------------------
+# SearchQueryLog
+# ----------------------------------------------------------------------
+
+class SearchQueryLogQuerySet(models.QuerySet):
+    def zero_results(self):
+        return self.filter(results_count=0)
+
+    def since(self, moment):
+        return self.filter(created_at__gte=moment)
+
+
+class SearchQueryLogManager(models.Manager):
+    def get_queryset(self):
+        return SearchQueryLogQuerySet(self.model, using=self._db)
+
+    def zero_results(self):
+        return self.get_queryset().zero_results()
+
+    def since(self, moment):
+        return self.get_queryset().since(moment)
+
+
+class SearchQueryLog(models.Model):
+    """Запрос к product_search (пишется пачками, см. products/analytics.py)."""
+    query = models.CharField(max_length=255, verbose_name='Запрос')
+    filters = models.JSONField(default=dict, blank=True, verbose_name='Фильтры')
+    results_count = models.PositiveIntegerField(verbose_name='Найдено')
+    latency_ms = models.FloatField(verbose_name='Время ответа, мс')
+    cache_hit = models.BooleanField(default=False, verbose_name='Из кеша')
+    created_at = models.DateTimeField(verbose_name='Дата запроса')
+
+    objects = SearchQueryLogManager()
+
+    class Meta:
+        verbose_name = 'Поисковый запрос'
+        verbose_name_plural = 'Поисковые запросы'
+        indexes = [
+            models.Index(fields=['created_at']),
+            models.Index(fields=['query', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f'{self.query} ({self.results_count})'
+
+
 # ----------------------------------------------------------------------
 # Order
 # ----------------------------------------------------------------------
@@ -235,6 +335,11 @@ class OrderQuerySet(models.QuerySet):
         # prefetch_related -> items + подгрузка product
         return self.prefetch_related('items__product').select_related('user')
 
+    def transition(self, status, actor=None, note=''):
+        """Переводит заказы выборки в статус status (см. products/lifecycle.py)."""
+        from .lifecycle import transition_orders
+        return transition_orders(self, status, actor=actor, note=note)
+
 
 class OrderManager(models.Manager):
     def get_queryset(self):
@@ -302,7 +407,8 @@ class Order(models.Model):
         return f'Заказ {self.id} от {self.user.username}'
 
     def get_total_cost(self):
-        return sum(item.get_cost() for item in self.items.all())
+        # total_amount поддерживается при записи заказа и позиций (products/orders.py)
+        return self.total_amount
 
     def get_absolute_url(self):
         return reverse('orders:order_detail', args=[str(self.id)])
@@ -346,6 +452,177 @@ class OrderItem(models.Model):
         return f'{self.quantity} x {self.product.name}'
 
 
+# ----------------------------------------------------------------------
+# OrderStatusEvent
+# ----------------------------------------------------------------------
+
+class OrderStatusEvent(models.Model):
+    """Смена статуса заказа (журнал только пополняется, см. products/lifecycle.py)."""
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='status_events', verbose_name='Заказ')
+    from_status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES, verbose_name='Был статус')
+    to_status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES, verbose_name='Новый статус')
+    actor = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+',
+        verbose_name='Кто изменил'
+    )
+    note = models.CharField(max_length=255, blank=True, verbose_name='Комментарий')
+    created_at = models.DateTimeField(default=timezone.now, verbose_name='Дата')
+
+    class Meta:
+        verbose_name = 'Смена статуса заказа'
+        verbose_name_plural = 'Журнал статусов заказов'
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['order', 'created_at']),
+            models.Index(fields=['to_status', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f'Заказ {self.order_id}: {self.from_status} -> {self.to_status}'
+
+
+# ----------------------------------------------------------------------
+# OrderHistoryEntry
+# ----------------------------------------------------------------------
+
+class OrderHistoryEntry(models.Model):
+    """
+    Строка истории заказов пользователя: всё, что показывает страница
+    истории, в одной строке — позиции хранятся списком
+    [{'name', 'quantity', 'price'}]. Заполняется при оформлении заказа и
+    обновляется при изменении заказа и позиций (products/orders.py).
+    """
+    STATUS_COLORS = {
+        'processing': 'warning',
+        'shipped': 'info',
+        'delivered': 'success',
+        'cancelled': 'secondary',
+    }
+
+    order = models.OneToOneField(
+        Order,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='history_entry',
+        verbose_name='Заказ'
+    )
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='order_history', verbose_name='Пользователь')
+    created_at = models.DateTimeField(verbose_name='Дата создания')
+    status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES, verbose_name='Статус')
+    total_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0, verbose_name='Общая сумма')
+    address = models.CharField(max_length=400, blank=True, verbose_name='Адрес доставки')
+    items = models.JSONField(default=list, blank=True, verbose_name='Позиции')
+
+    class Meta:
+        verbose_name = 'Строка истории заказов'
+        verbose_name_plural = 'История заказов'
+        indexes = [
+            models.Index(fields=['user', '-created_at', '-order']),
+        ]
+
+    def __str__(self):
+        return f'Заказ {self.order_id}'
+
+    @property
+    def status_color(self):
+        return self.STATUS_COLORS.get(self.status, 'secondary')
+
+
+# ----------------------------------------------------------------------
+# UserOrderSummary
+# ----------------------------------------------------------------------
+
+class UserOrderSummary(models.Model):
+    """
+    Сводка заказов пользователя: пересчитывается при записи заказов и
+    позиций (products/orders.py), чтобы админка и профиль не агрегировали
+    заказы на каждый показ.
+    """
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='order_summary',
+        verbose_name='Пользователь'
+    )
+    orders_count = models.PositiveIntegerField(default=0, verbose_name='Количество заказов')
+    total_spent = models.DecimalField(max_digits=12, decimal_places=2, default=0, verbose_name='Общая сумма покупок')
+    last_order_at = models.DateTimeField(null=True, blank=True, verbose_name='Последний заказ')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Обновлено')
+
+    class Meta:
+        verbose_name = 'Сводка заказов пользователя'
+        verbose_name_plural = 'Сводки заказов пользователей'
+
+    def __str__(self):
+        return f'{self.user_id}: {self.orders_count} / {self.total_spent}'
+
+
+# ----------------------------------------------------------------------
+# StockReservation
+# ----------------------------------------------------------------------
+
+class StockReservationQuerySet(models.QuerySet):
+    def active(self, now=None):
+        return self.filter(expires_at__gt=now or timezone.now())
+
+    def expired(self, now=None):
+        return self.filter(expires_at__lte=now or timezone.now())
+
+    def for_holder(self, holder):
+        return self.filter(holder=holder)
+
+
+class StockReservationManager(models.Manager):
+    def get_queryset(self):
+        return StockReservationQuerySet(self.model, using=self._db)
+
+    def active(self, now=None):
+        return self.get_queryset().active(now)
+
+    def expired(self, now=None):
+        return self.get_queryset().expired(now)
+
+    def for_holder(self, holder):
+        return self.get_queryset().for_holder(holder)
+
+
+class StockReservation(models.Model):
+    """
+    Резерв товара под корзину до expires_at (см. products/reservations.py).
+    holder — токен корзины из сессии, он переживает смену ключа сессии при входе.
+    """
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name='reservations',
+        verbose_name='Товар'
+    )
+    holder = models.CharField(max_length=64, verbose_name='Корзина')
+    quantity = models.PositiveIntegerField(verbose_name='Количество')
+    expires_at = models.DateTimeField(verbose_name='Действует до')
+
+    objects = StockReservationManager()
+
+    class Meta:
+        verbose_name = 'Резерв товара'
+        verbose_name_plural = 'Резервы товаров'
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'holder'], name='unique_reservation_per_holder'),
+        ]
+        indexes = [
+            models.Index(fields=['expires_at']),
+            models.Index(fields=['product', 'expires_at']),
+        ]
+
+    def __str__(self):
+        return f'{self.quantity} x {self.product_id} ({self.holder})'
+
+
 # ----------------------------------------------------------------------
 # Review
 # ----------------------------------------------------------------------
@@ -455,6 +732,98 @@ class Wishlist(models.Model):
         ordering = ['-added_at']
 
 
+# ----------------------------------------------------------------------
+# UserCart / CartLine (корзина авторизованного пользователя)
+# ----------------------------------------------------------------------
+
+class UserCart(models.Model):
+    """
+    Серверная корзина пользователя. items_count и total — денормализованная
+    сводка по строкам, чтобы значок в шапке не загружал строки корзины.
+    """
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        related_name='cart',
+        verbose_name='Пользователь'
+    )
+    items_count = models.PositiveIntegerField(default=0, verbose_name='Количество товаров')
+    total = models.DecimalField(max_digits=12, decimal_places=2, default=0, verbose_name='Сумма')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата обновления')
+
+    class Meta:
+        verbose_name = 'Корзина'
+        verbose_name_plural = 'Корзины'
+
+    def __str__(self):
+        return f'Корзина {self.user_id}'
+
+
+class CartLineQuerySet(models.QuerySet):
+    def for_user(self, user):
+        return self.filter(cart__user=user)
+
+    def with_product(self):
+        return self.select_related('product', 'product__category')
+
+
+class CartLineManager(models.Manager):
+    def get_queryset(self):
+        return CartLineQuerySet(self.model, using=self._db)
+
+    def for_user(self, user):
+        return self.get_queryset().for_user(user)
+
+
+class CartLine(models.Model):
+    cart = models.ForeignKey(UserCart, on_delete=models.CASCADE, related_name='lines', verbose_name='Корзина')
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name='cart_lines',
+        verbose_name='Товар'
+    )
+    quantity = models.PositiveIntegerField(default=1, verbose_name='Количество')
+    price = models.DecimalField(max_digits=10, decimal_places=2, verbose_name='Цена')
+    added_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата добавления')
+
+    objects = CartLineManager()
+
+    class Meta:
+        verbose_name = 'Строка корзины'
+        verbose_name_plural = 'Строки корзины'
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product'], name='unique_cart_line'),
+        ]
+
+    def __str__(self):
+        return f'{self.quantity} x {self.product_id}'
+
+
+# ----------------------------------------------------------------------
+# ExchangeRate
+# ----------------------------------------------------------------------
+
+class ExchangeRate(models.Model):
+    """
+    Курс валюты к базовой (settings.BASE_CURRENCY): сколько единиц валюты
+    стоит одна единица базовой. Читается через products.currency.
+    """
+    code = models.CharField(max_length=3, primary_key=True, verbose_name='Код')
+    name = models.CharField(max_length=50, verbose_name='Название')
+    symbol = models.CharField(max_length=5, verbose_name='Символ')
+    rate = models.DecimalField(max_digits=14, decimal_places=6, verbose_name='Курс')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Обновлён')
+
+    class Meta:
+        verbose_name = 'Курс валюты'
+        verbose_name_plural = 'Курсы валют'
+        ordering = ['code']
+
+    def __str__(self):
+        return f'{self.code}: {self.rate}'
+
+
 # ----------------------------------------------------------------------
 # CartItem (не модель, менеджер не требуется)
 # ----------------------------------------------------------------------
@@ -464,13 +833,8 @@ class CartItem:
         self.quantity = quantity
 
     def price_converted(self, currency):
-        exchange_rates = {
-            'MDL': 1,
-            'USD': 0.056,
-            'EUR': 0.048,
-        }
-        rate = exchange_rates.get(currency, 1)
-        return self.product.price * rate
+        from .currency import convert
+        return convert(self.product.price, currency)
 
     def total_price_converted(self, currency):
         return self.price_converted(currency) * self.quantity
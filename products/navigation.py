@@ -0,0 +1,71 @@
+# products/navigation.py
+"""
+Дерево навигации каталога: категории -> подкатегории с количеством
+товаров и количеством товаров в наличии.
+
+Дерево строится двумя агрегирующими запросами и хранится в кеше как
+список словарей с готовыми URL, так что шаблонам не нужны ни запросы,
+ни reverse(). Ключ кеша привязан к версии каталога (search.catalog_version),
+которую сигналы Category/SubCategory/Product увеличивают при любом изменении,
+поэтому следующее чтение после изменения перестраивает дерево.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Q
+from django.urls import reverse
+
+from .search import catalog_version
+
+
+def navigation_timeout():
+    return getattr(settings, 'NAVIGATION_CACHE_TIMEOUT', 60 * 60)
+
+
+def build_navigation_tree():
+    from .models import Category, SubCategory
+
+    counts = {
+        'products_count': Count('products'),
+        'in_stock_count': Count('products', filter=Q(products__stock__gt=0)),
+    }
+    subcategories = {}
+    rows = (
+        SubCategory.objects.order_by('name')
+        .values('id', 'name', 'slug', 'icon', 'category_id', 'category__slug')
+        .annotate(**counts)
+    )
+    for row in rows:
+        subcategories.setdefault(row['category_id'], []).append({
+            'id': row['id'],
+            'name': row['name'],
+            'slug': row['slug'],
+            'icon': row['icon'] or '',
+            'url': reverse('products:subcategory_detail', args=[row['category__slug'], row['slug']]),
+            'products_count': row['products_count'],
+            'in_stock_count': row['in_stock_count'],
+        })
+
+    rows = Category.objects.order_by('name').values('id', 'name', 'slug', 'icon').annotate(**counts)
+    return [
+        {
+            'id': row['id'],
+            'name': row['name'],
+            'slug': row['slug'],
+            'icon': row['icon'],
+            'url': reverse('products:category_detail', args=[row['slug']]),
+            'products_count': row['products_count'],
+            'in_stock_count': row['in_stock_count'],
+            'subcategories': subcategories.get(row['id'], []),
+        }
+        for row in rows
+    ]
+
+
+def get_navigation_tree():
+    """Дерево навигации из кеша (перестраивается после изменений каталога)."""
+    key = f"navigation_tree:{catalog_version()}"
+    tree = cache.get(key)
+    if tree is None:
+        tree = build_navigation_tree()
+        cache.set(key, tree, navigation_timeout())
+    return tree
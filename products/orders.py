@@ -0,0 +1,206 @@
+# products/orders.py
+"""
+Хранимые итоги заказов.
+
+Order.total_amount — сумма позиций заказа (price * quantity), а
+UserOrderSummary — сводка заказов пользователя: количество заказов, сумма
+неотменённых заказов и дата последнего. Каждая величина пересчитывается
+одним запросом в той же транзакции, что и запись заказа или позиции
+(сигналы в products/signals.py). place_order() считает total_amount сам,
+вставляет позиции bulk_create'ом и сам дописывает их в строку истории.
+
+История заказов читается из OrderHistoryEntry — по строке на заказ с
+адресом, итогом и позициями (название, количество, цена), записанными при
+оформлении. Страница истории — один keyset-запрос по (user, created_at)
+без join'ов и prefetch, стоимость не зависит от числа заказов покупателя.
+Страницы кешируются по ключу с версией истории пользователя; любое
+изменение его заказа (статус, позиции, удаление) увеличивает версию.
+
+Если заказы менялись в обход ORM, всё пересчитывает команда
+rebuild_order_totals.
+"""
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, DecimalField, F, Max, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from .models import Order, OrderHistoryEntry, OrderItem, UserOrderSummary
+from .pagination import KeysetPaginator
+
+CANCELLED = 'cancelled'
+
+
+def items_total_subquery():
+    """Сумма позиций заказа OuterRef('pk') — для UPDATE/annotate."""
+    total = (
+        OrderItem.objects.filter(order=OuterRef('pk'))
+        .order_by()
+        .values('order')
+        .annotate(total=Sum(F('price') * F('quantity')))
+        .values('total')
+    )
+    output = DecimalField(max_digits=10, decimal_places=2)
+    return Coalesce(Subquery(total, output_field=output), Value(Decimal('0')), output_field=output)
+
+
+def refresh_order_totals(order_ids=None):
+    """Пересчитывает total_amount заказов (всех, если order_ids=None) одним UPDATE."""
+    orders = Order.objects.all()
+    if order_ids is not None:
+        orders = orders.filter(pk__in=order_ids)
+    return orders.update(total_amount=items_total_subquery())
+
+
+def refresh_user_summaries(user_ids):
+    """
+    Пересчитывает сводки пользователей user_ids одним агрегатом и одним
+    upsert; у пользователей без заказов сводка удаляется.
+    """
+    user_ids = set(user_ids)
+    if not user_ids:
+        return 0
+    rows = (
+        Order.objects.filter(user_id__in=user_ids)
+        .order_by()
+        .values('user_id')
+        .annotate(
+            orders_count=Count('pk'),
+            total_spent=Sum('total_amount', filter=~Q(status=CANCELLED)),
+            last_order_at=Max('created_at'),
+        )
+    )
+    summaries = [
+        UserOrderSummary(
+            user_id=row['user_id'],
+            orders_count=row['orders_count'],
+            total_spent=row['total_spent'] or Decimal('0'),
+            last_order_at=row['last_order_at'],
+        )
+        for row in rows
+    ]
+    UserOrderSummary.objects.bulk_create(
+        summaries,
+        update_conflicts=True,
+        unique_fields=['user'],
+        update_fields=['orders_count', 'total_spent', 'last_order_at', 'updated_at'],
+    )
+    without_orders = user_ids - {summary.user_id for summary in summaries}
+    if without_orders:
+        UserOrderSummary.objects.filter(user_id__in=without_orders).delete()
+    return len(summaries)
+
+
+# ----------------------------------------------------------------------
+# История заказов
+# ----------------------------------------------------------------------
+
+def history_version_key(user_id):
+    return f'order_history_version:{user_id}'
+
+
+def history_version(user_id):
+    key = history_version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, 1, None)
+        version = cache.get(key, 1)
+    return version
+
+
+def bump_history_version(user_id):
+    """
+    Делает закешированные страницы истории пользователя недостижимыми —
+    сразу и ещё раз после коммита, чтобы параллельный запрос не закешировал
+    под новой версией данные до коммита.
+    """
+    def bump():
+        try:
+            cache.incr(history_version_key(user_id))
+        except ValueError:
+            cache.set(history_version_key(user_id), 2, None)
+
+    bump()
+    transaction.on_commit(bump)
+
+
+def history_item(name, quantity, price):
+    return {'name': name, 'quantity': quantity, 'price': str(price)}
+
+
+def history_entry(order, items=()):
+    """Строка истории для заказа order (без запросов)."""
+    return OrderHistoryEntry(
+        order_id=order.pk,
+        user_id=order.user_id,
+        created_at=order.created_at,
+        status=order.status,
+        total_amount=order.total_amount,
+        address=f'{order.address}, {order.postal_code}, {order.city}',
+        items=list(items),
+    )
+
+
+def materialize_history(order_ids):
+    """Пересобирает строки истории заказов order_ids: два SELECT и один upsert."""
+    items = {}
+    rows = (
+        OrderItem.objects.filter(order_id__in=order_ids).order_by('pk')
+        .values_list('order_id', 'product__name', 'quantity', 'price')
+    )
+    for order_id, name, quantity, price in rows:
+        items.setdefault(order_id, []).append(history_item(name, quantity, price))
+    entries = [
+        history_entry(order, items.get(order.pk, ()))
+        for order in Order.objects.filter(pk__in=order_ids).select_related(None)
+    ]
+    OrderHistoryEntry.objects.bulk_create(
+        entries,
+        update_conflicts=True,
+        unique_fields=['order'],
+        update_fields=['status', 'total_amount', 'address', 'items'],
+    )
+    for user_id in {entry.user_id for entry in entries}:
+        bump_history_version(user_id)
+    return len(entries)
+
+
+def history_page_size():
+    return getattr(settings, 'ORDER_HISTORY_PAGE_SIZE', 10)
+
+
+def order_history_page(user, cursor=None):
+    """
+    Страница истории заказов пользователя (KeysetPage из OrderHistoryEntry,
+    новые сверху). Кешируется по пользователю, версии его истории и курсору.
+    """
+    per_page = history_page_size()
+    key = f'order_history:{user.pk}:{history_version(user.pk)}:{per_page}:{cursor or ""}'
+    page = cache.get(key)
+    if page is None:
+        entries = OrderHistoryEntry.objects.filter(user=user)
+        page = KeysetPaginator(entries, per_page, ordering='-created_at').page(cursor)
+        cache.set(key, page, getattr(settings, 'ORDER_HISTORY_CACHE_TIMEOUT', 15 * 60))
+    return page
+
+
+def rebuild_order_totals(chunk_size=1000):
+    """
+    Полный пересчёт: total_amount всех заказов одним UPDATE, затем сводки
+    пользователей и история заказов пачками по chunk_size.
+    Возвращает (заказов, сводок, строк истории).
+    """
+    orders = refresh_order_totals()
+    user_ids = list(Order.objects.order_by('user_id').values_list('user_id', flat=True).distinct())
+    summaries = 0
+    for start in range(0, len(user_ids), chunk_size):
+        summaries += refresh_user_summaries(user_ids[start:start + chunk_size])
+    UserOrderSummary.objects.exclude(user_id__in=Order.objects.values('user_id')).delete()
+
+    order_ids = list(Order.objects.order_by('pk').values_list('pk', flat=True))
+    entries = 0
+    for start in range(0, len(order_ids), chunk_size):
+        entries += materialize_history(order_ids[start:start + chunk_size])
+    return orders, summaries, entries
@@ -0,0 +1,161 @@
+# products/pagination.py
+"""
+Keyset (seek) пагинация для каталога.
+
+Вместо COUNT(*) + OFFSET страница выбирается условием по ключу сортировки
+последней показанной строки: WHERE (price, id) > (:price, :id) LIMIT n+1.
+Стоимость страницы не зависит от её глубины. Курсор в URL непрозрачен:
+base64 от JSON с направлением, значением ключа и id.
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.utils.http import urlsafe_base64_decode, urlsafe_base64_encode
+
+KEYSET_FIELDS = ('price', 'name', 'created_at')
+DEFAULT_ORDERING = '-created_at'
+
+NEXT = 'n'
+PREVIOUS = 'p'
+
+
+def pagination_mode():
+    """'cursor' — keyset-пагинация, 'page' — классический Paginator."""
+    return getattr(settings, 'PRODUCT_PAGINATION_MODE', 'page')
+
+
+def approximate_count(queryset, timeout=None):
+    """
+    Приблизительное число строк: COUNT(*) кешируется по тексту SQL на
+    settings.APPROXIMATE_COUNT_TIMEOUT секунд, поэтому страница каталога
+    не пересчитывает его при каждом запросе.
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'APPROXIMATE_COUNT_TIMEOUT', 600)
+    sql, params = queryset.query.sql_with_params()
+    digest = hashlib.sha1(f"{sql}|{params}".encode('utf-8')).hexdigest()
+    key = f"approx_count:{queryset.model._meta.label_lower}:{digest}"
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, timeout)
+    return count
+
+
+class KeysetPage:
+    """Страница keyset-пагинации (по интерфейсу похожа на Page)."""
+
+    def __init__(self, object_list, has_next, has_previous, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self._has_next = has_next
+        self._has_previous = has_previous
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+
+class KeysetPaginator:
+    """
+    paginator = KeysetPaginator(Product.objects.all(), 12, ordering='-price')
+    page = paginator.page(request.GET.get('cursor'))
+
+    ordering — одно из fields (по умолчанию KEYSET_FIELDS каталога; с '-'
+    для убывания); если не задано, берётся из queryset.order_by(), иначе
+    DEFAULT_ORDERING (или первое из fields по убыванию). id всегда
+    добавляется последним ключом, чтобы порядок был строгим.
+    """
+
+    def __init__(self, queryset, per_page, ordering=None, fields=KEYSET_FIELDS):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.fields = fields
+        self.ordering = self._resolve_ordering(ordering or self._queryset_ordering(queryset))
+        self.field = self.ordering.lstrip('-')
+        self.descending = self.ordering.startswith('-')
+
+    @staticmethod
+    def _queryset_ordering(queryset):
+        order_by = queryset.query.order_by
+        return order_by[0] if order_by else None
+
+    def _resolve_ordering(self, ordering):
+        if ordering and ordering.lstrip('-') in self.fields:
+            return ordering
+        if DEFAULT_ORDERING.lstrip('-') in self.fields:
+            return DEFAULT_ORDERING
+        return f'-{self.fields[0]}'
+
+    # --- курсоры ---
+
+    def encode_cursor(self, direction, obj):
+        value = getattr(obj, self.field)
+        payload = {'o': self.ordering, 'd': direction, 'v': str(value), 'id': obj.pk}
+        return urlsafe_base64_encode(json.dumps(payload, separators=(',', ':')).encode('utf-8'))
+
+    def decode_cursor(self, cursor):
+        """Возвращает (direction, value, pk) или None для некорректного курсора."""
+        if not cursor:
+            return None
+        try:
+            payload = json.loads(urlsafe_base64_decode(cursor))
+            if payload['o'] != self.ordering or payload['d'] not in (NEXT, PREVIOUS):
+                return None
+            field = self.queryset.model._meta.get_field(self.field)
+            return payload['d'], field.to_python(payload['v']), int(payload['id'])
+        except (ValueError, TypeError, KeyError, ValidationError):
+            return None
+
+    # --- выборка ---
+
+    def _seek(self, value, pk, forward):
+        # Для "следующей" страницы по возрастанию: (field, id) > (value, pk)
+        greater = forward != self.descending
+        op = 'gt' if greater else 'lt'
+        return Q(**{f'{self.field}__{op}': value}) | Q(**{self.field: value, f'pk__{op}': pk})
+
+    def _order(self, forward):
+        descending = self.descending if forward else not self.descending
+        prefix = '-' if descending else ''
+        return f'{prefix}{self.field}', f'{prefix}pk'
+
+    def page(self, cursor=None):
+        position = self.decode_cursor(cursor)
+        forward = position is None or position[0] == NEXT
+        queryset = self.queryset.order_by(*self._order(forward))
+        if position is not None:
+            _, value, pk = position
+            queryset = queryset.filter(self._seek(value, pk, forward))
+
+        rows = list(queryset[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if forward:
+            has_next, has_previous = has_more, position is not None
+        else:
+            rows.reverse()
+            has_next, has_previous = True, has_more
+
+        next_cursor = self.encode_cursor(NEXT, rows[-1]) if has_next and rows else None
+        previous_cursor = self.encode_cursor(PREVIOUS, rows[0]) if has_previous and rows else None
+        return KeysetPage(rows, has_next, has_previous, next_cursor, previous_cursor)
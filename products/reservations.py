@@ -0,0 +1,113 @@
+# products/reservations.py
+"""
+Резервирование товара под корзину.
+
+Пока товар лежит в корзине, под него держится StockReservation со сроком
+settings.STOCK_RESERVATION_TTL. Доступный остаток товара — это stock минус
+действующие резервы других корзин. Резерв ставится под блокировкой строки
+товара (select_for_update) в короткой транзакции, поэтому две корзины не
+могут одновременно зарезервировать один и тот же последний экземпляр.
+SQLite select_for_update не поддерживает (Django его пропускает), там
+транзакции открываются как BEGIN IMMEDIATE (OPTIONS в settings.DATABASES)
+и резервы ставятся по очереди под блокировкой записи всей БД.
+
+При оформлении заказа (services.place_order) резервы корзины превращаются
+в продажу: списание учитывает только чужие резервы, а свои удаляются.
+Истёкшие резервы удаляются пачкой командой release_expired_reservations.
+"""
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Product, StockReservation
+
+HOLDER_SESSION_KEY = 'cart_holder'
+
+
+def reservation_ttl():
+    return timedelta(seconds=getattr(settings, 'STOCK_RESERVATION_TTL', 15 * 60))
+
+
+def holder_for_session(session):
+    """Токен корзины; хранится в сессии и не меняется при входе пользователя."""
+    holder = session.get(HOLDER_SESSION_KEY)
+    if not holder:
+        holder = session[HOLDER_SESSION_KEY] = uuid.uuid4().hex
+        session.modified = True
+    return holder
+
+
+def held_by_others(product_id, holder, now=None):
+    return (
+        StockReservation.objects.active(now)
+        .filter(product_id=product_id)
+        .exclude(holder=holder)
+        .aggregate(total=Sum('quantity'))['total'] or 0
+    )
+
+
+def others_reserved_subquery(holder, now=None):
+    """Сумма чужих действующих резервов товара OuterRef('pk') — для UPDATE/annotate."""
+    reserved = (
+        StockReservation.objects.active(now)
+        .filter(product=OuterRef('pk'))
+        .exclude(holder=holder)
+        .values('product')
+        .annotate(total=Sum('quantity'))
+        .values('total')
+    )
+    return Coalesce(Subquery(reserved), 0)
+
+
+def available_stock(product, holder=None):
+    """Сколько товара может взять корзина holder с учётом чужих резервов."""
+    return max(product.stock - held_by_others(product.pk, holder), 0)
+
+
+def reserve(holder, product, quantity):
+    """
+    Устанавливает резерв корзины на товар равным quantity (но не больше
+    доступного) и продлевает его. Возвращает фактически зарезервированное
+    количество; 0 — резерв снят.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        stock = Product.objects.select_for_update().filter(pk=product.pk).values_list('stock', flat=True).first()
+        if stock is None:
+            return 0
+        reserved = max(min(int(quantity), stock - held_by_others(product.pk, holder, now)), 0)
+        if reserved == 0:
+            StockReservation.objects.filter(product=product, holder=holder).delete()
+            return 0
+        StockReservation.objects.update_or_create(
+            product=product, holder=holder,
+            defaults={'quantity': reserved, 'expires_at': now + reservation_ttl()},
+        )
+    return reserved
+
+
+def release(holder, product_ids=None):
+    """Снимает резервы корзины (все или по списку товаров)."""
+    reservations = StockReservation.objects.for_holder(holder)
+    if product_ids is not None:
+        reservations = reservations.filter(product_id__in=product_ids)
+    return reservations.delete()[0]
+
+
+def extend(holder):
+    """Продлевает все резервы корзины (вызывается при просмотре корзины)."""
+    now = timezone.now()
+    return (
+        StockReservation.objects.active(now).for_holder(holder)
+        .update(expires_at=now + reservation_ttl())
+    )
+
+
+def release_expired(now=None):
+    """Удаляет все истёкшие резервы одним DELETE. Возвращает их число."""
+    return StockReservation.objects.expired(now).delete()[0]
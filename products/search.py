@@ -0,0 +1,505 @@
+# products/search.py
+"""
+Полнотекстовый поиск по каталогу.
+
+Индексируются название товара, текст описания (без HTML-разметки CKEditor),
+названия категории и подкатегории. Текст заранее нормализован и хранится в
+ProductSearchDocument, поэтому при индексации не нужны JOIN и разбор HTML.
+Если SQLite собран с FTS5, используется виртуальная таблица
+products_product_fts и ранжирование bm25(); иначе — инвертированный индекс
+в памяти процесса с той же формулой BM25.
+
+Индекс обновляется инкрементально сигналами (см. products/signals.py).
+Индекс в памяти свой у каждого процесса и видит только изменения, сделанные
+в этом процессе (через ORM); записи из других процессов (соседние воркеры,
+manage.py) он получит лишь после перезапуска. Для нескольких воркеров
+нужен FTS5, чей индекс лежит в самой БД.
+
+Здесь же — кеш результатов поиска: в кеше хранится упорядоченный список
+id найденных товаров и их общее число, а страница гидрируется одним
+запросом id__in. Полные списки id в запросы передаются пачками
+(id_chunks): у SQLite ограничено число параметров одного запроса.
+"""
+import hashlib
+import json
+import logging
+import math
+import re
+import threading
+import unicodedata
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from html import unescape
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.utils.html import strip_tags
+
+logger = logging.getLogger(__name__)
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# Веса полей: совпадение в названии важнее, чем в описании
+FIELD_WEIGHTS = {
+    'name': 3.0,
+    'description': 1.0,
+    'category': 2.0,
+}
+FTS_TABLE = 'products_product_fts'
+
+
+# ё -> е: в запросах и названиях пишут по-разному
+FOLD_MAP = str.maketrans({'ё': 'е'})
+# Диакритику снимаем только у латиницы (café -> cafe): у кириллицы
+# "й" тоже раскладывается на букву и знак, но это другая буква
+LATIN_END = '\u0250'
+
+
+def fold(text):
+    """Нижний регистр, латиница без диакритики, ё -> е."""
+    if not text:
+        return ''
+    chars = []
+    base = ''
+    for ch in unicodedata.normalize('NFKD', text.lower()):
+        if unicodedata.combining(ch):
+            if base < LATIN_END:
+                continue
+        else:
+            base = ch
+        chars.append(ch)
+    return unicodedata.normalize('NFC', ''.join(chars)).translate(FOLD_MAP)
+
+
+def tokenize(text):
+    """Разбивает текст на нормализованные токены (см. fold)."""
+    if not text:
+        return []
+    return TOKEN_RE.findall(fold(text))
+
+
+def html_to_text(html):
+    """Убирает HTML-разметку и сущности из описания CKEditor."""
+    if not html:
+        return ''
+    return ' '.join(unescape(strip_tags(html)).split())
+
+
+# ----------------------------------------------------------------------
+# Поисковые документы (ProductSearchDocument)
+# ----------------------------------------------------------------------
+
+def document_fields(product):
+    """Нормализованный текст товара для ProductSearchDocument."""
+    return {
+        'name': fold(product.name),
+        'description': fold(html_to_text(product.description)),
+        'category': fold(product.category.name) if product.category_id else '',
+        'subcategory': fold(product.subcategory.name) if product.subcategory_id else '',
+    }
+
+
+def save_document(product):
+    """Создаёт или обновляет поисковый документ товара."""
+    from .models import ProductSearchDocument
+
+    document = ProductSearchDocument(product_id=product.pk, **document_fields(product))
+    document.save()
+    return document
+
+
+def rebuild_documents(chunk_size=1000):
+    """
+    Пересобирает все поисковые документы пачками по chunk_size товаров
+    (bulk_create с обновлением при конфликте). Возвращает число документов.
+    """
+    from .models import Product, ProductSearchDocument
+
+    products = Product.objects.select_related('category', 'subcategory').order_by('pk')
+    update_fields = ['name', 'description', 'category', 'subcategory', 'updated_at']
+    total = 0
+    last_pk = 0
+    while True:
+        chunk = list(products.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            break
+        ProductSearchDocument.objects.bulk_create(
+            [ProductSearchDocument(product_id=p.pk, **document_fields(p)) for p in chunk],
+            update_conflicts=True,
+            unique_fields=['product'],
+            update_fields=update_fields,
+        )
+        total += len(chunk)
+        last_pk = chunk[-1].pk
+    return total
+
+
+# ----------------------------------------------------------------------
+# Pure-Python инвертированный индекс (fallback)
+# ----------------------------------------------------------------------
+
+class PythonSearchIndex:
+    """
+    Инвертированный индекс в памяти процесса (у каждого процесса свой, см.
+    описание модуля).
+
+    postings: term -> {product_id: взвешенная частота термина}
+    Запрос: каждый токен запроса ищется как префикс термина (через bisect
+    по отсортированному словарю), токены объединяются по AND.
+    """
+    name = 'python'
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._postings = defaultdict(dict)
+        self._doc_terms = {}
+        self._doc_lengths = {}
+        self._sorted_terms = None
+        self._built = False
+
+    # --- построение / обновление ---
+
+    def _index_fields(self, product_id, fields):
+        weighted = Counter()
+        for field, text in fields.items():
+            weight = FIELD_WEIGHTS.get(field, 1.0)
+            for token in tokenize(text):
+                weighted[token] += weight
+        self._remove(product_id)
+        for term, tf in weighted.items():
+            self._postings[term][product_id] = tf
+        self._doc_terms[product_id] = tuple(weighted)
+        self._doc_lengths[product_id] = sum(weighted.values())
+        self._sorted_terms = None
+
+    def _remove(self, product_id):
+        for term in self._doc_terms.pop(product_id, ()):
+            docs = self._postings.get(term)
+            if docs is not None:
+                docs.pop(product_id, None)
+                if not docs:
+                    del self._postings[term]
+        if self._doc_lengths.pop(product_id, None) is not None:
+            self._sorted_terms = None
+
+    def rebuild(self):
+        from .models import ProductSearchDocument
+
+        with self._lock:
+            self._postings.clear()
+            self._doc_terms.clear()
+            self._doc_lengths.clear()
+            self._sorted_terms = None
+            for document in ProductSearchDocument.objects.iterator(chunk_size=2000):
+                self._index_fields(document.product_id, document.index_fields())
+            self._built = True
+
+    def ensure_built(self):
+        if not self._built:
+            self.rebuild()
+
+    def update_document(self, document):
+        product_id = document.product_id
+        fields = document.index_fields()
+
+        def apply():
+            with self._lock:
+                if self._built:
+                    self._index_fields(product_id, fields)
+
+        transaction.on_commit(apply)
+
+    def remove_product(self, product_id):
+        def apply():
+            with self._lock:
+                self._remove(product_id)
+
+        transaction.on_commit(apply)
+
+    # --- поиск ---
+
+    def _expand(self, token):
+        """Все термины словаря, начинающиеся с token."""
+        if self._sorted_terms is None:
+            self._sorted_terms = sorted(self._postings)
+        terms = self._sorted_terms
+        matched = []
+        i = bisect_left(terms, token)
+        while i < len(terms) and terms[i].startswith(token):
+            matched.append(terms[i])
+            i += 1
+        return matched
+
+    def search(self, query, limit=None):
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        self.ensure_built()
+        with self._lock:
+            total_docs = len(self._doc_lengths)
+            if not total_docs:
+                return []
+            avg_length = sum(self._doc_lengths.values()) / total_docs
+            scores = None
+            for token in tokens:
+                token_scores = defaultdict(float)
+                for term in self._expand(token):
+                    docs = self._postings[term]
+                    idf = math.log(1 + (total_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+                    for product_id, tf in docs.items():
+                        norm = self.k1 * (1 - self.b + self.b * self._doc_lengths[product_id] / avg_length)
+                        token_scores[product_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+                if scores is None:
+                    scores = token_scores
+                else:
+                    scores = {
+                        pid: score + token_scores[pid]
+                        for pid, score in scores.items() if pid in token_scores
+                    }
+                if not scores:
+                    return []
+        ranked = sorted(scores, key=lambda pid: (-scores[pid], pid))
+        return ranked[:limit] if limit else ranked
+
+
+# ----------------------------------------------------------------------
+# SQLite FTS5
+# ----------------------------------------------------------------------
+
+class SQLiteFTSSearchIndex:
+    """
+    Индекс на виртуальной таблице FTS5 (создаётся миграцией).
+    rowid таблицы совпадает с id товара, поэтому обновление — это
+    DELETE + INSERT по rowid в той же транзакции, что и сохранение товара.
+    """
+    name = 'fts5'
+
+    def rebuild(self):
+        from .models import ProductSearchDocument
+
+        # Документы уже нормализованы — индекс заполняется одним INSERT ... SELECT
+        documents = ProductSearchDocument._meta.db_table
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+            cursor.execute(
+                f'INSERT INTO {FTS_TABLE} (rowid, name, description, category) '
+                f"SELECT product_id, name, description, TRIM(category || ' ' || subcategory) FROM {documents}"
+            )
+
+    def update_document(self, document):
+        fields = document.index_fields()
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [document.product_id])
+            cursor.execute(
+                f'INSERT INTO {FTS_TABLE} (rowid, name, description, category) VALUES (%s, %s, %s, %s)',
+                [document.product_id, fields['name'], fields['description'], fields['category']],
+            )
+
+    def remove_product(self, product_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [product_id])
+
+    @staticmethod
+    def match_expression(tokens):
+        # Каждый токен — префиксный запрос в кавычках, чтобы операторы FTS5 не интерпретировались
+        return ' AND '.join(f'"{token}"*' for token in tokens)
+
+    def search(self, query, limit=None):
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        weights = ', '.join(str(FIELD_WEIGHTS[field]) for field in ('name', 'description', 'category'))
+        sql = (
+            f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s '
+            f'ORDER BY bm25({FTS_TABLE}, {weights}), rowid'
+        )
+        params = [self.match_expression(tokens)]
+        if limit:
+            sql += ' LIMIT %s'
+            params.append(limit)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [row[0] for row in cursor.fetchall()]
+
+
+# ----------------------------------------------------------------------
+# Выбор бэкенда
+# ----------------------------------------------------------------------
+
+def fts5_available(conn=None):
+    """Проверяет, что БД — SQLite с поддержкой FTS5."""
+    conn = conn or connection
+    if conn.vendor != 'sqlite':
+        return False
+    with conn.cursor() as cursor:
+        cursor.execute('PRAGMA compile_options')
+        return any(row[0] == 'ENABLE_FTS5' for row in cursor.fetchall())
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def _fts_table_exists():
+    return FTS_TABLE in connection.introspection.table_names()
+
+
+def get_search_backend():
+    """
+    Возвращает активный поисковый бэкенд (один на процесс).
+    settings.PRODUCT_SEARCH_BACKEND: 'auto' (по умолчанию), 'fts5' или 'python'.
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                choice = getattr(settings, 'PRODUCT_SEARCH_BACKEND', 'auto')
+                use_fts = choice == 'fts5' or (
+                    choice == 'auto' and fts5_available() and _fts_table_exists()
+                )
+                _backend = SQLiteFTSSearchIndex() if use_fts else PythonSearchIndex()
+                logger.info("Поисковый бэкенд: %s", _backend.name)
+    return _backend
+
+
+def reset_search_backend():
+    """Сбрасывает выбранный бэкенд (используется в тестах и после rebuild)."""
+    global _backend
+    with _backend_lock:
+        _backend = None
+
+
+# ----------------------------------------------------------------------
+# Кеш результатов поиска
+# ----------------------------------------------------------------------
+
+# Сколько id передавать в одном id__in: старые сборки SQLite принимают
+# не больше 999 параметров в запросе
+ID_CHUNK_SIZE = 500
+
+
+def id_chunks(ids, size=None):
+    """Режет список id на пачки для запросов id__in."""
+    ids = list(ids)
+    size = size or ID_CHUNK_SIZE
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+CATALOG_VERSION_KEY = 'catalog_version'
+
+
+def catalog_version():
+    """Версия каталога: меняется при любом изменении товаров и категорий."""
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOG_VERSION_KEY, 1, None)
+        version = cache.get(CATALOG_VERSION_KEY, 1)
+    return version
+
+
+def bump_catalog_version():
+    """Инвалидирует всё, что закешировано с привязкой к версии каталога."""
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        cache.set(CATALOG_VERSION_KEY, 2, None)
+
+
+def query_signature(query, **filters):
+    """
+    Нормализованная подпись запроса: токены + непустые фильтры. Запрос без
+    токенов (например, "!!!") отличается от просмотра каталога без запроса.
+    """
+    payload = {
+        'q': tokenize(query),
+        'has_query': bool(query and query.strip()),
+        'filters': {key: str(value) for key, value in sorted(filters.items()) if value not in ('', None)},
+    }
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+class SearchResultCache:
+    """
+    Кеш "подпись запроса -> (ids, total, did_you_mean)".
+
+    Ключ включает версию каталога, поэтому изменение товаров делает старые
+    записи недостижимыми. Счётчики попаданий/промахов — в памяти процесса.
+    """
+    prefix = 'search_results'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def timeout(self):
+        return getattr(settings, 'SEARCH_RESULTS_CACHE_TIMEOUT', 300)
+
+    def max_ids(self):
+        return getattr(settings, 'SEARCH_RESULTS_CACHE_MAX_IDS', 1200)
+
+    def key(self, signature):
+        return f"{self.prefix}:{catalog_version()}:{signature}"
+
+    def get(self, signature):
+        entry = cache.get(self.key(signature))
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def set(self, signature, ids, total, did_you_mean=()):
+        entry = {'ids': list(ids), 'total': total, 'did_you_mean': list(did_you_mean)}
+        cache.set(self.key(signature), entry, self.timeout())
+        return entry
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / total if total else 0.0,
+            }
+
+
+search_result_cache = SearchResultCache()
+
+
+class CachedSearchResults:
+    """
+    Последовательность для Paginator: длина — total из кеша, срез —
+    один запрос id__in по id страницы с сохранением порядка.
+
+    Если страница лежит дальше закешированного префикса ids
+    (SEARCH_RESULTS_CACHE_MAX_IDS), срез берётся из fallback_queryset.
+    """
+
+    def __init__(self, ids, total, queryset, fallback_queryset=None):
+        self.ids = ids
+        self.total = total
+        self.queryset = queryset
+        self.fallback_queryset = fallback_queryset
+
+    def count(self):
+        return self.total
+
+    def __len__(self):
+        return self.total
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        start, stop, _ = index.indices(self.total)
+        if stop > len(self.ids) and self.fallback_queryset is not None:
+            return list(self.fallback_queryset[start:stop])
+        page_ids = self.ids[start:stop]
+        products = self.queryset.in_bulk(page_ids)
+        return [products[pk] for pk in page_ids if pk in products]
@@ -0,0 +1,115 @@
+# products/services.py
+"""
+Оформление заказа.
+
+place_order() выполняется в одной транзакции и стоит постоянное число
+запросов независимо от размера корзины:
+
+1. один UPDATE списывает остатки всех товаров корзины:
+   stock = stock - CASE id WHEN ... THEN qty END
+   WHERE id IN (...) AND stock >= CASE id WHEN ... THEN qty END + <чужие резервы>
+   Условие в WHERE проверяется под блокировкой строки, поэтому два
+   параллельных заказа не уведут остаток в минус; если хотя бы одной
+   позиции не хватило, транзакция откатывается целиком;
+2. один SELECT цен и названий списанных товаров;
+3. INSERT заказа с уже посчитанным total_amount (сигналы добавляют строку
+   истории и пересчитывают сводку пользователя, см. products/orders.py);
+4. один bulk_create позиций заказа и один UPDATE позиций в строке истории;
+5. один DELETE резервов корзины — они превратились в продажу
+   (см. products/reservations.py).
+
+bulk_create не вызывает post_save позиций, поэтому продажи в подсказках
+поиска (products/autocomplete.py) увеличиваются здесь же, без запросов.
+"""
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+
+from .autocomplete import autocomplete_index
+from .models import OrderHistoryEntry, OrderItem, Product
+from .orders import history_item
+from .reservations import others_reserved_subquery, release
+from .search import bump_catalog_version
+from .suggestions import PRODUCT
+
+
+class InsufficientStockError(Exception):
+    """Не хватает товара на складе; shortages — [(product_id, name, available), ...]."""
+
+    def __init__(self, shortages):
+        self.shortages = shortages
+        super().__init__(
+            ', '.join(f'{name}: доступно {available}' for _, name, available in shortages)
+        )
+
+
+def _quantity_case(quantities):
+    return Case(
+        *[When(pk=pk, then=Value(quantity)) for pk, quantity in quantities.items()],
+        output_field=IntegerField(),
+    )
+
+
+def _shortages(quantities, holder):
+    """Позиции, которых не хватает (после отката списания)."""
+    found = (
+        Product.objects.filter(pk__in=quantities)
+        .annotate(available=F('stock') - others_reserved_subquery(holder))
+        .values_list('pk', 'name', 'available')
+    )
+    stock = {pk: (name, max(available, 0)) for pk, name, available in found}
+    return [
+        (pk, *stock.get(pk, ('', 0)))
+        for pk, quantity in quantities.items()
+        if stock.get(pk, ('', 0))[1] < quantity
+    ]
+
+
+def place_order(order, quantities, holder=None):
+    """
+    Сохраняет order (ещё не сохранённый экземпляр Order) с позициями
+    quantities = {product_id: количество}, списывает остатки и
+    записывает total_amount. Цены берутся текущие, из Product.price.
+    holder — токен корзины: её резервы не мешают списанию и снимаются.
+    При нехватке товара ничего не сохраняет и бросает InsufficientStockError.
+    """
+    quantities = {int(pk): int(quantity) for pk, quantity in quantities.items() if int(quantity) > 0}
+    if not quantities:
+        raise ValueError("Пустой заказ")
+
+    try:
+        with transaction.atomic():
+            requested = _quantity_case(quantities)
+            updated = (
+                Product.objects
+                .filter(pk__in=quantities, stock__gte=requested + others_reserved_subquery(holder))
+                .update(stock=F('stock') - requested)
+            )
+            if updated != len(quantities):
+                raise InsufficientStockError([])
+
+            products = {
+                pk: (price, name)
+                for pk, price, name in Product.objects.filter(pk__in=quantities).values_list('pk', 'price', 'name')
+            }
+            prices = {pk: price for pk, (price, _) in products.items()}
+            order.total_amount = sum(
+                (prices[pk] * quantity for pk, quantity in quantities.items()), Decimal('0')
+            )
+            order.save()
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product_id=pk, price=prices[pk], quantity=quantity)
+                for pk, quantity in quantities.items()
+            ])
+            OrderHistoryEntry.objects.filter(order=order).update(items=[
+                history_item(products[pk][1], quantity, prices[pk]) for pk, quantity in quantities.items()
+            ])
+            if holder:
+                release(holder, list(quantities))
+            # UPDATE не вызывает post_save — сбрасываем кеши каталога сами
+            transaction.on_commit(bump_catalog_version)
+            autocomplete_index.add_popularity(PRODUCT, quantities)
+    except InsufficientStockError:
+        raise InsufficientStockError(_shortages(quantities, holder)) from None
+    return order
@@ -0,0 +1,235 @@
+# products/signals.py
+import threading
+
+from django.contrib.auth.signals import user_logged_in
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from .autocomplete import autocomplete_index
+from .cart import merge_session_cart, refresh_summary
+from .currency import bump_rates_version
+from .models import (
+    Category, ExchangeRate, Order, OrderHistoryEntry, OrderItem, Product, ProductSearchDocument, SubCategory,
+    UserCart,
+)
+from .orders import (
+    bump_history_version, history_entry, materialize_history, refresh_order_totals, refresh_user_summaries,
+)
+from .search import bump_catalog_version, fold, get_search_backend, save_document
+from .suggestions import CATEGORY, PRODUCT, SUBCATEGORY, trigram_index
+
+
+# Заказы, которые удаляются сейчас в этом потоке: их позиции удаляются
+# каскадом, и пересчитывать по ним итоги и историю незачем
+_deleting = threading.local()
+
+
+def deleting_orders():
+    if not hasattr(_deleting, 'order_ids'):
+        _deleting.order_ids = set()
+    return _deleting.order_ids
+
+
+def reindex_documents(documents, **changes):
+    """Обновляет поле документов одним UPDATE и переиндексирует их."""
+    documents.update(**changes)
+    backend = get_search_backend()
+    for document in documents:
+        backend.update_document(document)
+
+
+def refresh_group_popularity(category_ids, subcategory_ids):
+    """Популярность категорий и подкатегорий в подсказках — число их товаров."""
+    autocomplete_index.refresh_popularity(CATEGORY, category_ids)
+    autocomplete_index.refresh_popularity(SUBCATEGORY, subcategory_ids)
+
+
+@receiver(pre_save, sender=Product)
+def remember_product_groups(sender, instance, raw=False, **kwargs):
+    # Товар мог уйти из категории или подкатегории — её счётчик тоже пересчитаем
+    instance._old_groups = None
+    if not raw and not instance._state.adding:
+        instance._old_groups = (
+            Product._base_manager.filter(pk=instance.pk).values_list('category_id', 'subcategory_id').first()
+        )
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, raw=False, **kwargs):
+    """Обновляем поисковый документ и индексы при сохранении товара."""
+    if raw:
+        return
+    get_search_backend().update_document(save_document(instance))
+    trigram_index.update(PRODUCT, instance.pk, instance.name)
+    autocomplete_index.update_product(instance)
+    old_category_id, old_subcategory_id = getattr(instance, '_old_groups', None) or (None, None)
+    refresh_group_popularity(
+        [instance.category_id, old_category_id], [instance.subcategory_id, old_subcategory_id],
+    )
+    bump_catalog_version()
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    # Документ удаляется каскадом вместе с товаром
+    get_search_backend().remove_product(instance.id)
+    trigram_index.remove(PRODUCT, instance.pk)
+    autocomplete_index.remove(PRODUCT, instance.pk)
+    refresh_group_popularity([instance.category_id], [instance.subcategory_id])
+    bump_catalog_version()
+
+
+@receiver(pre_delete, sender=Product)
+def remember_product_carts(sender, instance, **kwargs):
+    # Строки корзин удаляются каскадом мимо хранилища корзины — запоминаем
+    # корзины, чтобы пересчитать их сводки после удаления
+    instance._cart_ids = list(UserCart.objects.filter(lines__product=instance).values_list('pk', 'user_id'))
+
+
+@receiver(post_delete, sender=Product)
+def refresh_product_carts(sender, instance, **kwargs):
+    for pk, user_id in getattr(instance, '_cart_ids', ()):
+        refresh_summary(UserCart(pk=pk, user_id=user_id))
+
+
+@receiver(post_save, sender=Category)
+def index_category(sender, instance, created, raw=False, **kwargs):
+    """
+    Название категории входит в подсказки и в документ каждого её товара,
+    поэтому при переименовании переиндексируем документы категории. Слаг
+    категории входит в подсказки её подкатегорий.
+    """
+    if raw:
+        return
+    trigram_index.update(CATEGORY, instance.pk, instance.name)
+    autocomplete_index.update_category(instance)
+    bump_catalog_version()
+    if created:
+        return
+    for subcategory in instance.subcategories.all():
+        autocomplete_index.update_subcategory(subcategory)
+    reindex_documents(
+        ProductSearchDocument.objects.filter(product__category=instance),
+        category=fold(instance.name),
+    )
+
+
+@receiver(post_delete, sender=Category)
+def unindex_category(sender, instance, **kwargs):
+    trigram_index.remove(CATEGORY, instance.pk)
+    autocomplete_index.remove(CATEGORY, instance.pk)
+    bump_catalog_version()
+
+
+@receiver(post_save, sender=SubCategory)
+def index_subcategory(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    trigram_index.update(SUBCATEGORY, instance.pk, instance.name)
+    autocomplete_index.update_subcategory(instance)
+    bump_catalog_version()
+    if created:
+        return
+    reindex_documents(
+        ProductSearchDocument.objects.filter(product__subcategory=instance),
+        subcategory=fold(instance.name),
+    )
+
+
+@receiver(pre_delete, sender=SubCategory)
+def detach_subcategory_documents(sender, instance, **kwargs):
+    # У товаров подкатегория обнуляется (SET_NULL) без post_save — чистим документы сами
+    reindex_documents(
+        ProductSearchDocument.objects.filter(product__subcategory=instance),
+        subcategory='',
+    )
+
+
+@receiver(post_delete, sender=SubCategory)
+def unindex_subcategory(sender, instance, **kwargs):
+    trigram_index.remove(SUBCATEGORY, instance.pk)
+    autocomplete_index.remove(SUBCATEGORY, instance.pk)
+    bump_catalog_version()
+
+
+@receiver(post_save, sender=ExchangeRate)
+@receiver(post_delete, sender=ExchangeRate)
+def exchange_rate_changed(sender, instance, raw=False, **kwargs):
+    # После коммита, чтобы другие процессы не перечитали старые курсы под новой версией
+    if not raw:
+        transaction.on_commit(bump_rates_version)
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+def order_changed(sender, instance, raw=False, **kwargs):
+    """Сводка заказов пользователя пересчитывается в транзакции записи заказа."""
+    if not raw:
+        refresh_user_summaries([instance.user_id])
+
+
+@receiver(post_save, sender=Order)
+def update_order_history(sender, instance, created, raw=False, **kwargs):
+    """Строка истории создаётся вместе с заказом и следует за его статусом и адресом."""
+    if raw:
+        return
+    if created:
+        history_entry(instance).save(force_insert=True)
+        bump_history_version(instance.user_id)
+        return
+    updated = OrderHistoryEntry.objects.filter(order=instance).update(
+        status=instance.status,
+        total_amount=instance.total_amount,
+        address=history_entry(instance).address,
+    )
+    if updated:
+        bump_history_version(instance.user_id)
+    else:
+        materialize_history([instance.pk])
+
+
+@receiver(pre_delete, sender=Order)
+def begin_order_delete(sender, instance, **kwargs):
+    # Сигналы позиций, удаляемых каскадом, пропускаются (order_item_changed);
+    # популярность их товаров пересчитывается один раз после удаления заказа
+    deleting_orders().add(instance.pk)
+    instance._product_ids = list(
+        OrderItem.objects.filter(order=instance).values_list('product_id', flat=True).distinct()
+    )
+
+
+@receiver(post_delete, sender=Order)
+def end_order_delete(sender, instance, **kwargs):
+    # Строка истории удалена каскадом вместе с заказом
+    deleting_orders().discard(instance.pk)
+    bump_history_version(instance.user_id)
+    autocomplete_index.refresh_popularity(PRODUCT, getattr(instance, '_product_ids', ()))
+
+
+@receiver(post_save, sender=OrderItem)
+@receiver(post_delete, sender=OrderItem)
+def update_product_popularity(sender, instance, raw=False, **kwargs):
+    # Продажи товара — его популярность в подсказках
+    if not raw and instance.order_id not in deleting_orders():
+        autocomplete_index.refresh_popularity(PRODUCT, [instance.product_id])
+
+
+@receiver(post_save, sender=OrderItem)
+@receiver(post_delete, sender=OrderItem)
+def order_item_changed(sender, instance, raw=False, **kwargs):
+    # Позиция меняет сумму заказа, а через неё — сводку пользователя и историю
+    if raw or instance.order_id in deleting_orders():
+        return
+    refresh_order_totals([instance.order_id])
+    refresh_user_summaries(
+        Order.objects.filter(pk=instance.order_id).values_list('user_id', flat=True)
+    )
+    materialize_history([instance.order_id])
+
+
+@receiver(user_logged_in)
+def merge_cart_on_login(sender, request, user, **kwargs):
+    """Анонимная корзина из сессии переезжает в корзину пользователя."""
+    if request is not None:
+        merge_session_cart(request, user)
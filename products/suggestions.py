@@ -0,0 +1,208 @@
+# products/suggestions.py
+"""
+Подсказки "Возможно, вы имели в виду?" на триграммном индексе.
+
+Для каждого названия (товар, категория, подкатегория) и для каждого слова
+из этих названий заранее считается множество триграмм. Поиск кандидатов
+устроен как в SimString (CPMerge):
+
+* похожие по Жаккару строки имеют близкое число триграмм, поэтому постинги
+  разбиты по размеру и просматриваются только подходящие размеры;
+* для размера l нужно не меньше tau общих триграмм, значит кандидатов
+  достаточно собрать из |Q| - tau + 1 самых коротких постингов, а остальные
+  постинги использовать только для проверки.
+
+Оставшиеся кандидаты переранжируются через difflib.SequenceMatcher.
+"""
+import difflib
+import math
+import threading
+from collections import Counter, defaultdict
+
+from django.db import transaction
+
+from .search import tokenize
+
+PRODUCT = 'product'
+CATEGORY = 'category'
+SUBCATEGORY = 'subcategory'
+
+# Слова короче не индексируются отдельно — подсказки по ним бессмысленны
+MIN_WORD_LENGTH = 4
+
+
+def normalize_name(name):
+    return ' '.join(tokenize(name))
+
+
+def trigrams(text):
+    """Триграммы строки с дополнением пробелами по краям (как в pg_trgm)."""
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TrigramIndex:
+    """
+    Триграммный индекс названий в памяти процесса.
+
+    Записи адресуются ключом (kind, pk). Одна строка (название или слово)
+    может принадлежать нескольким записям, поэтому у строк есть счётчик
+    ссылок, а постинги (trigram, size) -> {строка} хранят каждую строку один раз.
+    """
+    MAX_RERANK = 50
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._entries = {}                  # (kind, pk) -> (строки записи)
+        self._display = {}                  # строка -> исходное написание
+        self._refs = Counter()              # строка -> число записей
+        self._grams = {}                    # строка -> frozenset триграмм
+        self._postings = defaultdict(set)   # (trigram, size) -> {строка}
+        self._sizes = Counter()             # size -> число строк такого размера
+        self._built = False
+
+    # --- построение / обновление ---
+
+    def _add_string(self, norm, display):
+        self._refs[norm] += 1
+        if self._refs[norm] > 1:
+            return
+        grams = frozenset(trigrams(norm))
+        size = len(grams)
+        self._grams[norm] = grams
+        self._display[norm] = display
+        self._sizes[size] += 1
+        for gram in grams:
+            self._postings[(gram, size)].add(norm)
+
+    def _release_string(self, norm):
+        self._refs[norm] -= 1
+        if self._refs[norm] > 0:
+            return
+        del self._refs[norm]
+        self._display.pop(norm, None)
+        grams = self._grams.pop(norm, ())
+        size = len(grams)
+        self._sizes[size] -= 1
+        if self._sizes[size] <= 0:
+            del self._sizes[size]
+        for gram in grams:
+            names = self._postings.get((gram, size))
+            if names is not None:
+                names.discard(norm)
+                if not names:
+                    del self._postings[(gram, size)]
+
+    def _add(self, key, name):
+        self._discard(key)
+        norm = normalize_name(name)
+        if not norm:
+            return
+        strings = {norm: name.strip()}
+        for word in norm.split():
+            if len(word) >= MIN_WORD_LENGTH and not word.isdigit():
+                strings.setdefault(word, word)
+        self._entries[key] = tuple(strings)
+        for string, display in strings.items():
+            self._add_string(string, display)
+
+    def _discard(self, key):
+        for string in self._entries.pop(key, ()):
+            self._release_string(string)
+
+    def rebuild(self):
+        from .models import Category, Product, SubCategory
+
+        with self._lock:
+            self._entries.clear()
+            self._display.clear()
+            self._refs.clear()
+            self._grams.clear()
+            self._postings.clear()
+            self._sizes.clear()
+            for kind, model in ((PRODUCT, Product), (CATEGORY, Category), (SUBCATEGORY, SubCategory)):
+                for pk, name in model._base_manager.values_list('pk', 'name').iterator(chunk_size=2000):
+                    self._add((kind, pk), name)
+            self._built = True
+
+    def ensure_built(self):
+        if not self._built:
+            self.rebuild()
+
+    def update(self, kind, pk, name):
+        def apply():
+            with self._lock:
+                if self._built:
+                    self._add((kind, pk), name)
+
+        transaction.on_commit(apply)
+
+    def remove(self, kind, pk):
+        def apply():
+            with self._lock:
+                self._discard((kind, pk))
+
+        transaction.on_commit(apply)
+
+    # --- поиск ---
+
+    def _candidates(self, query_grams, min_similarity):
+        """Строки с коэффициентом Жаккара >= min_similarity (CPMerge)."""
+        q = len(query_grams)
+        found = []
+        min_size = math.ceil(min_similarity * q)
+        max_size = math.floor(q / min_similarity)
+        for size in self._sizes:
+            if not min_size <= size <= max_size:
+                continue
+            tau = math.ceil(min_similarity * (q + size) / (1 + min_similarity))
+            lists = sorted(
+                (self._postings.get((gram, size), ()) for gram in query_grams),
+                key=len,
+            )
+            signature, rest = lists[:q - tau + 1], lists[q - tau + 1:]
+            counts = Counter()
+            for names in signature:
+                counts.update(names)
+            for name, overlap in counts.items():
+                needed = tau - overlap
+                for i, names in enumerate(rest):
+                    if needed <= 0 or needed > len(rest) - i:
+                        break
+                    if name in names:
+                        overlap += 1
+                        needed -= 1
+                if overlap >= tau:
+                    found.append((overlap / (q + size - overlap), name))
+        return found
+
+    def suggest(self, query, limit=5, cutoff=0.6, min_similarity=0.4):
+        """
+        Возвращает до limit названий или слов, похожих на query.
+        min_similarity — порог Жаккара по триграммам для отбора кандидатов,
+        cutoff — порог difflib-ratio для финального ответа (как раньше в
+        difflib.get_close_matches).
+        """
+        norm = normalize_name(query)
+        if not norm:
+            return []
+        self.ensure_built()
+        query_grams = trigrams(norm)
+        with self._lock:
+            candidates = self._candidates(query_grams, min_similarity)
+            candidates.sort(key=lambda item: -item[0])
+            matcher = difflib.SequenceMatcher()
+            matcher.set_seq2(norm)
+            scored = []
+            for jaccard, name in candidates[:self.MAX_RERANK]:
+                if name == norm:
+                    continue
+                matcher.set_seq1(name)
+                ratio = matcher.ratio()
+                if ratio >= cutoff:
+                    scored.append((ratio, jaccard, self._display[name]))
+        scored.sort(key=lambda item: (-item[0], -item[1], item[2]))
+        return [name for _, _, name in scored[:limit]]
+
+
+trigram_index = TrigramIndex()
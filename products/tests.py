@@ -1 +1,1431 @@
-# Create your tests here.
+# products/tests.py
+
+import json
+import sys
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.messages import get_messages
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from products.cart import Cart, cart_summary
+from products.context_processors import cart_total_amount
+from products.currency import convert, currency_symbol, exchange_rates, localize_prices
+from products.autocomplete import AutocompleteIndex, autocomplete_index
+from products.facets import compute_facets, get_facets
+from products.analytics import SearchQueryBuffer, search_query_log
+from products.apps import serves_requests
+from products.highlight import highlight_products
+from products.lifecycle import InvalidTransitionError, transition_orders
+from products.navigation import get_navigation_tree
+from products.models import (
+    CartLine,
+    Category,
+    ExchangeRate,
+    Order,
+    OrderHistoryEntry,
+    OrderItem,
+    OrderStatusEvent,
+    Product,
+    ProductSearchDocument,
+    SearchQueryLog,
+    StockReservation,
+    SubCategory,
+    UserCart,
+    UserOrderSummary,
+)
+from products.pagination import KeysetPaginator
+from products.reservations import available_stock, release_expired, reserve
+from products.services import InsufficientStockError, place_order
+from products.search import (
+    PythonSearchIndex,
+    SQLiteFTSSearchIndex,
+    document_fields,
+    fold,
+    fts5_available,
+    get_search_backend,
+    query_signature,
+    search_result_cache,
+)
+from products.suggestions import SUBCATEGORY, TrigramIndex
+
+User = get_user_model()
+
+
+@override_settings(SEARCH_LOG_ENABLED=False)
+class SearchBackendTests(TestCase):
+    """Тесты полнотекстового поиска (FTS5 и индекс в памяти)."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.laptops = Category.objects.create(name="Ноутбуки")
+        cls.phones = Category.objects.create(name="Телефоны")
+        cls.lenovo = Product.objects.create(
+            name="Lenovo IdeaPad", price=1000, image="products/sample.jpg", category=cls.laptops,
+            description="<p>Лёгкий <strong>ноутбук</strong> для работы</p>",
+        )
+        cls.iphone = Product.objects.create(
+            name="iPhone 15", price=2000, image="products/sample.jpg", category=cls.phones,
+            description="<p>Смартфон с отличной камерой</p>",
+        )
+        cls.case = Product.objects.create(
+            name="Чехол для ноутбука", price=50, image="products/sample.jpg", category=cls.phones,
+            description="<p>Аксессуар</p>",
+        )
+
+    def test_python_index_ranks_by_field_weights(self):
+        index = PythonSearchIndex()
+        index.rebuild()
+        self.assertEqual(set(index.search("ноутбук")), {self.lenovo.id, self.case.id})
+        # Совпадение в названии весит больше, чем в описании
+        self.assertEqual(index.search("аксессуар ноутбук"), [self.case.id])
+        self.assertEqual(index.search("для"), [self.case.id, self.lenovo.id])
+
+    def test_python_index_strips_html_and_uses_prefixes(self):
+        index = PythonSearchIndex()
+        index.rebuild()
+        self.assertEqual(index.search("strong"), [])
+        self.assertEqual(index.search("смарт"), [self.iphone.id])
+        # Токены объединяются по AND
+        self.assertEqual(index.search("iphone камерой"), [self.iphone.id])
+        self.assertEqual(index.search("iphone ноутбук"), [])
+
+    def test_python_index_incremental_updates(self):
+        index = PythonSearchIndex()
+        index.rebuild()
+        self.iphone.name = "Galaxy S24"
+        with self.captureOnCommitCallbacks(execute=True):
+            index.update_document(ProductSearchDocument(product_id=self.iphone.pk, **document_fields(self.iphone)))
+            index.remove_product(self.case.id)
+        self.assertEqual(index.search("galaxy"), [self.iphone.id])
+        self.assertEqual(index.search("iphone"), [])
+        self.assertEqual(index.search("чехол"), [])
+
+    def test_fts_index_follows_product_changes(self):
+        if not fts5_available():
+            self.skipTest("SQLite собран без FTS5")
+        self.assertIsInstance(get_search_backend(), SQLiteFTSSearchIndex)
+        index = SQLiteFTSSearchIndex()
+        self.assertEqual(index.search("для"), [self.case.id, self.lenovo.id])
+
+        self.case.delete()
+        self.lenovo.name = "ThinkPad X1"
+        self.lenovo.save()
+        self.assertEqual(index.search("ноутбук"), [self.lenovo.id])
+        self.assertEqual(index.search("thinkpad"), [self.lenovo.id])
+
+        self.phones.name = "Смартфоны"
+        self.phones.save()
+        self.assertEqual(index.search("смартфоны"), [self.iphone.id])
+
+    def test_documents_are_normalized_and_follow_categories(self):
+        sub = SubCategory.objects.create(name="Ультрабуки", category=self.laptops)
+        self.lenovo.subcategory = sub
+        self.lenovo.save()
+        document = ProductSearchDocument.objects.get(product=self.lenovo)
+        self.assertEqual(document.description, "лёгкий ноутбук для работы".replace("ё", "е"))
+        self.assertEqual((document.category, document.subcategory), ("ноутбуки", "ультрабуки"))
+
+        self.laptops.name = "Лэптопы"
+        self.laptops.save()
+        sub.name = "Тонкие"
+        sub.save()
+        document.refresh_from_db()
+        self.assertEqual((document.category, document.subcategory), ("лэптопы", "тонкие"))
+        self.assertEqual(get_search_backend().search("тонкие лэптопы"), [self.lenovo.id])
+
+        sub.delete()
+        document.refresh_from_db()
+        self.assertEqual(document.subcategory, "")
+        self.assertEqual(get_search_backend().search("тонкие"), [])
+
+    def test_accent_folding(self):
+        self.assertEqual(fold("Café Ёлка Йогурт"), "cafe елка йогурт")
+        index = PythonSearchIndex()
+        index.rebuild()
+        self.assertEqual(index.search("легкий"), [self.lenovo.id])
+
+    def test_rebuild_command_recreates_documents(self):
+        ProductSearchDocument.objects.all().delete()
+        call_command('rebuild_search_index', chunk_size=2, stdout=StringIO())
+        self.assertEqual(ProductSearchDocument.objects.count(), 3)
+        self.assertEqual(get_search_backend().search("чехол"), [self.case.id])
+
+    def test_product_search_view(self):
+        response = self.client.get(reverse('products:product_search'), {'q': 'ноутбук'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['selected_sort'], 'relevance')
+        self.assertEqual(
+            {p.id for p in response.context['page_obj']},
+            {self.case.id, self.lenovo.id},
+        )
+
+
+class TrigramSuggestionTests(TestCase):
+    """Тесты подсказок "Возможно, вы имели в виду?"."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name="Смартфоны")
+        cls.subcategory = SubCategory.objects.create(name="Наушники", category=cls.category)
+        cls.product = Product.objects.create(
+            name="Samsung Galaxy", price=100, category=cls.category, description="",
+        )
+
+    def setUp(self):
+        self.index = TrigramIndex()
+        self.index.rebuild()
+
+    def test_suggests_products_categories_and_subcategories(self):
+        self.assertEqual(self.index.suggest("samsng galaxy"), ["Samsung Galaxy"])
+        self.assertEqual(self.index.suggest("смартфоын"), ["Смартфоны"])
+        self.assertEqual(self.index.suggest("наушнеки"), ["Наушники"])
+        # Отдельные слова из названий тоже подсказываются
+        self.assertIn("galaxy", self.index.suggest("galaxi"))
+        self.assertEqual(self.index.suggest("холодильник"), [])
+
+    def test_incremental_updates(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.name = "Xiaomi Redmi"
+            self.product.save()
+            self.index.update('product', self.product.pk, self.product.name)
+            self.index.remove('subcategory', self.subcategory.pk)
+        self.assertEqual(self.index.suggest("samsng galaxy"), [])
+        self.assertEqual(self.index.suggest("xiaomi redmy")[0], "Xiaomi Redmi")
+        self.assertEqual(self.index.suggest("наушнеки"), [])
+
+
+class AutocompleteTests(TestCase):
+    """Тесты префиксного автодополнения (search_suggestions)."""
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user(username="buyer", password="12345")
+        cls.category = Category.objects.create(name="Смартфоны")
+        cls.subcategory = SubCategory.objects.create(name="Смарт-часы", category=cls.category)
+        cls.galaxy = Product.objects.create(name="Samsung Galaxy S24", price=100, category=cls.category)
+        cls.note = Product.objects.create(name="Samsung Galaxy Note", price=100, category=cls.category)
+        cls.tab = Product.objects.create(name="Samsung Tab", price=100, category=cls.category)
+        order = Order.objects.create(user=user)
+        OrderItem.objects.create(order=order, product=cls.note, price=100, quantity=5)
+        OrderItem.objects.create(order=order, product=cls.tab, price=100, quantity=1)
+
+    def setUp(self):
+        self.index = AutocompleteIndex()
+        self.index.rebuild()
+
+    def test_prefix_matches_any_word_ranked_by_popularity(self):
+        result = self.index.search("sams")
+        self.assertEqual(
+            [p['id'] for p in result['products']],
+            [self.note.id, self.tab.id, self.galaxy.id],
+        )
+        result = self.index.search("galaxy")
+        self.assertEqual([p['id'] for p in result['products']], [self.note.id, self.galaxy.id])
+        result = self.index.search("смарт")
+        self.assertEqual(result['categories'], [{'slug': self.category.slug, 'name': "Смартфоны"}])
+        self.assertEqual(result['subcategories'][0]['category_slug'], self.category.slug)
+
+    @override_settings(SEARCH_SUGGESTIONS_LIMIT=2)
+    def test_result_cap(self):
+        self.assertEqual(len(self.index.search("samsung")['products']), 2)
+        self.assertEqual(len(self.index.search("samsung", limit=1)['products']), 1)
+        self.assertEqual(len(self.index.search("samsung", limit=50)['products']), 2)
+
+    def test_signals_update_index(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.index.update_product(Product(pk=self.tab.pk, name="Apple iPad"))
+            self.index.remove('product', self.galaxy.pk)
+        self.assertEqual([p['id'] for p in self.index.search("samsung")['products']], [self.note.id])
+        self.assertEqual(self.index.search("ipad")['products'], [{'id': self.tab.pk, 'name': "Apple iPad"}])
+
+    def test_built_on_first_search(self):
+        index = AutocompleteIndex()
+        with mock.patch.object(index, '_load', wraps=index._load) as load:
+            self.assertEqual(len(index.search("galaxy")['products']), 2)
+            index.search("note")
+        load.assert_called_once()
+
+    def test_falls_back_to_database_when_build_is_discarded(self):
+        index = AutocompleteIndex()
+        with mock.patch.object(index, 'rebuild'), self.assertLogs('products.autocomplete', 'WARNING'):
+            result = index.search("galaxy")
+        self.assertEqual([p['id'] for p in result['products']], [self.note.id, self.galaxy.id])
+        self.assertFalse(index._built)
+
+    def test_signals_refresh_popularity_and_category_slug(self):
+        autocomplete_index.rebuild()
+        with self.captureOnCommitCallbacks(execute=True):
+            order = Order.objects.create(user=User.objects.get(username="buyer"))
+            OrderItem.objects.create(order=order, product=self.galaxy, price=100, quantity=10)
+            Product.objects.create(
+                name="Часы", price=100, category=self.category, subcategory=self.subcategory,
+            )
+            self.category.slug = "smartphones-new"
+            self.category.save()
+        result = autocomplete_index.search("samsung")
+        self.assertEqual([p['id'] for p in result['products']], [self.galaxy.id, self.note.id, self.tab.id])
+        subcategory, = [
+            entry for entry in autocomplete_index._entries.values() if entry.kind == SUBCATEGORY
+        ]
+        self.assertEqual(subcategory.popularity, 1)
+        self.assertEqual(subcategory.payload['category_slug'], "smartphones-new")
+
+    @mock.patch.dict('os.environ', {'RUN_MAIN': 'true'})
+    def test_warm_up_only_for_servers(self):
+        for argv, expected in (
+            (['manage.py', 'migrate'], False),
+            (['manage.py', 'test'], False),
+            (['manage.py', 'runserver'], True),
+            (['gunicorn', 'InternetStore.wsgi'], True),
+        ):
+            with mock.patch.object(sys, 'argv', argv):
+                self.assertIs(serves_requests(), expected)
+
+    def test_view_does_not_query_database(self):
+        autocomplete_index.rebuild()
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('products:search_suggestions'), {'q': 'Galaxy'})
+        self.assertEqual(len(response.json()['products']), 2)
+
+
+@override_settings(SEARCH_LOG_ENABLED=False)
+class SearchResultCacheTests(TestCase):
+    """Тесты кеша результатов поиска (id + total вместо QuerySet)."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name="Мониторы")
+        cls.products = [
+            Product.objects.create(
+                name=f"Монитор {i}", price=100 + i, category=cls.category,
+                description="", image="products/sample.jpg",
+            )
+            for i in range(15)
+        ]
+
+    def setUp(self):
+        cache.clear()
+
+    def product_queries(self, context):
+        return [q for q in context.captured_queries if 'products_product' in q['sql']]
+
+    def test_signature_is_normalized(self):
+        self.assertEqual(
+            query_signature("  Монитор  ", sort='price', category=''),
+            query_signature("монитор", sort='price'),
+        )
+        self.assertNotEqual(query_signature("монитор", sort='price'), query_signature("монитор", sort='name'))
+        self.assertNotEqual(query_signature("!!!", sort='name'), query_signature("", sort='name'))
+
+    @override_settings(PRODUCT_PAGINATION_MODE='page')
+    def test_query_without_tokens_does_not_poison_catalog(self):
+        url = reverse('products:product_search')
+        response = self.client.get(url, {'q': '!!!', 'sort': 'name'})
+        self.assertEqual(response.context['total_results'], 0)
+        response = self.client.get(url, {'sort': 'name'})
+        self.assertEqual(response.context['total_results'], 15)
+        self.assertEqual(response.context['facets']['total'], 15)
+
+    @override_settings(PRODUCT_PAGINATION_MODE='page')
+    def test_matches_are_checked_in_chunks(self):
+        url = reverse('products:product_search')
+        ranked = get_search_backend().search('монитор')
+        with mock.patch('products.search.ID_CHUNK_SIZE', 4):
+            response = self.client.get(url, {'q': 'монитор', 'sort': '-price'})
+            self.assertEqual(
+                [p.id for p in response.context['page_obj']],
+                [p.id for p in reversed(self.products)][:12],
+            )
+            self.assertEqual(response.context['facets']['total'], 15)
+            self.assertEqual(response.context['facets']['categories'][0]['count'], 15)
+            response = self.client.get(url, {'q': 'монитор', 'price_min': '110'})
+            self.assertEqual(response.context['total_results'], 5)
+            self.assertEqual(
+                [p.id for p in response.context['page_obj']],
+                [pk for pk in ranked if pk in {p.id for p in self.products[10:]}],
+            )
+
+    def test_cache_hit_costs_one_primary_key_query(self):
+        url = reverse('products:product_search')
+        params = {'q': 'монитор', 'sort': 'price', 'page': 2}
+        hits = search_result_cache.hits
+        self.client.get(url, params)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, params)
+        self.assertEqual(search_result_cache.hits, hits + 1)
+        queries = self.product_queries(context)
+        self.assertEqual(len(queries), 1)
+        self.assertIn(' IN (', queries[0]['sql'])
+        self.assertEqual(response.context['total_results'], 15)
+        self.assertEqual(
+            [p.id for p in response.context['page_obj']],
+            [p.id for p in self.products[12:]],
+        )
+
+    def test_catalog_change_invalidates_results(self):
+        url = reverse('products:product_search')
+        self.client.get(url, {'q': 'монитор'})
+        Product.objects.create(
+            name="Монитор новый", price=1, category=self.category,
+            description="", image="products/sample.jpg",
+        )
+        misses = search_result_cache.misses
+        response = self.client.get(url, {'q': 'монитор'})
+        self.assertEqual(search_result_cache.misses, misses + 1)
+        self.assertEqual(response.context['total_results'], 16)
+
+    @override_settings(SEARCH_RESULTS_CACHE_MAX_IDS=5, PRODUCT_PAGINATION_MODE='page')
+    def test_deep_catalog_pages_beyond_cached_prefix(self):
+        response = self.client.get(reverse('products:product_search'), {'sort': 'price', 'page': 2})
+        self.assertEqual(response.context['total_results'], 15)
+        self.assertEqual(
+            [p.id for p in response.context['page_obj']],
+            [p.id for p in self.products[12:]],
+        )
+
+
+class KeysetPaginationTests(TestCase):
+    """Тесты keyset-пагинации каталога."""
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name="Клавиатуры")
+        # Одинаковые цены проверяют tie-breaker по id
+        cls.products = [
+            Product.objects.create(
+                name=f"Клавиатура {i:02d}", price=100 + i // 3, category=category,
+                description="", image="products/sample.jpg",
+            )
+            for i in range(14)
+        ]
+
+    def walk(self, ordering):
+        paginator = KeysetPaginator(Product.objects.all(), 4, ordering=ordering)
+        pages, cursor = [], None
+        while True:
+            page = paginator.page(cursor)
+            pages.append(page)
+            if not page.has_next():
+                return paginator, pages
+            cursor = page.next_cursor
+
+    def test_forward_walk_matches_offset_order(self):
+        for ordering in ('price', '-price', 'name', '-created_at'):
+            _, pages = self.walk(ordering)
+            field = ordering.lstrip('-')
+            expected = list(Product.objects.order_by(ordering, f"{'-' if ordering[0] == '-' else ''}id"))
+            self.assertEqual([p for page in pages for p in page], expected, ordering)
+            self.assertEqual([len(page) for page in pages], [4, 4, 4, 2], field)
+            self.assertFalse(pages[0].has_previous())
+
+    def test_previous_cursor_returns_previous_page(self):
+        paginator, pages = self.walk('-price')
+        previous = paginator.page(pages[2].previous_cursor)
+        self.assertEqual(list(previous), list(pages[1]))
+        self.assertTrue(previous.has_next())
+        first = paginator.page(pages[1].previous_cursor)
+        self.assertEqual(list(first), list(pages[0]))
+        self.assertFalse(first.has_previous())
+
+    def test_ordering_limited_to_allowed_fields(self):
+        self.assertEqual(KeysetPaginator(Product.objects.all(), 4, ordering='-stock').ordering, '-created_at')
+        paginator = KeysetPaginator(Product.objects.all(), 4, ordering='-price', fields=('name',))
+        self.assertEqual(paginator.ordering, '-name')
+        self.assertEqual(list(paginator.page(None)), list(Product.objects.order_by('-name', '-id')[:4]))
+
+    def test_invalid_or_foreign_cursor_starts_from_first_page(self):
+        paginator, pages = self.walk('price')
+        other = KeysetPaginator(Product.objects.all(), 4, ordering='name')
+        self.assertEqual(list(other.page(pages[0].next_cursor)), list(other.page(None)))
+        self.assertEqual(list(paginator.page('garbage')), list(pages[0]))
+
+    @override_settings(PRODUCT_PAGINATION_MODE='cursor')
+    def test_product_list_uses_cursor_without_count(self):
+        cache.clear()
+        url = reverse('products:product_list')
+        response = self.client.get(url, {'ordering': 'price'})
+        self.assertTrue(response.context['cursor_pagination'])
+        self.assertEqual(response.context['approx_total'], 14)
+        cursor = response.context['page_obj'].next_cursor
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, {'ordering': 'price', 'cursor': cursor})
+        self.assertFalse([q for q in context.captured_queries if 'COUNT(' in q['sql']])
+        self.assertEqual(list(response.context['products']), self.products[12:])
+        self.assertFalse(response.context['page_obj'].has_next())
+
+    @override_settings(PRODUCT_PAGINATION_MODE='cursor', SEARCH_LOG_ENABLED=False)
+    def test_catalog_search_cursor_skips_id_cache_and_count(self):
+        cache.clear()
+        url = reverse('products:product_search')
+        response = self.client.get(url, {'sort': 'price'})
+        self.assertTrue(response.context['cursor_pagination'])
+        self.assertEqual(response.context['total_results'], 14)
+        cursor = response.context['page_obj'].next_cursor
+        with mock.patch.object(search_result_cache, 'get') as cache_get, \
+                CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, {'sort': 'price', 'cursor': cursor})
+        cache_get.assert_not_called()
+        self.assertFalse([q for q in context.captured_queries if 'COUNT(' in q['sql']])
+        self.assertEqual(list(response.context['page_obj']), self.products[12:])
+
+
+@override_settings(SEARCH_FACET_PRICE_BUCKETS=(100, 500), SEARCH_LOG_ENABLED=False)
+class FacetTests(TestCase):
+    """Тесты фасетов каталога и поиска."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.audio = Category.objects.create(name="Аудио")
+        cls.video = Category.objects.create(name="Видео")
+        cls.headphones = SubCategory.objects.create(name="Наушники", category=cls.audio)
+        cls.speakers = SubCategory.objects.create(name="Колонки", category=cls.audio)
+        for name, price, stock, category, subcategory in (
+            ("Наушники Sony", 50, 3, cls.audio, cls.headphones),
+            ("Наушники JBL", 150, 0, cls.audio, cls.headphones),
+            ("Колонка Marshall", 700, 1, cls.audio, cls.speakers),
+            ("Телевизор LG", 900, 2, cls.video, None),
+        ):
+            Product.objects.create(
+                name=name, price=price, stock=stock, category=category, subcategory=subcategory,
+                description="", image="products/sample.jpg",
+            )
+
+    def setUp(self):
+        cache.clear()
+
+    def test_counts_in_one_query(self):
+        with self.assertNumQueries(1):
+            facets = compute_facets(Product.objects.all())
+        self.assertEqual(facets['total'], 4)
+        self.assertEqual(facets['in_stock'], 3)
+        self.assertEqual(
+            [(c['name'], c['count']) for c in facets['categories']],
+            [("Аудио", 3), ("Видео", 1)],
+        )
+        self.assertEqual(
+            [(s['name'], s['count']) for s in facets['subcategories']],
+            [("Наушники", 2), ("Колонки", 1)],
+        )
+        self.assertEqual(
+            [(b['min'], b['max'], b['count']) for b in facets['price_buckets']],
+            [(0, 100, 1), (100, 500, 1), (500, None, 2)],
+        )
+
+    def test_facets_follow_filters(self):
+        facets = compute_facets(Product.objects.filter(category=self.audio, stock__gt=0))
+        self.assertEqual(facets['total'], 2)
+        self.assertEqual([c['name'] for c in facets['categories']], ["Аудио"])
+
+    def test_cached_per_signature_until_catalog_changes(self):
+        signature = query_signature('', category=self.audio.pk)
+        queryset = Product.objects.filter(category=self.audio)
+        get_facets(queryset, signature)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_facets(queryset, signature)['total'], 3)
+        Product.objects.create(
+            name="Наушники Bose", price=300, category=self.audio, description="", image="products/sample.jpg",
+        )
+        self.assertEqual(get_facets(queryset, signature)['total'], 4)
+
+    def test_views_expose_facets(self):
+        response = self.client.get(reverse('products:product_list'), {'subcategory': self.headphones.pk})
+        self.assertEqual(response.context['facets']['total'], 2)
+        response = self.client.get(reverse('products:product_search'), {'q': 'наушники', 'in_stock': '1'})
+        self.assertEqual(response.context['facets']['total'], 1)
+        self.assertEqual(response.context['facets']['subcategories'][0]['slug'], self.headphones.slug)
+
+    def test_unassigned_products_only_on_category_page(self):
+        unassigned = Product.objects.create(
+            name="Проигрыватель", price=400, category=self.audio, description="", image="products/sample.jpg",
+        )
+        response = self.client.get(
+            reverse('products:subcategory_detail', args=[self.audio.slug, self.speakers.slug])
+        )
+        self.assertEqual([p.name for p in response.context['products']], ["Колонка Marshall"])
+        response = self.client.get(reverse('products:product_list'), {'subcategory': self.speakers.pk})
+        self.assertEqual(response.context['facets']['total'], 1)
+        response = self.client.get(reverse('products:product_search'), {'subcategory': self.speakers.slug})
+        self.assertEqual(response.context['total_results'], 1)
+        speakers, = [s for s in get_navigation_tree()[0]['subcategories'] if s['id'] == self.speakers.pk]
+        self.assertEqual(speakers['products_count'], 1)
+        response = self.client.get(reverse('products:category_detail', args=[self.audio.slug]))
+        self.assertIn(unassigned.name, {p.name for p in response.context['products']})
+
+    def test_subcategory_must_belong_to_category(self):
+        product = Product(
+            name="Проектор", price=500, category=self.video, subcategory=self.speakers,
+            description="", image="products/sample.jpg",
+        )
+        with self.assertRaises(ValidationError) as raised:
+            product.clean()
+        self.assertIn('subcategory', raised.exception.message_dict)
+        product.subcategory = None
+        product.clean()
+
+
+@override_settings(SEARCH_SNIPPET_LENGTH=60)
+class HighlightTests(TestCase):
+    """Тесты подсветки результатов поиска."""
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name="Мониторы")
+        cls.product = Product.objects.create(
+            name="Монитор <Dell> UltraSharp", price=500, category=category, image="products/sample.jpg",
+            description="<p>" + "Вступление без совпадений. " * 10
+                        + "Матрица <strong>IPS</strong> и подставка &amp; кабель</p>",
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def test_case_insensitive_multi_term_marks_are_escaped(self):
+        product, = highlight_products([self.product], "монитор ips")
+        self.assertEqual(
+            product.highlighted_name,
+            "<mark>Монитор</mark> &lt;Dell&gt; UltraSharp",
+        )
+        description = product.highlighted_description
+        self.assertIn("<mark>IPS</mark>", description)
+        self.assertIn("&amp; кабель", description)
+        self.assertNotIn("<strong>", description)
+        self.assertTrue(description.startswith("… "))
+        self.assertLessEqual(len(description.replace("<mark>", "").replace("</mark>", "")), 60 + 10)
+
+    def test_snippets_are_cached_per_query_terms(self):
+        highlight_products([self.product], "ips матрица")
+        with mock.patch('products.highlight.html_to_text') as html_to_text:
+            product, = highlight_products([self.product], "Матрица IPS")
+            html_to_text.assert_not_called()
+        self.assertIn("<mark>Матрица</mark>", product.highlighted_description)
+        with mock.patch('products.highlight.html_to_text') as html_to_text:
+            # Новый запрос: фрагмент строится заново, но из закешированного текста
+            product, = highlight_products([self.product], "подставка")
+            html_to_text.assert_not_called()
+        self.assertIn("<mark>подставка</mark>", product.highlighted_description)
+
+
+@override_settings(SEARCH_LOG_FLUSH_INTERVAL=None, SEARCH_LOG_BATCH_SIZE=3)
+class SearchQueryLogTests(TestCase):
+    """Тесты журнала поисковых запросов."""
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name="Книги")
+        Product.objects.create(
+            name="Мастер и Маргарита", price=300, category=category, description="", image="products/sample.jpg",
+        )
+
+    def setUp(self):
+        cache.clear()
+        search_query_log.flush()
+
+    def search(self, query):
+        return self.client.get(reverse('products:product_search'), {'q': query})
+
+    def test_buffered_until_batch_is_full(self):
+        self.search("Мастер")
+        self.search("мастер")
+        self.assertEqual(SearchQueryLog.objects.count(), 0)
+        self.assertEqual(search_query_log.pending(), 2)
+        with self.assertNumQueries(1):
+            search_query_log.record("гарри поттер", {}, 0, 1.5, False)
+        self.assertEqual(search_query_log.pending(), 0)
+
+        first, second, third = SearchQueryLog.objects.order_by('id')
+        self.assertEqual((first.query, first.results_count, first.cache_hit), ("мастер", 1, False))
+        self.assertEqual(first.filters, {'sort': 'relevance'})
+        self.assertTrue(second.cache_hit)
+        self.assertEqual(third.query, "гарри поттер")
+
+    @override_settings(SEARCH_LOG_BUFFER_SIZE=2, SEARCH_LOG_BATCH_SIZE=10)
+    def test_overflow_drops_oldest_and_is_logged(self):
+        buffer = SearchQueryBuffer()
+        for query in ("первый", "второй", "третий"):
+            buffer.record(query, {}, 0, 1.0, False)
+        with self.assertLogs('products.buffering', 'WARNING') as logs:
+            self.assertEqual(buffer.flush(), 2)
+        self.assertIn("потеряно записей: 1", logs.output[0])
+        self.assertEqual(
+            list(SearchQueryLog.objects.order_by('id').values_list('query', flat=True)), ["второй", "третий"],
+        )
+
+    def test_catalog_browsing_is_not_logged(self):
+        self.search("")
+        self.assertEqual(search_query_log.pending(), 0)
+
+    def test_report_command(self):
+        for query, count in (("мастер", 1), ("гарри", 0), ("гарри", 0), ("мастер", 1)):
+            search_query_log.record(query, {}, count, 10.0 if count else 40.0, False)
+        out = StringIO()
+        call_command('search_report', stdout=out)
+        report = out.getvalue()
+        self.assertIn("Всего запросов: 4", report)
+        zero_section = report.split("Запросы без результатов")[1]
+        self.assertIn("гарри", zero_section)
+        self.assertNotIn("мастер", zero_section)
+        slow_section = report.split("Самые медленные запросы")[1].split("Запросы без результатов")[0]
+        self.assertLess(slow_section.index("гарри"), slow_section.index("мастер"))
+
+
+class NavigationTreeTests(TestCase):
+    """Тесты закешированного дерева категорий."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.tools = Category.objects.create(name="Инструменты", icon="fas fa-tools")
+        cls.drills = SubCategory.objects.create(name="Дрели", category=cls.tools)
+        Category.objects.create(name="Сад", icon="fas fa-leaf")
+        for stock in (0, 5):
+            Product.objects.create(
+                name=f"Дрель {stock}", price=100, stock=stock, category=cls.tools, subcategory=cls.drills,
+                description="", image="products/sample.jpg",
+            )
+
+    def setUp(self):
+        cache.clear()
+
+    def test_tree_counts(self):
+        with self.assertNumQueries(2):
+            tree = get_navigation_tree()
+        self.assertEqual([c['name'] for c in tree], ["Инструменты", "Сад"])
+        tools = tree[0]
+        self.assertEqual((tools['products_count'], tools['in_stock_count']), (2, 1))
+        self.assertEqual(tools['url'], self.tools.get_absolute_url())
+        drills, = tools['subcategories']
+        self.assertEqual((drills['products_count'], drills['in_stock_count']), (2, 1))
+        self.assertEqual(drills['url'], self.drills.get_absolute_url())
+        with self.assertNumQueries(0):
+            get_navigation_tree()
+
+    def test_rebuilt_after_catalog_changes(self):
+        get_navigation_tree()
+        SubCategory.objects.create(name="Пилы", category=self.tools)
+        self.assertEqual(len(get_navigation_tree()[0]['subcategories']), 2)
+        Product.objects.filter(subcategory=self.drills).first().delete()
+        self.assertEqual(get_navigation_tree()[0]['products_count'], 1)
+
+    def test_home_queries_do_not_depend_on_category_count(self):
+        url = reverse('products:home')
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as before:
+            self.client.get(url)
+        for i in range(5):
+            category = Category.objects.create(name=f"Категория {i}")
+            SubCategory.objects.create(name=f"Подкатегория {i}", category=category)
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as after:
+            response = self.client.get(url)
+        self.assertEqual(len(after), len(before))
+        self.assertContains(response, "Подкатегория 4")
+
+
+class PlaceOrderTests(TestCase):
+    """Тесты оформления заказа."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="buyer", password="pass12345")
+        category = Category.objects.create(name="Посуда")
+        cls.products = [
+            Product.objects.create(
+                name=f"Кружка {i}", price=10 + i, stock=5, category=category,
+                description="", image="products/sample.jpg",
+            )
+            for i in range(6)
+        ]
+
+    def new_order(self):
+        return Order(
+            user=self.user, first_name="Иван", last_name="Иванов", email="buyer@example.com",
+            address="ул. Пушкина, 1", postal_code="2000", city="Кишинёв", country="MD",
+            payment_method="paypal",
+        )
+
+    def test_constant_number_of_queries(self):
+        with CaptureQueriesContext(connection) as small:
+            place_order(self.new_order(), {self.products[0].pk: 1})
+        with CaptureQueriesContext(connection) as large:
+            place_order(self.new_order(), {p.pk: 2 for p in self.products})
+        self.assertEqual(len(small), len(large))
+
+    def test_stock_items_and_total(self):
+        order = place_order(self.new_order(), {self.products[0].pk: 2, self.products[1].pk: 3})
+        order.refresh_from_db()
+        self.assertEqual(order.total_amount, 2 * 10 + 3 * 11)
+        self.assertEqual(
+            sorted(order.items.values_list('product_id', 'price', 'quantity')),
+            [(self.products[0].pk, 10, 2), (self.products[1].pk, 11, 3)],
+        )
+        self.assertEqual(
+            list(Product.objects.filter(pk__in=[self.products[0].pk, self.products[1].pk])
+                 .order_by('pk').values_list('stock', flat=True)),
+            [3, 2],
+        )
+
+    def test_insufficient_stock_rolls_back_everything(self):
+        place_order(self.new_order(), {self.products[1].pk: 4})
+        with self.assertRaises(InsufficientStockError) as raised:
+            place_order(self.new_order(), {self.products[0].pk: 1, self.products[1].pk: 2})
+        self.assertEqual(raised.exception.shortages, [(self.products[1].pk, "Кружка 1", 1)])
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).stock, 5)
+
+    def test_order_create_view(self):
+        self.client.force_login(self.user)
+        self.client.post(reverse('products:add_to_cart', args=[self.products[2].pk]), {'quantity': 2})
+        data = {
+            'first_name': "Иван", 'last_name': "Иванов", 'email': "buyer@example.com",
+            'address': "ул. Пушкина, 1", 'postal_code': "2000", 'city': "Кишинёв",
+            'country': "MD", 'payment_method': "paypal",
+        }
+        response = self.client.post(reverse('products:order_create'), data)
+        self.assertEqual(response.status_code, 302)
+        order = Order.objects.get(user=self.user)
+        self.assertEqual(order.total_amount, 24)
+        self.assertEqual(Product.objects.get(pk=self.products[2].pk).stock, 3)
+        self.assertFalse(CartLine.objects.for_user(self.user).exists())
+        self.assertFalse(StockReservation.objects.exists())
+
+
+class StockReservationTests(TestCase):
+    """Тесты резервирования товара под корзину."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="flash", password="pass12345")
+        category = Category.objects.create(name="Распродажа")
+        cls.product = Product.objects.create(
+            name="Приставка", price=300, stock=3, category=category, description="", image="products/sample.jpg",
+        )
+
+    def order(self):
+        return Order(
+            user=self.user, first_name="Иван", last_name="Иванов", email="flash@example.com",
+            address="ул. Пушкина, 1", postal_code="2000", city="Кишинёв", country="MD",
+            payment_method="paypal",
+        )
+
+    def test_reserve_respects_other_holds(self):
+        self.assertEqual(reserve("alice", self.product, 2), 2)
+        self.assertEqual(reserve("bob", self.product, 5), 1)
+        self.assertEqual(available_stock(self.product, "carol"), 0)
+        # Свой резерв не мешает изменить количество
+        self.assertEqual(reserve("alice", self.product, 1), 1)
+        self.assertEqual(available_stock(self.product, "carol"), 1)
+        self.assertEqual(reserve("carol", self.product, 0), 0)
+        self.assertFalse(StockReservation.objects.filter(holder="carol").exists())
+
+    def test_expired_holds_are_ignored_and_swept(self):
+        reserve("alice", self.product, 3)
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(available_stock(self.product, "bob"), 3)
+        reserve("bob", self.product, 1)
+        with self.assertNumQueries(1):
+            self.assertEqual(release_expired(), 1)
+        self.assertEqual(list(StockReservation.objects.values_list('holder', flat=True)), ["bob"])
+
+    def test_checkout_converts_own_holds_and_respects_others(self):
+        reserve("alice", self.product, 2)
+        reserve("bob", self.product, 1)
+        with self.assertRaises(InsufficientStockError) as raised:
+            place_order(self.order(), {self.product.pk: 3}, holder="bob")
+        self.assertEqual(raised.exception.shortages, [(self.product.pk, "Приставка", 1)])
+
+        place_order(self.order(), {self.product.pk: 1}, holder="bob")
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 2)
+        self.assertEqual(list(StockReservation.objects.values_list('holder', flat=True)), ["alice"])
+        self.assertEqual(available_stock(self.product, "carol"), 0)
+
+    def test_add_to_cart_reserves(self):
+        reserve("other", self.product, 2)
+        url = reverse('products:add_to_cart', args=[self.product.pk])
+        self.client.post(url, {'quantity': 2})
+        self.assertNotIn('cart', self.client.session)
+        self.client.post(url, {'quantity': 1})
+        holder = self.client.session['cart_holder']
+        self.assertEqual(StockReservation.objects.get(holder=holder).quantity, 1)
+        # Проверяется всё количество в корзине, а не только добавляемое
+        response = self.client.post(url, {'quantity': 1})
+        self.assertEqual(
+            str(list(get_messages(response.wsgi_request))[-1]),
+            "Извините, доступно только 1 единиц товара, в корзине уже 1.",
+        )
+        self.assertEqual(StockReservation.objects.get(holder=holder).quantity, 1)
+        self.client.get(reverse('products:cart_remove', args=[self.product.pk]))
+        self.assertFalse(StockReservation.objects.filter(holder=holder).exists())
+
+
+class PersistentCartTests(TestCase):
+    """Тесты серверной корзины и её слияния с анонимной при входе."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="shopper", password="pass12345")
+        category = Category.objects.create(name="Чай")
+        cls.green, cls.black = (
+            Product.objects.create(
+                name=name, price=price, stock=10, category=category, description="", image="products/sample.jpg",
+            )
+            for name, price in (("Зелёный чай", 5), ("Чёрный чай", 7))
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def add(self, product, quantity):
+        self.client.post(reverse('products:add_to_cart', args=[product.pk]), {'quantity': quantity})
+
+    def test_anonymous_visit_does_not_create_session(self):
+        self.client.get(reverse('products:home'))
+        self.assertNotIn('sessionid', self.client.cookies)
+
+    def test_logged_in_cart_lives_in_database(self):
+        self.client.force_login(self.user)
+        self.add(self.green, 2)
+        self.add(self.black, 1)
+        self.add(self.green, 1)
+        self.assertNotIn('cart', self.client.session)
+        self.assertEqual(
+            sorted(CartLine.objects.for_user(self.user).values_list('product_id', 'quantity')),
+            [(self.green.pk, 3), (self.black.pk, 1)],
+        )
+        cart = UserCart.objects.get(user=self.user)
+        self.assertEqual((cart.items_count, cart.total), (4, 22))
+
+    def test_badge_reads_cached_summary(self):
+        self.client.force_login(self.user)
+        self.add(self.green, 2)
+        response = self.client.get(reverse('products:home'))
+        self.assertEqual(response.context['cart_total_items'], 2)
+        cache.clear()
+        self.client.get(reverse('products:home'))
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(reverse('products:home'))
+        self.assertFalse([q for q in context.captured_queries if 'cartline' in q['sql'].lower()])
+        self.assertFalse([q for q in context.captured_queries if 'usercart' in q['sql'].lower()])
+
+    def test_summary_follows_cascade_delete(self):
+        self.client.force_login(self.user)
+        self.add(self.green, 2)
+        self.add(self.black, 1)
+        self.assertEqual(self.client.get(reverse('products:home')).context['cart_total_items'], 3)
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.filter(pk=self.black.pk).delete()
+        cart = UserCart.objects.get(user=self.user)
+        self.assertEqual((cart.items_count, cart.total), (2, 10))
+        self.assertEqual(self.client.get(reverse('products:home')).context['cart_total_items'], 2)
+
+    def test_update_without_stock_removes_line(self):
+        self.client.force_login(self.user)
+        self.add(self.green, 2)
+        Product.objects.filter(pk=self.green.pk).update(stock=0)
+        self.client.post(reverse('products:update_quantity'), {'product_id': self.green.pk, 'quantity': 3})
+        self.assertFalse(CartLine.objects.for_user(self.user).exists())
+        self.assertEqual(UserCart.objects.get(user=self.user).items_count, 0)
+
+    def test_merge_on_login(self):
+        self.client.force_login(self.user)
+        self.add(self.green, 1)
+        self.client.logout()
+
+        self.add(self.green, 2)
+        self.add(self.black, 4)
+        anonymous_holder = self.client.session['cart_holder']
+        self.client.login(username="shopper", password="pass12345")
+
+        self.assertNotIn('cart', self.client.session)
+        self.assertEqual(
+            sorted(CartLine.objects.for_user(self.user).values_list('product_id', 'quantity')),
+            [(self.green.pk, 3), (self.black.pk, 4)],
+        )
+        self.assertFalse(StockReservation.objects.filter(holder=anonymous_holder).exists())
+        self.assertEqual(
+            StockReservation.objects.get(holder=f"user:{self.user.pk}", product=self.green).quantity, 3,
+        )
+
+    def test_merge_drops_line_without_stock(self):
+        self.client.force_login(self.user)
+        self.add(self.green, 1)
+        self.add(self.black, 1)
+        self.client.logout()
+
+        self.add(self.green, 2)
+        Product.objects.filter(pk=self.green.pk).update(stock=0)
+        self.client.login(username="shopper", password="pass12345")
+
+        self.assertEqual(
+            list(CartLine.objects.for_user(self.user).values_list('product_id', 'quantity')),
+            [(self.black.pk, 1)],
+        )
+        cart = UserCart.objects.get(user=self.user)
+        self.assertEqual((cart.items_count, cart.total), (1, 7))
+
+
+class CartSummaryTests(TestCase):
+    """Тесты ленивой сводки корзины для счётчика в шапке."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="badge", password="pass12345")
+        category = Category.objects.create(name="Кофе")
+        cls.product = Product.objects.create(
+            name="Арабика", price=12, stock=10, category=category, description="", image="products/sample.jpg",
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def request(self, user=None):
+        request = RequestFactory().get('/')
+        SessionMiddleware(lambda r: None).process_request(request)
+        request.user = user or AnonymousUser()
+        return request
+
+    def test_summary_not_computed_until_rendered(self):
+        request = self.request(self.user)
+        with self.assertNumQueries(0):
+            cart_total_amount(request)
+        self.assertFalse(hasattr(request, '_cart_summary'))
+
+    def test_summary_memoized_per_request(self):
+        request = self.request(self.user)
+        with self.assertNumQueries(1):
+            self.assertEqual(cart_summary(request), (0, 0))
+            self.assertEqual(cart_summary(request), (0, 0))
+
+    def test_summary_follows_cart_changes(self):
+        request = self.request()
+        self.assertEqual(cart_summary(request)[0], 0)
+        Cart(request).add(self.product, 3)
+        self.assertEqual(cart_summary(request), (3, 36))
+
+    def test_anonymous_badge_does_not_touch_session(self):
+        request = self.request()
+        self.assertEqual(cart_total_amount(request)['cart_total_items'], 0)
+        self.assertFalse(request.session.modified)
+        self.assertIsNone(request.session.session_key)
+
+
+class CurrencyTests(TestCase):
+    """Тесты курсов валют и пересчёта цен."""
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name="Посуда")
+        cls.cup, cls.plate = (
+            Product.objects.create(
+                name=name, price=price, stock=10, category=category, description="", image="products/sample.jpg",
+            )
+            for name, price in (("Чашка", Decimal("19.99")), ("Тарелка", Decimal("10.00")))
+        )
+
+    def setUp(self):
+        cache.clear()
+        exchange_rates.clear()
+
+    def test_convert_rounds_to_cents(self):
+        self.assertEqual(convert(Decimal("10.00"), "USD"), Decimal("0.56"))
+        self.assertEqual(convert(Decimal("19.99"), "EUR"), Decimal("0.96"))
+        self.assertEqual(convert(Decimal("19.99"), "MDL"), Decimal("19.99"))
+        # Неизвестная валюта — базовая
+        self.assertEqual(convert(Decimal("19.99"), "XXX"), Decimal("19.99"))
+
+    def test_rates_loaded_once_per_version(self):
+        convert(1, "USD")
+        with self.assertNumQueries(0):
+            convert(2, "USD")
+            currency_symbol("EUR")
+        with self.captureOnCommitCallbacks(execute=True):
+            ExchangeRate.objects.filter(code="USD").update(rate=Decimal("0.06"))
+            ExchangeRate.objects.get(code="USD").save()
+        with self.assertNumQueries(1):
+            self.assertEqual(convert(Decimal("10.00"), "USD"), Decimal("0.60"))
+
+    def test_cart_total_is_sum_of_converted_lines(self):
+        request = RequestFactory().get('/')
+        SessionMiddleware(lambda r: None).process_request(request)
+        request.user = AnonymousUser()
+        request.session['currency'] = 'EUR'
+        cart = Cart(request)
+        cart.add(self.cup, 3)
+        cart.add(self.plate, 1)
+        items = list(cart)
+        self.assertEqual(
+            sorted(item['price'] for item in items), [Decimal("0.48"), Decimal("0.96")],
+        )
+        self.assertEqual(cart.get_total_price(), Decimal("3.36"))
+        self.assertEqual(cart.get_item_total_price(self.cup), Decimal("2.88"))
+
+    def test_old_price_converted_with_price(self):
+        self.cup.old_price = Decimal("25.00")
+        cup, plate = localize_prices([self.cup, self.plate], "EUR")
+        self.assertEqual((cup.display_price, cup.display_old_price), (Decimal("0.96"), Decimal("1.20")))
+        self.assertIsNone(plate.display_old_price)
+
+    @override_settings(SEARCH_LOG_ENABLED=False)
+    def test_listing_shows_selected_currency(self):
+        session = self.client.session
+        session['currency'] = 'USD'
+        session.save()
+        response = self.client.get(reverse('products:product_search'), {'q': 'Чашка'})
+        self.assertContains(response, "1,12 $")
+
+    def test_cart_page_uses_posted_currency(self):
+        user = User.objects.create_user(username="currency", password="pass12345")
+        self.client.force_login(user)
+        self.client.post(reverse('products:add_to_cart', args=[self.cup.pk]), {'quantity': 3})
+        self.client.get(reverse('products:cart_detail'))
+        response = self.client.post(reverse('products:cart_detail'), {'currency': 'EUR'})
+        self.assertEqual(response.context['currency'], 'EUR')
+        [item] = list(response.context['cart'])
+        self.assertEqual((item['price'], item['total_price']), (Decimal("0.96"), Decimal("2.88")))
+        self.assertEqual(response.context['cart'].get_total_price(), Decimal("2.88"))
+
+
+class HydratedCartTests(TestCase):
+    """Тесты строк корзины, собранных вместе с товарами."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="hydrated", password="pass12345")
+        category = Category.objects.create(name="Канцелярия")
+        cls.pen, cls.pencil = (
+            Product.objects.create(
+                name=name, price=price, stock=10, category=category, description="", image="products/sample.jpg",
+            )
+            for name, price in (("Ручка", Decimal("4.50")), ("Карандаш", Decimal("2.00")))
+        )
+
+    def setUp(self):
+        cache.clear()
+        exchange_rates.clear()
+
+    def cart(self, user=None):
+        request = RequestFactory().get('/')
+        SessionMiddleware(lambda r: None).process_request(request)
+        request.user = user or AnonymousUser()
+        cart = Cart(request)
+        cart.add(self.pen, 2)
+        cart.add(self.pencil, 3)
+        return cart
+
+    def test_products_fetched_once_per_cart(self):
+        cart = self.cart()
+        cart.currency  # курсы читаются один раз на процесс
+        with self.assertNumQueries(1):
+            first = [(item['product'].category.name, item['total_price']) for item in cart]
+            second = [(item['product'].category.name, item['total_price']) for item in cart]
+            total = cart.get_total_price()
+        self.assertEqual(first, second)
+        self.assertEqual(total, Decimal("15.00"))
+
+    def test_session_payload_stays_json_clean(self):
+        cart = self.cart()
+        list(cart)
+        json.dumps(cart.session['cart'])
+        self.assertEqual(set(cart.session['cart'][str(self.pen.pk)]), {'quantity', 'price'})
+
+    def test_stale_prices_detected_and_refreshed(self):
+        cart = self.cart(self.user)
+        Product.objects.filter(pk=self.pen.pk).update(price=Decimal("5.00"))
+        [stale] = cart.hydrated().stale
+        self.assertEqual((stale['product'], stale['current_price']), (self.pen, Decimal("5.00")))
+
+        self.assertEqual(cart.refresh_prices(), [self.pen])
+        self.assertFalse(cart.hydrated().stale)
+        self.assertEqual(cart.get_total_price(), Decimal("16.00"))
+        self.assertEqual(UserCart.objects.get(user=self.user).total, Decimal("16.00"))
+
+
+class CartBatchTests(TestCase):
+    """Тесты пакетного изменения корзины."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="batch", password="pass12345")
+        category = Category.objects.create(name="Книги")
+        cls.novel, cls.poems, cls.atlas = (
+            Product.objects.create(
+                name=name, price=price, stock=stock, category=category, description="", image="products/sample.jpg",
+            )
+            for name, price, stock in (("Роман", 10, 5), ("Стихи", 4, 5), ("Атлас", 25, 1))
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+        self.client.post(reverse('products:add_to_cart', args=[self.novel.pk]), {'quantity': 1})
+        self.client.post(reverse('products:add_to_cart', args=[self.poems.pk]), {'quantity': 2})
+
+    def batch(self, *operations):
+        return self.client.post(
+            reverse('products:cart_batch'), json.dumps({'operations': list(operations)}),
+            content_type='application/json',
+        )
+
+    def test_operations_applied_in_one_request(self):
+        response = self.batch(
+            {'op': 'update', 'product_id': self.novel.pk, 'quantity': 3},
+            {'op': 'remove', 'product_id': self.poems.pk},
+            {'op': 'add', 'product_id': self.atlas.pk, 'quantity': 1},
+        )
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(set(data['lines']), {str(self.novel.pk), str(self.atlas.pk)})
+        self.assertEqual(data['lines'][str(self.novel.pk)]['total_price'], 30)
+        self.assertEqual((data['cart_total_price'], data['cart_count']), (55, 4))
+        self.assertEqual(
+            dict(StockReservation.objects.values_list('product_id', 'quantity')),
+            {self.novel.pk: 3, self.atlas.pk: 1},
+        )
+
+    def test_shortage_rejects_whole_batch(self):
+        response = self.batch(
+            {'op': 'update', 'product_id': self.novel.pk, 'quantity': 4},
+            {'op': 'add', 'product_id': self.atlas.pk, 'quantity': 2},
+        )
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['errors'], [{'product_id': self.atlas.pk, 'name': "Атлас", 'available': 1}])
+        self.assertEqual(
+            sorted(CartLine.objects.for_user(self.user).values_list('product_id', 'quantity')),
+            [(self.novel.pk, 1), (self.poems.pk, 2)],
+        )
+        self.assertEqual(StockReservation.objects.get(product=self.novel).quantity, 1)
+
+    def test_invalid_operation(self):
+        response = self.batch({'op': 'explode', 'product_id': self.novel.pk})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(reverse('products:cart_batch'), 'not json', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class OrderTotalsTests(TestCase):
+    """Тесты хранимых итогов заказов и сводки заказов пользователя."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="totals", password="pass12345")
+        category = Category.objects.create(name="Игрушки")
+        cls.car, cls.ball = (
+            Product.objects.create(
+                name=name, price=price, stock=10, category=category, description="", image="products/sample.jpg",
+            )
+            for name, price in (("Машинка", 15), ("Мяч", 8))
+        )
+
+    def summary(self):
+        return UserOrderSummary.objects.values_list('orders_count', 'total_spent').get(user=self.user)
+
+    def test_item_writes_keep_totals(self):
+        order = Order.objects.create(user=self.user)
+        item = OrderItem.objects.create(order=order, product=self.car, price=15, quantity=2)
+        OrderItem.objects.create(order=order, product=self.ball, price=8, quantity=1)
+        order.refresh_from_db()
+        self.assertEqual(order.get_total_cost(), 38)
+        self.assertEqual(self.summary(), (1, 38))
+
+        item.quantity = 1
+        item.save()
+        self.assertEqual(self.summary(), (1, 23))
+        item.delete()
+        self.assertEqual(self.summary(), (1, 8))
+
+        order.delete()
+        self.assertFalse(UserOrderSummary.objects.filter(user=self.user).exists())
+
+    def test_order_delete_skips_item_handlers(self):
+        order = Order.objects.create(user=self.user)
+        OrderItem.objects.create(order=order, product=self.car, price=15, quantity=2)
+        OrderItem.objects.create(order=order, product=self.ball, price=8, quantity=1)
+        with mock.patch('products.signals.materialize_history') as materialize, \
+                mock.patch('products.signals.refresh_order_totals') as refresh_totals:
+            order.delete()
+        materialize.assert_not_called()
+        refresh_totals.assert_not_called()
+        self.assertFalse(OrderHistoryEntry.objects.exists())
+        self.assertFalse(UserOrderSummary.objects.filter(user=self.user).exists())
+
+        # После удаления позиции других заказов снова пересчитывают итоги
+        other = Order.objects.create(user=self.user)
+        OrderItem.objects.create(order=other, product=self.car, price=15, quantity=1)
+        self.assertEqual(self.summary(), (1, 15))
+
+    def test_cancelled_orders_not_counted_in_spend(self):
+        order = Order.objects.create(user=self.user)
+        OrderItem.objects.create(order=order, product=self.car, price=15, quantity=1)
+        order.status = 'cancelled'
+        order.save()
+        self.assertEqual(self.summary(), (1, 0))
+        self.assertIsNotNone(UserOrderSummary.objects.get(user=self.user).last_order_at)
+
+    def test_rebuild_command(self):
+        order = Order.objects.create(user=self.user)
+        OrderItem.objects.create(order=order, product=self.car, price=15, quantity=3)
+        # Изменения в обход сигналов
+        Order.objects.update(total_amount=0)
+        UserOrderSummary.objects.all().delete()
+
+        out = StringIO()
+        call_command('rebuild_order_totals', stdout=out)
+        order.refresh_from_db()
+        self.assertEqual(order.total_amount, 45)
+        self.assertEqual(self.summary(), (1, 45))
+        self.assertIn("сводок пользователей: 1", out.getvalue())
+
+
+@override_settings(ORDER_HISTORY_PAGE_SIZE=4)
+class OrderHistoryTests(TestCase):
+    """Тесты истории заказов из OrderHistoryEntry."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username="history", password="pass12345")
+        cls.other = User.objects.create_user(username="neighbour", password="pass12345")
+        category = Category.objects.create(name="Садовые товары")
+        cls.rake = Product.objects.create(
+            name="Грабли", price=30, stock=100, category=category, description="", image="products/sample.jpg",
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def place(self, user, quantity=1):
+        order = Order(
+            user=user, first_name="Анна", last_name="Петрова", email="anna@example.com",
+            address="ул. Садовая, 5", postal_code="2001", city="Бельцы", country="MD",
+            payment_method="paypal",
+        )
+        return place_order(order, {self.rake.pk: quantity})
+
+    def test_entry_materialized_at_order_time(self):
+        order = self.place(self.user, 2)
+        entry = OrderHistoryEntry.objects.get(order=order)
+        self.assertEqual(entry.items, [{'name': "Грабли", 'quantity': 2, 'price': "30.00"}])
+        self.assertEqual((entry.total_amount, entry.address), (60, "ул. Садовая, 5, 2001, Бельцы"))
+
+    def test_pages_follow_cursor_and_stay_per_user(self):
+        orders = [self.place(self.user) for _ in range(6)]
+        self.place(self.other)
+        self.client.force_login(self.user)
+        url = reverse('accounts:order_history')
+
+        response = self.client.get(url)
+        page = response.context['orders']
+        self.assertEqual([entry.order_id for entry in page], [o.pk for o in reversed(orders)][:4])
+        response = self.client.get(url, {'cursor': page.next_cursor})
+        self.assertEqual([entry.order_id for entry in response.context['orders']], [orders[1].pk, orders[0].pk])
+
+        self.client.force_login(self.other)
+        response = self.client.get(url)
+        self.assertEqual(len(response.context['orders']), 1)
+
+    def test_cached_page_invalidated_on_status_change(self):
+        order = self.place(self.user)
+        self.client.force_login(self.user)
+        url = reverse('products:order_history')
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(url)
+        self.assertFalse([q for q in context.captured_queries if 'orderhistoryentry' in q['sql']])
+
+        order.status = 'shipped'
+        order.save()
+        response = self.client.get(url)
+        self.assertEqual(response.context['orders'][0].status, 'shipped')
+
+
+class OrderLifecycleTests(TestCase):
+    """Тесты массовой смены статусов заказов."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_superuser(username="warehouse", password="pass12345")
+        cls.user = User.objects.create_user(username="buyer", password="pass12345")
+        category = Category.objects.create(name="Склад")
+        cls.box = Product.objects.create(
+            name="Коробка", price=10, stock=100, category=category, description="", image="products/sample.jpg",
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def place(self, quantity=1):
+        order = Order(
+            user=self.user, first_name="Иван", last_name="Сидоров", email="ivan@example.com",
+            address="ул. Мира, 1", postal_code="2000", city="Кишинёв", country="MD",
+            payment_method="paypal",
+        )
+        return place_order(order, {self.box.pk: quantity})
+
+    def test_bulk_transition_writes_events_and_read_models(self):
+        orders = [self.place(2) for _ in range(3)]
+        ids = [order.pk for order in orders]
+        count = Order.objects.filter(pk__in=ids[:2]).transition('cancelled', actor=self.staff, note="нет оплаты")
+
+        self.assertEqual(count, 2)
+        self.assertEqual(Order.objects.filter(status='cancelled').count(), 2)
+        events = OrderStatusEvent.objects.filter(order_id__in=ids)
+        self.assertEqual(
+            sorted(events.values_list('order_id', 'from_status', 'to_status', 'actor', 'note')),
+            [(pk, 'processing', 'cancelled', self.staff.pk, "нет оплаты") for pk in ids[:2]],
+        )
+        self.assertEqual(OrderHistoryEntry.objects.filter(status='cancelled').count(), 2)
+        self.assertEqual(UserOrderSummary.objects.get(user=self.user).total_spent, 20)
+        # Повторный перевод в тот же статус ничего не делает
+        self.assertEqual(transition_orders(ids[:2], 'cancelled'), 0)
+
+    def test_invalid_transition_rejects_whole_batch(self):
+        shipped, fresh = self.place(), self.place()
+        transition_orders([shipped.pk], 'shipped')
+        transition_orders([shipped.pk], 'delivered')
+
+        with self.assertRaises(InvalidTransitionError) as context:
+            transition_orders([shipped.pk, fresh.pk], 'cancelled')
+        self.assertEqual(context.exception.invalid, [(shipped.pk, 'delivered')])
+        self.assertEqual(Order.objects.get(pk=fresh.pk).status, 'processing')
+        self.assertEqual(OrderStatusEvent.objects.filter(order=fresh).count(), 0)
+
+    def test_updates_are_chunked(self):
+        ids = [self.place().pk for _ in range(5)]
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(transition_orders(ids, 'shipped', chunk_size=2), 5)
+        updates = [q for q in context.captured_queries if q['sql'].startswith('UPDATE "products_order"')]
+        inserts = [q for q in context.captured_queries if 'INSERT INTO "products_orderstatusevent"' in q['sql']]
+        self.assertEqual((len(updates), len(inserts)), (3, 1))
+
+    def test_admin_action(self):
+        orders = [self.place() for _ in range(2)]
+        self.client.force_login(self.staff)
+        response = self.client.post(reverse('admin:products_order_changelist'), {
+            'action': 'mark_shipped',
+            '_selected_action': [order.pk for order in orders],
+        }, follow=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Order.objects.filter(status='shipped').count(), 2)
+
+        response = self.client.post(reverse('admin:products_order_changelist'), {
+            'action': 'cancel_orders',
+            '_selected_action': [orders[0].pk],
+        }, follow=True)
+        self.assertEqual(Order.objects.get(pk=orders[0].pk).status, 'cancelled')
+        response = self.client.post(reverse('admin:products_order_changelist'), {
+            'action': 'mark_delivered',
+            '_selected_action': [order.pk for order in orders],
+        }, follow=True)
+        self.assertContains(response, "Нельзя перевести в статус delivered")
+        self.assertEqual(Order.objects.get(pk=orders[1].pk).status, 'shipped')
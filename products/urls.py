@@ -34,6 +34,7 @@ urlpatterns = [
 
     path('cart/update_quantity/', views.update_quantity, name='update_quantity'),
     path('cart/remove_item/', views.remove_item, name='remove_item'),
+    path('cart/batch/', views.cart_batch, name='cart_batch'),
     path('staticpage/<int:pk>/preview/', views.static_page_preview, name='staticpage_preview'),
     path('category/<slug:category_slug>/<slug:subcategory_slug>/', views.subcategory_detail, name='subcategory_detail'),
 
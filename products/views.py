@@ -1,31 +1,42 @@
+import json
+import time
 from datetime import datetime
 
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.core.cache import cache
 from django.core.paginator import Paginator
-from django.db.models import Q
 from django.http import JsonResponse
 from django.shortcuts import render, get_object_or_404, redirect
-from django.utils.safestring import mark_safe
-from django.views.decorators.cache import cache_page
 from django.views.decorators.http import require_POST
 from django_filters.views import FilterView
 
-from accounts.models import UserActivity
+from accounts.events import activity_events
+from accounts.models import ActivityType
+from .analytics import search_query_log
+from .autocomplete import autocomplete_index
 from .cart import Cart
+from .currency import CURRENCY_SESSION_KEY, exchange_rates, localize_prices, session_currency
+from .facets import get_facets
 from .filters import ProductFilter
+from .highlight import highlight_products
 from .forms import OrderCreateForm, ReviewForm
+from .orders import order_history_page
 from .models import Product, Category, OrderItem, Review, Wishlist, Order, StaticPage, SubCategory
+from .pagination import KeysetPaginator, approximate_count, pagination_mode
+from .reservations import available_stock
+from .search import CachedSearchResults, get_search_backend, id_chunks, query_signature, search_result_cache
+from .services import InsufficientStockError, place_order
 from .utils import fuzzy_search_suggestions
 
 
 def home(request):
-    featured_products = Product.objects.filter(is_featured=True)
-    categories = Category.objects.all()
+    # Меню категорий берётся из закешированного дерева (context processor navigation)
+    # Шаблон показывает два ряда по 4 товара — выбираем их одним запросом
+    featured_products = localize_prices(
+        Product.objects.filter(is_featured=True)[:8], session_currency(request.session),
+    )
     context = {
         'featured_products': featured_products,
-        'categories': categories,
         'current_year': datetime.now().year,
     }
     return render(request, 'home.html', context)
@@ -34,40 +45,45 @@ def add_to_cart(request, product_id):
     cart = Cart(request)
     product = get_object_or_404(Product, id=product_id)
     quantity = int(request.POST.get('quantity', 1))
-    if quantity > product.stock:
-        messages.error(request, f"Извините, доступно только {product.stock} единиц товара.")
+    in_cart = cart.quantity(product)
+    # Доступно столько, сколько не зарезервировано другими корзинами;
+    # резервируется всё количество в корзине, а не только добавляемое
+    available = available_stock(product, cart.holder)
+    if in_cart + quantity > available:
+        if in_cart:
+            messages.error(request, f"Извините, доступно только {available} единиц товара, в корзине уже {in_cart}.")
+        else:
+            messages.error(request, f"Извините, доступно только {available} единиц товара.")
     else:
-        cart.add(product=product, quantity=quantity)
-        messages.success(request, "Товар добавлен в корзину.")
+        reserved = cart.add(product=product, quantity=quantity)
+        if reserved < in_cart + quantity:
+            # Пока добавляли, остаток зарезервировали другие корзины
+            messages.warning(request, f"Удалось зарезервировать только {reserved} единиц товара.")
+        else:
+            messages.success(request, "Товар добавлен в корзину.")
     return redirect('products:cart_detail')
 
 
-def get_currency_symbol(currency_code):
-    symbols = {
-        'MDL': 'L',
-        'USD': '$',
-        'EUR': '€',
-    }
-    return symbols.get(currency_code, '')
-
-
 @login_required
 def cart_detail(request):
-    cart = Cart(request)
+    # Выбор валюты: сохраняем только известные коды. До сборки строк корзины,
+    # иначе они будут пересчитаны в прежнюю валюту
+    if request.method == 'POST' and request.POST.get('currency') in exchange_rates.all():
+        request.session[CURRENCY_SESSION_KEY] = request.POST['currency']
 
-    # Handle currency selection
-    if request.method == 'POST' and 'currency' in request.POST:
-        currency = request.POST.get('currency', 'MDL')
-        request.session['currency'] = currency
-    else:
-        currency = request.session.get('currency', 'MDL')
-
-    currency_symbol = get_currency_symbol(currency)
+    cart = Cart(request)
+    # Пока покупатель смотрит корзину, резервы не истекают
+    cart.extend_reservations()
+    # Заказ оформляется по текущим ценам — показываем их же
+    for product in cart.refresh_prices():
+        messages.info(request, f"Цена товара «{product.name}» изменилась.")
+    currency = cart.currency
 
     context = {
         'cart': cart,
-        'currency': currency,
-        'currency_symbol': currency_symbol,
+        'currency': currency.code,
+        'currency_symbol': currency.symbol,
+        'currencies': exchange_rates.all().values(),
         'current_year': datetime.now().year,
     }
     return render(request, 'cart_detail.html', context)
@@ -87,15 +103,13 @@ def order_create(request):
         if form.is_valid():
             order = form.save(commit=False)
             order.user = request.user
-            order.save()
-            # Добавляем товары в заказ
-            for item in cart:
-                OrderItem.objects.create(
-                    order=order,
-                    product=item['product'],
-                    price=item['price'],
-                    quantity=item['quantity']
-                )
+            # Заказ, позиции и списание остатков — одной транзакцией
+            try:
+                place_order(order, cart.quantities(), holder=cart.holder)
+            except InsufficientStockError as e:
+                for _, name, available in e.shortages:
+                    messages.error(request, f"Извините, товара «{name}» доступно только {available} шт.")
+                return render(request, 'order_create.html', {'cart': cart, 'form': form})
             # Очищаем корзину
             cart.clear()
             messages.success(request, 'Заказ успешно оформлен!')
@@ -105,7 +119,10 @@ def order_create(request):
     return render(request, 'order_create.html', {'cart': cart, 'form': form})
 def category_detail(request, slug):
     category = get_object_or_404(Category, slug=slug)
-    products = category.products.all()  # Используя related_name='products'
+    products = localize_prices(
+        category.products.all(),  # Используя related_name='products'
+        session_currency(request.session),
+    )
     context = {
         'category': category,
         'products': products,
@@ -116,11 +133,8 @@ def product_detail(request, product_id):
     product = get_object_or_404(Product, id=product_id)
     # Логика отображения продукта
     if request.user.is_authenticated:
-        UserActivity.objects.create(
-            user=request.user,
-            activity_type='Просмотр товара',
-            description=f'Просмотрел товар: {product.name}'
-        )
+        # Запись в БД — пачкой в фоне (accounts/events.py)
+        activity_events.record(request.user.pk, ActivityType.PRODUCT_VIEW, product.pk)
     return render(request, 'product_detail.html', {'product': product})
 
 
@@ -171,10 +185,10 @@ def view_wishlist(request):
     return render(request, 'wishlist.html', {'page_obj': page_obj})
 
 @login_required
-@cache_page(60 * 15)
 def order_history(request):
-    orders = Order.objects.filter(user=request.user).order_by('-created_at')
-    return render(request, 'accounts/order_history.html', {'orders': orders})
+    # Страница строится из OrderHistoryEntry и кешируется по пользователю (products/orders.py)
+    page = order_history_page(request.user, request.GET.get('cursor'))
+    return render(request, 'accounts/order_history.html', {'orders': page})
 
 class ProductListView(FilterView):
     model = Product
@@ -187,8 +201,31 @@ class ProductListView(FilterView):
         queryset = super().get_queryset().select_related('category')
         return queryset
 
+    def paginate_queryset(self, queryset, page_size):
+        """
+        В режиме 'cursor' (или при наличии ?cursor=) используем keyset-пагинацию
+        по активной сортировке вместо COUNT(*) + OFFSET.
+        """
+        cursor = self.request.GET.get('cursor')
+        if cursor is None and pagination_mode() != 'cursor':
+            return super().paginate_queryset(queryset, page_size)
+        page = KeysetPaginator(queryset, page_size).page(cursor)
+        self.cursor_pagination = True
+        return None, page, page.object_list, page.has_other_pages()
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        if getattr(self, 'cursor_pagination', False):
+            context['cursor_pagination'] = True
+            context['approx_total'] = approximate_count(self.object_list)
+        # Фасеты по текущим фильтрам (без сортировки и страницы) — один
+        # агрегирующий запрос, результат кешируется
+        filters = {
+            key: value for key, value in self.filterset.data.items()
+            if key in self.filterset.filters and key != 'ordering'
+        }
+        context['facets'] = get_facets(self.object_list, query_signature('', scope='list', **filters))
+        context['products'] = localize_prices(context['products'], session_currency(self.request.session))
         user = self.request.user
         if user.is_authenticated:
             # Получаем список ID продуктов, находящихся в списке желаний пользователя
@@ -198,107 +235,162 @@ class ProductListView(FilterView):
             context['wishlist_product_ids'] = set()
         return context
 
-def highlight(text, query):
-    """Подсвечивает найденный текст с помощью тега <mark>."""
-    if not query:
-        return text
-    # Для упрощения выделяем все вхождения query (регистр зависит от используемых методов)
-    return mark_safe(text.replace(query, f'<mark>{query}</mark>'))
+SEARCH_SORTS = ['name', 'price', '-price', 'created_at', '-created_at']
+
+
+def search_matches(products, ranked_ids, sort_option):
+    """
+    id найденных товаров, прошедших фильтры products, в порядке сортировки.
+    Найденные id проверяются пачками (id_chunks); для сортировки по полю
+    вместе с id читается значение поля, и пачки упорядочиваются в Python
+    (для строк — по кодам символов, как BINARY в SQLite).
+    """
+    if sort_option == 'relevance':
+        matching = set()
+        for chunk in id_chunks(ranked_ids):
+            matching.update(products.filter(id__in=chunk).values_list('id', flat=True))
+        return [pk for pk in ranked_ids if pk in matching]
+    field = sort_option.lstrip('-')
+    rows = sorted(
+        row
+        for chunk in id_chunks(ranked_ids)
+        for row in products.filter(id__in=chunk).values_list('id', field)
+    )
+    # Сортировка устойчива: при равных значениях остаётся порядок по id
+    rows.sort(key=lambda row: row[1], reverse=sort_option.startswith('-'))
+    return [pk for pk, _ in rows]
+
+
+
 def product_search(request):
+    started = time.perf_counter()
     query = request.GET.get('q', '').strip()
-    sort_option = request.GET.get('sort', 'name')  # параметр сортировки из GET
+    # При наличии запроса по умолчанию сортируем по релевантности
+    sort_option = request.GET.get('sort', 'relevance' if query else 'name')
     category_filter = request.GET.get('category', '')  # фильтр по категории
+    subcategory_filter = request.GET.get('subcategory', '')
+    in_stock = request.GET.get('in_stock', '') in ('1', 'true', 'on')
     price_min = request.GET.get('price_min', '')
     price_max = request.GET.get('price_max', '')
 
-    # Ключ для кэша (включим в него все параметры, чтобы кэшировать конкретные результаты)
-    cache_key = f"search_{query}_{sort_option}_{category_filter}_{price_min}_{price_max}"
-    results = cache.get(cache_key)
-
-    if results is None:
-        # Если запрос пустой - показываем все товары.
-        products = Product.objects.all()
-
-        # Фильтруем по запросу (по названию, описанию, категории)
+    if sort_option not in SEARCH_SORTS and not (query and sort_option == 'relevance'):
+        sort_option = 'name'
+
+    # Если запрос пустой - показываем все товары.
+    products = Product.objects.all()
+
+    # Фильтрация по категории и цене
+    if category_filter:
+        products = products.filter(category__slug=category_filter)
+    if subcategory_filter:
+        products = products.filter(subcategory__slug=subcategory_filter)
+    if in_stock:
+        products = products.filter(stock__gt=0)
+    if price_min.isdigit():
+        products = products.filter(price__gte=float(price_min))
+    if price_max.isdigit():
+        products = products.filter(price__lte=float(price_max))
+
+    # В кеше храним не QuerySet, а упорядоченный список id и общее число
+    # результатов; страница гидрируется одним запросом id__in
+    filters = {
+        'category': category_filter,
+        'subcategory': subcategory_filter,
+        'in_stock': '1' if in_stock else '',
+        'price_min': price_min if price_min.isdigit() else '',
+        'price_max': price_max if price_max.isdigit() else '',
+    }
+    signature = query_signature(query, sort=sort_option, **filters)
+    # Просмотр каталога без запроса в режиме курсора: keyset по активной
+    # сортировке, глубина страницы не влияет на стоимость запроса
+    cursor = request.GET.get('cursor')
+    cursor_pagination = not query and (cursor is not None or pagination_mode() == 'cursor')
+    results = None if cursor_pagination else search_result_cache.get(signature)
+    cache_hit = results is not None
+    fallback = None
+
+    if cursor_pagination:
+        # Префикс id и точный COUNT здесь не нужны — число товаров приблизительное
+        results = {'ids': [], 'total': approximate_count(products), 'did_you_mean': []}
+    elif results is None:
+        max_ids = search_result_cache.max_ids()
         if query:
-            products = products.filter(
-                Q(name__icontains=query) |
-                Q(description__icontains=query) |
-                Q(category__name__icontains=query)
-            ).distinct()
-
-        # Фильтрация по категории, бренду и цене
-        if category_filter:
-            products = products.filter(category__slug=category_filter)
-
-        if price_min.isdigit():
-            products = products.filter(price__gte=float(price_min))
-        if price_max.isdigit():
-            products = products.filter(price__lte=float(price_max))
-
-        # Сортировка (по цене, по дате добавления, по популярности)
-        # Предположим: name (по имени), price (по цене), -price (по убыванию цены),
-        # created_at (по дате), -created_at (по убыванию даты)
-        # popularity не указана в модели, но предположим что сортируем по количеству просмотров или по created_at
-        valid_sorts = ['name', 'price', '-price', 'created_at', '-created_at']
-        if sort_option not in valid_sorts:
-            sort_option = 'name'
-        products = products.order_by(sort_option)
+            # Ищем по инвертированному индексу (название, описание, категория),
+            # ids возвращаются в порядке релевантности (BM25)
+            ranked_ids = get_search_backend().search(query)
+            ids = search_matches(products, ranked_ids, sort_option)
+            total = len(ids)
+        else:
+            ordered = products.order_by(sort_option, 'id')
+            ids = list(ordered.values_list('id', flat=True)[:max_ids + 1])
+            total = len(ids) if len(ids) <= max_ids else ordered.count()
 
         # Если ничего не найдено, попробуем предложить "Did you mean?" (fuzzy search)
-        did_you_mean = []
-        if query and not products.exists():
-            # Используем вашу логику или внешнюю утилиту для fuzzy search
-            did_you_mean = fuzzy_search_suggestions(query)  # например, ['product1', 'product2']
-
-        results = {
-            'products': products,
-            'did_you_mean': did_you_mean,
-            'query': query,
-        }
+        did_you_mean = fuzzy_search_suggestions(query) if query and not total else []
+        # Результаты поиска по q кешируются целиком, полный каталог — только
+        # первые max_ids позиций
+        results = search_result_cache.set(signature, ids if query else ids[:max_ids], total, did_you_mean)
 
-        # Кэшируем результаты на 5 минут
-        cache.set(cache_key, results, 300)
-    else:
-        products = results['products']
-        did_you_mean = results['did_you_mean']
-        query = results['query']
+    # Фасеты не зависят от сортировки; для поиска по q считаются по
+    # найденным id, для каталога — по отфильтрованной выборке
+    facets = get_facets(
+        products, query_signature(query, scope='search', **filters), results['ids'] if query else None,
+    )
 
     # Пагинация
-    paginator = Paginator(products, 12)  # 12 товаров на страницу
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    if cursor_pagination:
+        page_obj = KeysetPaginator(products, 12, ordering=sort_option).page(cursor)
+    else:
+        if results['total'] > len(results['ids']):
+            # Глубокие страницы каталога за пределами закешированного префикса
+            fallback = products.order_by(sort_option, 'id')
+        paginator = Paginator(
+            CachedSearchResults(results['ids'], results['total'], Product.objects.all(), fallback),
+            12,  # 12 товаров на страницу
+        )
+        page_number = request.GET.get('page')
+        page_obj = paginator.get_page(page_number)
 
-    # Подсветим запрос в названиях и описаниях
-    # В шаблоне вместо product.name и product.description используем product.highlighted_name и product.highlighted_description
-    highlighted_products = []
-    for p in page_obj:
-        p.highlighted_name = highlight(p.name, query)
-        p.highlighted_description = highlight(p.description, query)
-        highlighted_products.append(p)
+    # Подсвечиваем запрос в названиях и коротких фрагментах описаний
+    # (текст без HTML, фрагменты кешируются по товару и термам запроса)
+    highlighted_products = localize_prices(
+        highlight_products(page_obj, query), session_currency(request.session),
+    )
+
+    if query:
+        # Запись буферизуется и пишется в БД пачкой вне запроса
+        search_query_log.record(
+            query, dict(filters, sort=sort_option), results['total'],
+            (time.perf_counter() - started) * 1000, cache_hit,
+        )
 
     return render(request, 'product_search.html', {
         'query': query,
         'page_obj': page_obj,
-        'did_you_mean': did_you_mean,
+        'total_results': results['total'],
+        'cursor_pagination': cursor_pagination,
+        'did_you_mean': results['did_you_mean'],
         'selected_sort': sort_option,
         'selected_category': category_filter,
+        'selected_subcategory': subcategory_filter,
+        'in_stock': in_stock,
+        'facets': facets,
         'price_min': price_min,
         'price_max': price_max,
         'highlighted_products': highlighted_products,
     })
 
 def search_suggestions(request):
+    """
+    Подсказки для поля поиска: берутся из индекса автодополнения в памяти,
+    без запросов к БД. Параметр limit ограничен settings.SEARCH_SUGGESTIONS_LIMIT.
+    """
     query = request.GET.get('q', '').strip()
-    products = []
-    categories = []
-    if query:
-        products = list(Product.objects.filter(name__icontains=query).values('id', 'name'))
-        categories = list(Category.objects.filter(name__icontains=query).values('slug', 'name'))
-    return JsonResponse({
-        'products': products,
-        'categories': categories
-    })
+    try:
+        limit = int(request.GET.get('limit', 0))
+    except ValueError:
+        limit = 0
+    return JsonResponse(autocomplete_index.search(query, limit=limit if limit > 0 else None))
 
 @require_POST
 def update_quantity(request):
@@ -328,6 +420,41 @@ def remove_item(request):
         'cart_empty': cart_empty,
     })
 
+@require_POST
+def cart_batch(request):
+    """
+    Пакетное изменение корзины (AJAX). Тело — JSON:
+    {"operations": [{"op": "add" | "update" | "remove", "product_id": 1, "quantity": 2}, ...]}
+    Все операции проверяются по остаткам одним запросом и применяются
+    атомарно; в ответе — итоги изменённых строк и всей корзины.
+    """
+    cart = Cart(request)
+    try:
+        operations = json.loads(request.body)['operations']
+        hydrated = cart.apply(operations)
+    except InsufficientStockError as e:
+        return JsonResponse({
+            'errors': [
+                {'product_id': product_id, 'name': name, 'available': available}
+                for product_id, name, available in e.shortages
+            ],
+        }, status=409)
+    except (ValueError, KeyError, TypeError) as e:
+        return JsonResponse({'errors': [{'message': str(e) or "Некорректный запрос"}]}, status=400)
+    return JsonResponse({
+        'lines': {
+            str(item['product'].id): {
+                'quantity': item['quantity'],
+                'price': float(item['price']),
+                'total_price': float(item['total_price']),
+            }
+            for item in hydrated
+        },
+        'cart_total_price': float(hydrated.total),
+        'cart_count': hydrated.count,
+        'cart_empty': not hydrated.items,
+    })
+
 def static_page(request, slug):
     page = get_object_or_404(StaticPage, slug=slug)
     return render(request, 'static_page.html', {'page': page})
@@ -344,7 +471,12 @@ def static_page_preview(request, pk):
 def subcategory_detail(request, category_slug, subcategory_slug):
     category = get_object_or_404(Category, slug=category_slug)
     subcategory = get_object_or_404(SubCategory, category=category, slug=subcategory_slug)
-    products = Product.objects.filter(category=category)  # Если у вас есть связь товара с подкатегорией, отфильтруйте и по ней
+    products = localize_prices(
+        # Как фильтр ?subcategory=, фасеты и счётчики навигации: только товары,
+        # привязанные к подкатегории. Непривязанные видны на странице категории
+        Product.objects.filter(category=category, subcategory=subcategory),
+        session_currency(request.session),
+    )
     return render(request, 'subcategory_detail.html', {
         'category': category,
         'subcategory': subcategory,